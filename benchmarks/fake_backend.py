@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""
+Module for in-process stand-ins of smartsched.common cloud and monitoring handlers.
+
+FakeCluster keeps hosts, VMs and VM usage in memory. FakeCloud and
+FakeMonitoring answer requests of strategies from it with the same data
+layout as the real handlers and can add latency to every call. It is used by
+benchmarks, by the simulator and by tests, it is not installed with the package:
+
+    cluster = fake_backend.generate_cluster(hosts=100, vms_per_host=20, pending=50)
+    common.get_cloud_handler = lambda: fake_backend.FakeCloud(cluster, latency=0.01)
+    common.get_monitoring_handler = lambda: fake_backend.FakeMonitoring(cluster, latency=0.02)
+"""
+import datetime
+import random
+import threading
+
+import smartsched.daemon.clock as clocks
+
+EPOCH = datetime.datetime(1970, 1, 1, 0, 0)
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+USAGE_DISTRIBUTIONS = ['uniform', 'normal', 'bimodal', 'idle', 'busy']
+
+
+def draw_usage(rng, distribution):
+    """Usage ratio (0..1) of one VM resource."""
+    if distribution == 'uniform':
+        return rng.random()
+    if distribution == 'normal':
+        return min(1.0, max(0.0, rng.gauss(0.3, 0.15)))
+    if distribution == 'bimodal':
+        # Most of VMs are almost idle, the rest is loaded
+        if rng.random() < 0.6:
+            return rng.uniform(0.0, 0.1)
+        return rng.uniform(0.5, 1.0)
+    if distribution == 'idle':
+        return rng.uniform(0.0, 0.05)
+    if distribution == 'busy':
+        return rng.uniform(0.8, 1.0)
+    raise ValueError('Unknown usage distribution ' + distribution + ', expected one of ' +
+                     ', '.join(USAGE_DISTRIBUTIONS))
+
+
+class FakeCluster:
+    """Hosts and VMs of the fake cloud.
+
+    Units are the same as in the cloud: host['usage_cpu'] and
+    vm['cpu_allocated'] are measured in percents of one core, memory in KB,
+    vm['cpu_req'] in cores and vm['mem_req'] in MB.
+
+    Attributes:
+        hosts: {host_id: host}
+        host_names: {host_name: host}
+        vms: {vm_id: vm}
+        usage: {vm_id: {'cpu': ratio, 'mem': ratio}} current usage of VM allocation
+        deploy_time: seconds from deploy call till VM is RUNNING
+        migration_time: seconds from migrate call till VM is RUNNING on the new host
+        transitions: {vm_id: (time, action)} VMs which become RUNNING at given time, action
+            is their deploy or migration in history
+        history: log of deploys and migrations for reports, 'running' of an action is the time
+            when the VM became RUNNING or None if it is not RUNNING yet (or was terminated before)
+    """
+
+    def __init__(self, clock=None, deploy_time=0, migration_time=0):
+        self.clock = clock if clock is not None else clocks.SystemClock()
+        self.deploy_time = deploy_time
+        self.migration_time = migration_time
+        self.hosts = {}
+        self.host_names = {}
+        self.vms = {}
+        self.usage = {}
+        self.transitions = {}
+        self.history = []
+        self.lock = threading.RLock()
+
+    def add_host(self, host_id, cluster_id, cpu_max, mem_max, name=None, im_mad='im_ovz'):
+        host = {'id': host_id,
+                'name': name if name is not None else 'host' + str(host_id),
+                'cluster_id': cluster_id,
+                'im_mad': im_mad,
+                'vms': [],
+                'usage_cpu': {'max': cpu_max, 'allocated': 0, 'used': 0, 'ratio_overc': 0.0, 'ratio_used': 0.0},
+                'usage_mem': {'max': mem_max, 'allocated': 0, 'used': 0, 'ratio_overc': 0.0, 'ratio_used': 0.0}}
+        self.hosts[host_id] = host
+        self.host_names[host['name']] = host
+        return host
+
+    def add_vm(self, vm_id, cluster_id, cpu_allocated, mem_allocated, host_id=None, start_time=None,
+               cpu_usage=0.0, mem_usage=0.0):
+        """Add running VM (if host_id is given) or pending one."""
+        vm = {'id': vm_id,
+              'hid': -1,
+              'cluster_id': [cluster_id],
+              'cpu_allocated': cpu_allocated,
+              'mem_allocated': mem_allocated,
+              'cpu_req': cpu_allocated / 100.0,
+              'mem_req': mem_allocated / 1024.0,
+              'rstime': EPOCH,
+              'retime': EPOCH,
+              'state': 'PENDING',
+              'lcm_state': 'LCM_INIT'}
+        self.vms[vm_id] = vm
+        self.usage[vm_id] = {'cpu': cpu_usage, 'mem': mem_usage}
+        if host_id is not None:
+            self._attach(vm, host_id)
+            vm['state'] = 'ACTIVE'
+            vm['lcm_state'] = 'RUNNING'
+            vm['rstime'] = start_time if start_time is not None else self.clock.utcnow()
+        return vm
+
+    def remove_vm(self, vm_id):
+        """Terminate VM."""
+        with self.lock:
+            vm = self.vms[vm_id]
+            if vm['hid'] >= 0:
+                self._detach(vm)
+            vm['state'] = 'DONE'
+            vm['lcm_state'] = 'LCM_INIT'
+            vm['retime'] = self.clock.utcnow()
+            self.transitions.pop(vm_id, None)
+
+    def _attach(self, vm, host_id):
+        host = self.hosts[host_id]
+        vm['hid'] = host_id
+        host['vms'].append(str(vm['id']))
+        self._account(host, vm, 1)
+
+    def _detach(self, vm):
+        host = self.hosts[vm['hid']]
+        host['vms'].remove(str(vm['id']))
+        self._account(host, vm, -1)
+        vm['hid'] = -1
+
+    def _account(self, host, vm, sign):
+        usage = self.usage[vm['id']]
+        for resource in ['cpu', 'mem']:
+            host_usage = host['usage_' + resource]
+            host_usage['allocated'] += sign * vm[resource + '_allocated']
+            host_usage['used'] += sign * usage[resource] * vm[resource + '_allocated']
+            host_usage['ratio_overc'] = 1.0 * host_usage['allocated'] / host_usage['max']
+            host_usage['ratio_used'] = 1.0 * host_usage['used'] / host_usage['max']
+
+    def set_usage(self, vm_id, cpu, mem):
+        """Change usage ratios of VM, host usage is updated too."""
+        with self.lock:
+            vm = self.vms[vm_id]
+            if vm['hid'] >= 0:
+                self._account(self.hosts[vm['hid']], vm, -1)
+            self.usage[vm_id] = {'cpu': cpu, 'mem': mem}
+            if vm['hid'] >= 0:
+                self._account(self.hosts[vm['hid']], vm, 1)
+
+    def update(self):
+        """Finish deploys and migrations whose time has come."""
+        with self.lock:
+            if not self.transitions:
+                return
+            now = self.clock.time()
+            for vm_id, (ready_time, action) in list(self.transitions.items()):
+                if ready_time <= now:
+                    del self.transitions[vm_id]
+                    self.vms[vm_id]['lcm_state'] = 'RUNNING'
+                    # The state is changed by the next call, but the VM is RUNNING since ready_time
+                    action['running'] = ready_time
+
+    def deploy(self, vm_id, host_id):
+        with self.lock:
+            vm = self.vms[vm_id]
+            if vm['state'] != 'PENDING' or host_id not in self.hosts:
+                return False
+            self._attach(vm, host_id)
+            vm['state'] = 'ACTIVE'
+            vm['rstime'] = self.clock.utcnow()
+            action = {'action': 'deploy', 'vm': vm_id, 'host': host_id, 'time': self.clock.time()}
+            self.history.append(action)
+            self._start_transition(vm, 'PROLOG', self.deploy_time, action)
+            return True
+
+    def migrate(self, vm_id, host_id):
+        with self.lock:
+            vm = self.vms[vm_id]
+            if vm['lcm_state'] != 'RUNNING' or host_id not in self.hosts or vm['hid'] == host_id:
+                return False
+            source = vm['hid']
+            self._detach(vm)
+            self._attach(vm, host_id)
+            action = {'action': 'migrate', 'vm': vm_id, 'host': host_id, 'source': source,
+                      'time': self.clock.time()}
+            self.history.append(action)
+            self._start_transition(vm, 'MIGRATE', self.migration_time, action)
+            return True
+
+    def _start_transition(self, vm, lcm_state, duration, action):
+        if duration > 0:
+            vm['lcm_state'] = lcm_state
+            action['running'] = None
+            self.transitions[vm['id']] = (self.clock.time() + duration, action)
+        else:
+            vm['lcm_state'] = 'RUNNING'
+            action['running'] = self.clock.time()
+
+
+def copy_host(host):
+    copy = dict(host)
+    copy['vms'] = list(host['vms'])
+    copy['usage_cpu'] = dict(host['usage_cpu'])
+    copy['usage_mem'] = dict(host['usage_mem'])
+    return copy
+
+
+def generate_cluster(hosts=10, vms_per_host=10, pending=10, cluster_id=108, host_cores=32, host_mem_gb=128,
+                     vm_cores=(1, 2, 4), vm_mem_gb=(1, 2, 4, 8), usage='bimodal', fresh_ratio=0.1,
+                     max_age_hours=24 * 30, seed=0, clock=None, deploy_time=0, migration_time=0, clusters=1):
+    """Synthetic cluster with random VMs.
+
+    Args:
+        hosts: amount of hosts
+        vms_per_host: amount of running VMs on every host
+        pending: amount of pending VMs
+        vm_cores, vm_mem_gb: sizes of VMs are chosen from these values
+        usage: distribution of VM usage, one of USAGE_DISTRIBUTIONS
+        fresh_ratio: part of VMs which were started during the last hour
+        max_age_hours: the oldest VM start time
+        clusters: hosts are spread over this amount of clusters with ids starting from cluster_id
+
+    Returns:
+        FakeCluster
+    """
+    rng = random.Random(seed)
+    cluster = FakeCluster(clock, deploy_time, migration_time)
+    now = cluster.clock.utcnow()
+    for host_id in range(hosts):
+        cluster.add_host(host_id, cluster_id + host_id % clusters, host_cores * 100, host_mem_gb * 1024 * 1024)
+
+    vm_id = 0
+    for host_id in range(hosts):
+        for _ in range(vms_per_host):
+            vm_id += 1
+            if rng.random() < fresh_ratio:
+                age = datetime.timedelta(minutes=rng.uniform(1, 60))
+            else:
+                age = datetime.timedelta(hours=rng.uniform(1, max_age_hours))
+            cluster.add_vm(vm_id, cluster_id + host_id % clusters, rng.choice(vm_cores) * 100,
+                           rng.choice(vm_mem_gb) * 1024 * 1024, host_id, now - age,
+                           draw_usage(rng, usage), draw_usage(rng, usage))
+    for index in range(pending):
+        vm_id += 1
+        cluster.add_vm(vm_id, cluster_id + index % clusters, rng.choice(vm_cores) * 100,
+                       rng.choice(vm_mem_gb) * 1024 * 1024,
+                       cpu_usage=draw_usage(rng, usage), mem_usage=draw_usage(rng, usage))
+    return cluster
+
+
+class FakeHandler:
+    """Common part of fake handlers: latency injection and call counters.
+
+    Args:
+        latency: seconds added to every call or {method: seconds}, key
+            'default' is used for methods which are not listed
+        jitter: relative random deviation of latency (0.1 = +-10%)
+    """
+
+    def __init__(self, cluster, latency=0, jitter=0, seed=0):
+        self.cluster = cluster
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.calls = {}
+        self.calls_lock = threading.Lock()
+
+    def _call(self, method):
+        with self.calls_lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            delay = self.latency.get(method, self.latency.get('default', 0)) if isinstance(self.latency, dict) else self.latency
+            if delay and self.jitter:
+                delay *= 1 + self.rng.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            self.cluster.clock.sleep(delay)
+        self.cluster.update()
+
+
+class FakeCloud(FakeHandler):
+    """Stand-in of the cloud handler."""
+
+    def get_pending_unscheduled(self):
+        self._call('get_pending_unscheduled')
+        with self.cluster.lock:
+            return [dict(vm) for vm in self.cluster.vms.values() if vm['state'] == 'PENDING']
+
+    def get_hosts_of_cluster(self, cluster_id):
+        self._call('get_hosts_of_cluster')
+        cluster_ids = cluster_id if isinstance(cluster_id, list) else [cluster_id]
+        cluster_ids = [int(x) for x in cluster_ids]
+        with self.cluster.lock:
+            return [copy_host(host) for host in self.cluster.hosts.values() if host['cluster_id'] in cluster_ids]
+
+    def get_host_repr(self, host_id):
+        self._call('get_host_repr')
+        with self.cluster.lock:
+            return copy_host(self.cluster.hosts[int(host_id)])
+
+    def get_vm_repr(self, vm_id):
+        self._call('get_vm_repr')
+        with self.cluster.lock:
+            return dict(self.cluster.vms[int(vm_id)])
+
+    def get_vms_repr(self, startId=-1, endId=-1, vmStateFilter=-1):
+        """VMs with ids in [startId, endId], -1 means no bound.
+
+        vmStateFilter: -2 all VMs, -1 all except DONE, other values are not supported
+        """
+        self._call('get_vms_repr')
+        vms = []
+        with self.cluster.lock:
+            for vm_id, vm in self.cluster.vms.items():
+                if startId >= 0 and vm_id < startId:
+                    continue
+                if endId >= 0 and vm_id > endId:
+                    continue
+                if vmStateFilter == -1 and vm['state'] == 'DONE':
+                    continue
+                vms.append(dict(vm))
+        return vms
+
+    def deploy(self, vm_id, host_id, enforce):
+        self._call('deploy')
+        return self.cluster.deploy(int(vm_id), int(host_id))
+
+    def migrate(self, vm_id, host_id, live, enforce):
+        self._call('migrate')
+        return self.cluster.migrate(int(vm_id), int(host_id))
+
+
+class FakeMonitoring(FakeHandler):
+    """Stand-in of the monitoring handler.
+
+    Usage of VMs is taken from the cluster with small random noise, host
+    metrics are calculated from VMs running on the host.
+    """
+
+    def __init__(self, cluster, latency=0, jitter=0, seed=0, noise=0.05):
+        FakeHandler.__init__(self, cluster, latency, jitter, seed)
+        self.noise = noise
+
+    def get_host_load(self, host_name, metric, period='5m', group_by='10m', aggregation='max'):
+        self._call('get_host_load')
+        with self.cluster.lock:
+            host = self.cluster.host_names.get(host_name)
+            if host is None:
+                return {}
+            values = {'host_cpu_load': 100.0 * host['usage_cpu']['used'] / host['usage_cpu']['max'],
+                      'host_mem_used_percent': 100.0 * host['usage_mem']['used'] / host['usage_mem']['max'],
+                      'host_cpu_count': host['usage_cpu']['max'] / 100,
+                      'host_mem_total_bytes': host['usage_mem']['max'] * 1024}
+        return {self.cluster.clock.utcnow().strftime(TIME_FORMAT): values[metric]}
+
+    def get_ovz_vm(self, vm_id, fields, limit=60):
+        """One probe per minute for the last limit minutes (not earlier than VM start)."""
+        self._call('get_ovz_vm')
+        with self.cluster.lock:
+            vm = self.cluster.vms.get(int(vm_id))
+            if vm is None or vm['lcm_state'] != 'RUNNING':
+                return []
+            usage = dict(self.cluster.usage[vm['id']])
+            cores = vm['cpu_allocated'] / 100.0
+            start = vm['rstime']
+        rng = random.Random(vm['id'])
+        now = self.cluster.clock.utcnow().replace(second=0, microsecond=0)
+        rows = []
+        for minute in range(limit):
+            probe_time = now - datetime.timedelta(minutes=minute)
+            if probe_time < start:
+                break
+            cpu = min(1.0, max(0.0, usage['cpu'] + rng.uniform(-self.noise, self.noise)))
+            mem = min(1.0, max(0.0, usage['mem'] + rng.uniform(-self.noise, self.noise)))
+            rows.append({'time': probe_time.strftime(TIME_FORMAT),
+                         'cpu': cpu * cores * 100,
+                         'mem': mem * 100,
+                         'num': cores})
+        return rows
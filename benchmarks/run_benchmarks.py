@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of strategies on synthetic clusters.
+
+Every strategy makes one perform_strategy call against the fake cloud and
+monitoring handlers (benchmarks/fake_backend.py) for every scale. Wall
+time, RPC counts, phase durations and peak memory (tracemalloc, measured in
+a separate run) are reported and can be saved and compared with a previous
+run:
+
+    python3 benchmarks/run_benchmarks.py --scales 100,1000,10000 --output before.json
+    python3 benchmarks/run_benchmarks.py --scales 100,1000,10000 --compare before.json
+
+The exit code is 1 if wall time or peak memory of any benchmark is worse
+than in the compared run by more than --threshold.
+"""
+import argparse
+import datetime
+import importlib.machinery
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import smartsched.common as common
+import smartsched.daemon.clock as clocks
+import smartsched.daemon.metrics as metrics
+
+import fake_backend
+
+STRATEGIES_DIR = os.path.join(os.path.dirname(HERE), 'strategy_examples')
+CLUSTER_ID = 108
+
+STRATEGIES = {
+    'place_pending': {
+        'path': os.path.join(STRATEGIES_DIR, 'PlacePendingStrategy.py'),
+        'config': {'sleep_time': '60',
+                   'cpu_max_ovc': '3',
+                   'mem_max_ovc': '2',
+                   'cpu_max_usage': '50',
+                   'mem_max_usage': '30',
+                   'fresh_vm_timeframe': '5',
+                   'deploy_waiting_time': '600',
+                   'max_parallel_deploys': '4'}},
+    'ranked': {
+        'path': os.path.join(STRATEGIES_DIR, 'RankedStrategy.py'),
+        'config': {'sleep_time': '3700',
+                   'min_lifetime': '3600',
+                   'psquare': '0.1',
+                   'max_parallel_queries': '16',
+                   'cpu_max_ovc_0': '3',
+                   'mem_max_ovc_0': '2',
+                   'cpu_max_usage_0': '0.8',
+                   'mem_max_usage_0': '0.8',
+                   'cpu_max_ovc_1': '1',
+                   'mem_max_ovc_1': '1',
+                   'cpu_max_usage_1': '1',
+                   'mem_max_usage_1': '1'}},
+}
+
+
+def load_strategy(name):
+    module = importlib.machinery.SourceFileLoader('benchmark_' + name, STRATEGIES[name]['path']).load_module()
+    return module.target_class
+
+
+def create_cluster(args, vms):
+    hosts = max(1, vms // args.vms_per_host)
+    return fake_backend.generate_cluster(hosts=hosts, vms_per_host=args.vms_per_host,
+                                         pending=max(1, int(vms * args.pending_ratio)),
+                                         cluster_id=CLUSTER_ID, usage=args.usage, fresh_ratio=args.fresh_ratio,
+                                         seed=args.seed, clusters=args.clusters)
+
+
+def run_cycle(args, name, vms, trace_memory=False):
+    """Run one perform_strategy on a fresh cluster.
+
+    Returns:
+        (seconds, strategy metrics snapshot, peak memory in bytes or None)
+    """
+    cluster = create_cluster(args, vms)
+    latency = {'default': args.cloud_latency}
+    common.get_cloud_handler = lambda: fake_backend.FakeCloud(cluster, latency, args.jitter)
+    common.get_monitoring_handler = lambda: fake_backend.FakeMonitoring(cluster, args.monitoring_latency,
+                                                                        args.jitter)
+
+    config = dict(STRATEGIES[name]['config'])
+    config.update({'name': name,
+                   'cluster_list': ','.join(str(CLUSTER_ID + x) for x in range(args.clusters)),
+                   'log_filename': args.log_filename,
+                   'log_name': 'benchmark.' + name,
+                   'log_level': 'WARNING'})
+    # Strategies redirect stdout and stderr into their logs
+    stdout, stderr = sys.stdout, sys.stderr
+    strategy_class = load_strategy(name)
+    # Waiting inside the cycle (e.g. polling of migrations) takes no real time,
+    # latency of fake handlers is still real
+    strategy_class.clock = clocks.VirtualClock(time.time())
+    try:
+        strategy = strategy_class(config)
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+    peak = None
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    strategy.perform_strategy()
+    duration = time.perf_counter() - start
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    for handler in list(strategy.logger.handlers):
+        strategy.logger.removeHandler(handler)
+        handler.close()
+    return duration, strategy.metrics.snapshot(), peak
+
+
+def summarize_metrics(snapshot):
+    """RPC counts and phase durations from metrics of the strategy."""
+    rpc = {}
+    phases = {}
+    for (name, labels), histogram in snapshot['histograms'].items():
+        labels = dict(labels)
+        if name == metrics.RPC_DURATION:
+            rpc[labels['handler'] + '.' + labels['method']] = histogram['count']
+        elif name == metrics.PHASE_DURATION:
+            phases[labels['phase']] = round(histogram['sum'], 6)
+    return rpc, phases
+
+
+def run_benchmark(args, name, vms):
+    durations = []
+    snapshot = None
+    for _ in range(args.repeat):
+        duration, snapshot, _ = run_cycle(args, name, vms)
+        durations.append(duration)
+    peak = None
+    if not args.no_memory:
+        _, _, peak = run_cycle(args, name, vms, trace_memory=True)
+    rpc, phases = summarize_metrics(snapshot)
+    return {'strategy': name,
+            'vms': vms,
+            'hosts': max(1, vms // args.vms_per_host),
+            'wall_time': {'min': round(min(durations), 6),
+                          'median': round(statistics.median(durations), 6),
+                          'runs': len(durations)},
+            'phases': phases,
+            'rpc': rpc,
+            'rpc_total': sum(rpc.values()),
+            'peak_memory': peak}
+
+
+def print_result(result):
+    peak = '-' if result['peak_memory'] is None else '{0:.1f} MiB'.format(result['peak_memory'] / 1024 ** 2)
+    print('{0:<14} {1:>7} VMs {2:>6} hosts  {3:>9.3f} s  {4:>7} RPC  peak {5}'.format(
+        result['strategy'], result['vms'], result['hosts'], result['wall_time']['median'], result['rpc_total'], peak))
+    for phase, duration in sorted(result['phases'].items(), key=lambda x: -x[1]):
+        print('    {0:<28} {1:>9.3f} s'.format(phase, duration))
+    for call, count in sorted(result['rpc'].items()):
+        print('    {0:<28} {1:>9}'.format(call, count))
+
+
+def compare(results, baseline, threshold):
+    """Print changes against the baseline run.
+
+    Returns:
+        list of regressions
+    """
+    previous = {(x['strategy'], x['vms']): x for x in baseline['results']}
+    regressions = []
+    print('\nComparison with ' + baseline['meta']['date'] + ':')
+    for result in results:
+        key = (result['strategy'], result['vms'])
+        if key not in previous:
+            print('{0:<14} {1:>7} VMs  no baseline'.format(*key))
+            continue
+        old = previous[key]
+        changes = []
+        time_ratio = result['wall_time']['median'] / max(old['wall_time']['median'], 1e-9)
+        changes.append('time x{0:.2f}'.format(time_ratio))
+        if time_ratio > 1 + threshold:
+            regressions.append(key + ('wall_time', ))
+        if result['peak_memory'] is not None and old['peak_memory'] is not None:
+            memory_ratio = result['peak_memory'] / max(old['peak_memory'], 1)
+            changes.append('memory x{0:.2f}'.format(memory_ratio))
+            if memory_ratio > 1 + threshold:
+                regressions.append(key + ('peak_memory', ))
+        changes.append('RPC {0} -> {1}'.format(old['rpc_total'], result['rpc_total']))
+        print('{0:<14} {1:>7} VMs  '.format(*key) + ', '.join(changes))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', default='100,1000,10000,100000',
+                        help='comma-separated amounts of running VMs')
+    parser.add_argument('--strategies', default=','.join(sorted(STRATEGIES)))
+    parser.add_argument('--vms-per-host', type=int, default=20)
+    parser.add_argument('--clusters', type=int, default=1, help='hosts are spread over this amount of clusters')
+    parser.add_argument('--pending-ratio', type=float, default=0.01,
+                        help='amount of pending VMs relative to running ones')
+    parser.add_argument('--usage', default='bimodal', choices=fake_backend.USAGE_DISTRIBUTIONS)
+    # VMs younger than min_lifetime have no usage statistics, RankedStrategy counts their whole allocation
+    parser.add_argument('--fresh-ratio', type=float, default=0.0,
+                        help='part of VMs started during the last hour')
+    parser.add_argument('--cloud-latency', type=float, default=0.0, help='seconds per cloud call')
+    parser.add_argument('--monitoring-latency', type=float, default=0.0, help='seconds per monitoring call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='relative random deviation of latency')
+    parser.add_argument('--repeat', type=int, default=1, help='timed runs per benchmark')
+    parser.add_argument('--no-memory', action='store_true', help='skip the run with tracemalloc')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--log-filename', default=os.devnull, help='log file of strategies')
+    parser.add_argument('--output', help='save results to JSON file')
+    parser.add_argument('--compare', help='JSON file of a previous run')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed relative regression')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = []
+    for vms in [int(x) for x in args.scales.split(',')]:
+        for name in args.strategies.split(','):
+            result = run_benchmark(args, name, vms)
+            print_result(result)
+            results.append(result)
+
+    report = {'meta': {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                       'python': platform.python_version(),
+                       'machine': platform.node(),
+                       'args': vars(args)},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+        print('Results are saved to ' + args.output)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        if regressions:
+            print('Regressions: ' + ', '.join('{0} {1} VMs {2}'.format(*x) for x in regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+"""
+Module for replaying recorded traces against strategies in virtual time.
+
+The strategy (target_class of a strategy script) runs its usual run() loop
+with a virtual clock, so waiting between cycles takes no real time. Cloud
+and monitoring handlers are replaced by fake_backend working on an
+in-memory model of the cluster. The model is initialized from the first
+frame of the trace. Later frames bring new VMs, terminated VMs and changes
+of VM usage, while deploys and migrations of the strategy are applied to
+the model only.
+
+Usage:
+    python3 benchmarks/simulator.py replay --trace week.trace \\
+        --config /etc/smartscheduler/config.cfg --strategy ranked_strategy --set psquare=0.2
+    python3 benchmarks/simulator.py generate --trace synthetic.trace --days 7
+"""
+import argparse
+import configparser
+import importlib.machinery
+import json
+import math
+import os
+import random
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import smartsched.common as common
+import smartsched.daemon.clock as clocks
+import smartsched.daemon.metrics as metrics
+import smartsched.daemon.trace as trace
+
+import fake_backend
+
+# New VMs of the trace are pending for the strategy or placed where the trace says
+NEW_VMS_MODES = ['pending', 'trace']
+TERMINATED_STATES = ['DONE']
+
+
+def get_percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(percent / 100.0 * len(values))) - 1)]
+
+
+class Simulator:
+    """Replays the trace for one strategy.
+
+    Args:
+        strategy_class: subclass of BaseStrategy
+        config: config dict of the strategy
+        trace_path: trace recorded by snapshot provider (see trace)
+        new_vms: 'pending' - VMs which appear in the trace are pending and
+            placed by the strategy, 'trace' - they are started on hosts from
+            the trace (for strategies which do not deploy VMs)
+        deploy_time, migration_time: seconds till deployed or migrated VM is RUNNING
+        cloud_latency, monitoring_latency: virtual seconds per call
+    """
+
+    def __init__(self, strategy_class, config, trace_path, new_vms='pending', deploy_time=60, migration_time=120,
+                 cloud_latency=0, monitoring_latency=0):
+        if new_vms not in NEW_VMS_MODES:
+            raise ValueError('Unknown new_vms mode ' + new_vms + ', expected one of ' + ', '.join(NEW_VMS_MODES))
+        self.strategy_class = strategy_class
+        self.config = config
+        self.trace_path = trace_path
+        self.new_vms = new_vms
+        self.deploy_time = deploy_time
+        self.migration_time = migration_time
+        self.cloud_latency = cloud_latency
+        self.monitoring_latency = monitoring_latency
+
+        self.clock = None
+        self.cluster = None
+        self.strategy = None
+        self.frames = None
+        self.frame_count = 0
+        self.start_time = None
+        self.end_time = None
+        # {vm_id: virtual time when VM became pending}
+        self.pending_since = {}
+        self.removed_pending = 0
+        # (active hosts, mean CPU allocation ratio, mean MEM allocation ratio) after every frame
+        self.packing = []
+
+    def run(self):
+        """Replay the whole trace.
+
+        Returns:
+            report dict, see get_report
+        """
+        self.frames = iter(trace.TraceReader(self.trace_path))
+        first_frame = next(self.frames, None)
+        if first_frame is None:
+            raise trace.TraceError('Trace ' + self.trace_path + ' has no frames')
+        self.start_time = first_frame['time']
+        self.clock = clocks.VirtualClock(self.start_time)
+        self.cluster = fake_backend.FakeCluster(self.clock, self.deploy_time, self.migration_time)
+        self.apply_frame(first_frame, initial=True)
+
+        saved_handlers = (common.get_cloud_handler, common.get_monitoring_handler)
+        saved_clock = self.strategy_class.clock
+        saved_streams = (sys.stdout, sys.stderr)
+        common.get_cloud_handler = lambda: fake_backend.FakeCloud(self.cluster, self.cloud_latency)
+        common.get_monitoring_handler = lambda: fake_backend.FakeMonitoring(self.cluster, self.monitoring_latency)
+        self.strategy_class.clock = self.clock
+        wall_start = time.perf_counter()
+        try:
+            self.strategy = self.strategy_class(self.config)
+            self.schedule_next_frame()
+            self.strategy.run()
+            # Deploys and migrations which are finished by now but not seen by any call yet
+            self.cluster.update()
+        finally:
+            common.get_cloud_handler, common.get_monitoring_handler = saved_handlers
+            self.strategy_class.clock = saved_clock
+            sys.stdout, sys.stderr = saved_streams
+        return self.get_report(time.perf_counter() - wall_start)
+
+    def schedule_next_frame(self):
+        frame = next(self.frames, None)
+        if frame is None:
+            self.end_time = self.clock.time()
+            self.strategy.shutdown = True
+            return
+        self.clock.call_at(frame['time'], lambda: self.on_frame(frame))
+
+    def on_frame(self, frame):
+        self.apply_frame(frame)
+        self.schedule_next_frame()
+
+    def apply_frame(self, frame, initial=False):
+        self.frame_count += 1
+        for cluster_id, hosts in frame['hosts'].items():
+            for host in hosts:
+                if host['id'] not in self.cluster.hosts:
+                    self.cluster.add_host(host['id'], cluster_id, host['usage_cpu']['max'], host['usage_mem']['max'],
+                                          host['name'], host.get('im_mad', 'im_ovz'))
+
+        if frame['key_frame']:
+            changed = list(frame['vms'])
+            removed = [vm_id for vm_id in self.cluster.vms if vm_id not in frame['vms']]
+        else:
+            changed, removed = frame['changes']['vms']
+        for vm_id in changed:
+            self.apply_vm(frame['vms'][vm_id], frame['vm_usage'].get(vm_id), initial)
+        for vm_id in removed:
+            self.remove_vm(vm_id)
+
+        for vm_id in frame['changes']['vm_usage'][0]:
+            vm = self.cluster.vms.get(vm_id)
+            if vm is not None and vm['state'] not in TERMINATED_STATES:
+                usage = frame['vm_usage'][vm_id]
+                self.cluster.set_usage(vm_id, usage['cpu'], usage['mem'])
+        self.sample_packing()
+
+    def apply_vm(self, traced_vm, usage, initial):
+        vm_id = traced_vm['id']
+        if vm_id in self.cluster.vms:
+            # Placement is decided by the strategy, only termination is taken from the trace
+            if traced_vm['state'] in TERMINATED_STATES:
+                self.remove_vm(vm_id)
+            return
+        if traced_vm['state'] in TERMINATED_STATES:
+            return
+
+        host_id = None
+        start_time = None
+        running = traced_vm['state'] != 'PENDING' and traced_vm['hid'] in self.cluster.hosts
+        if running and (initial or self.new_vms == 'trace'):
+            host_id = traced_vm['hid']
+            start_time = traced_vm['rstime'] if initial else self.clock.utcnow()
+        if usage is None:
+            usage = {'cpu': 0.0, 'mem': 0.0}
+        cluster_ids = traced_vm.get('cluster_id') or [self.cluster.hosts[next(iter(self.cluster.hosts))]['cluster_id']]
+        vm = self.cluster.add_vm(vm_id, cluster_ids[0], traced_vm['cpu_allocated'], traced_vm['mem_allocated'],
+                                 host_id, start_time, usage['cpu'], usage['mem'])
+        vm['cluster_id'] = list(cluster_ids)
+        for field in ['cpu_req', 'mem_req']:
+            if field in traced_vm:
+                vm[field] = traced_vm[field]
+        if host_id is None:
+            self.pending_since[vm_id] = self.clock.time()
+
+    def remove_vm(self, vm_id):
+        vm = self.cluster.vms.get(vm_id)
+        if vm is None or vm['state'] in TERMINATED_STATES:
+            return
+        if vm['state'] == 'PENDING':
+            self.removed_pending += 1
+        self.cluster.remove_vm(vm_id)
+
+    def sample_packing(self):
+        active_hosts = [host for host in self.cluster.hosts.values() if host['vms']]
+        if not active_hosts:
+            self.packing.append((0, 0.0, 0.0))
+            return
+        self.packing.append((len(active_hosts),
+                             sum(host['usage_cpu']['ratio_overc'] for host in active_hosts) / len(active_hosts),
+                             sum(host['usage_mem']['ratio_overc'] for host in active_hosts) / len(active_hosts)))
+
+    def get_report(self, wall_seconds):
+        """Results of the replay.
+
+        Returns:
+            {'strategy', 'trace', 'frames', 'cycles', 'simulated_seconds', 'wall_seconds', 'speedup',
+             'migrations', 'deploys', 'deploys_not_running', 'pending_at_end', 'pending_removed',
+             'deploy_latency': {'count', 'mean', 'p50', 'p95', 'max'},
+
+        Deploy latency is measured from the time VM became pending till the
+        time the fake cloud reports it RUNNING. Deploys which did not bring the
+        VM to RUNNING (it was terminated or the replay ended first) are
+        counted in deploys_not_running.
+             'packing': {'hosts', 'active_hosts_avg', 'cpu_allocation_avg', 'mem_allocation_avg', 'final'},
+             'rpc': {handler.method: count}}
+        """
+        latencies = []
+        migrations = 0
+        not_running = 0
+        for action in self.cluster.history:
+            if action['action'] == 'migrate':
+                migrations += 1
+            elif action['running'] is None:
+                not_running += 1
+            elif action['vm'] in self.pending_since:
+                latencies.append(action['running'] - self.pending_since[action['vm']])
+
+        snapshot = self.strategy.metrics.snapshot()
+        cycles = 0
+        rpc = {}
+        for (name, labels), histogram in snapshot['histograms'].items():
+            labels = dict(labels)
+            if name == metrics.CYCLE_DURATION:
+                cycles = histogram['count']
+            elif name == metrics.RPC_DURATION:
+                rpc[labels['handler'] + '.' + labels['method']] = histogram['count']
+
+        simulated_seconds = self.end_time - self.start_time
+        final = self.packing[-1]
+        return {'strategy': self.strategy_class.__name__,
+                'trace': self.trace_path,
+                'frames': self.frame_count,
+                'cycles': cycles,
+                'simulated_seconds': simulated_seconds,
+                'wall_seconds': round(wall_seconds, 3),
+                'speedup': round(simulated_seconds / max(wall_seconds, 1e-9), 1),
+                'migrations': migrations,
+                'deploys': len(latencies),
+                'deploys_not_running': not_running,
+                'pending_at_end': sum(1 for vm in self.cluster.vms.values() if vm['state'] == 'PENDING'),
+                'pending_removed': self.removed_pending,
+                'deploy_latency': {'count': len(latencies),
+                                   'mean': sum(latencies) / len(latencies) if latencies else None,
+                                   'p50': get_percentile(latencies, 50),
+                                   'p95': get_percentile(latencies, 95),
+                                   'max': max(latencies) if latencies else None},
+                'packing': {'hosts': len(self.cluster.hosts),
+                            'active_hosts_avg': sum(x[0] for x in self.packing) / len(self.packing),
+                            'cpu_allocation_avg': sum(x[1] for x in self.packing) / len(self.packing),
+                            'mem_allocation_avg': sum(x[2] for x in self.packing) / len(self.packing),
+                            'final': {'active_hosts': final[0],
+                                      'cpu_allocation': final[1],
+                                      'mem_allocation': final[2]}},
+                'rpc': rpc}
+
+
+def generate_trace(path, hosts=20, vms_per_host=10, days=7, interval=60, arrivals_per_hour=4,
+                   mean_lifetime_hours=48, usage_changes_per_hour=0.05, usage='bimodal', cluster_id=108, seed=0,
+                   start=None):
+    """Write a synthetic trace: VMs arrive, get random hosts, change usage and terminate.
+
+    Returns:
+        amount of written frames
+    """
+    rng = random.Random(seed)
+    clock = clocks.VirtualClock(start if start is not None else time.time() - days * 86400)
+    cluster = fake_backend.generate_cluster(hosts, vms_per_host, 0, cluster_id, usage=usage, fresh_ratio=0, seed=seed,
+                                           clock=clock)
+    writer = trace.TraceWriter(path)
+    next_vm_id = max(cluster.vms) + 1 if cluster.vms else 1
+    frames = int(days * 86400 / interval)
+    for _ in range(frames):
+        for _ in range(_poisson(rng, arrivals_per_hour * interval / 3600.0)):
+            vm = cluster.add_vm(next_vm_id, cluster_id, rng.choice([1, 2, 4]) * 100, rng.choice([1, 2, 4, 8]) * 1024 ** 2,
+                                cpu_usage=fake_backend.draw_usage(rng, usage),
+                                mem_usage=fake_backend.draw_usage(rng, usage))
+            cluster.deploy(vm['id'], rng.choice(list(cluster.hosts)))
+            next_vm_id += 1
+        for vm in list(cluster.vms.values()):
+            if vm['state'] in TERMINATED_STATES:
+                continue
+            if rng.random() < interval / (mean_lifetime_hours * 3600.0):
+                cluster.remove_vm(vm['id'])
+            elif rng.random() < usage_changes_per_hour * interval / 3600.0:
+                cluster.set_usage(vm['id'], fake_backend.draw_usage(rng, usage), fake_backend.draw_usage(rng, usage))
+        cluster.update()
+
+        vm_usage = {}
+        for vm_id, vm in cluster.vms.items():
+            if vm['state'] not in TERMINATED_STATES:
+                vm_usage[vm_id] = dict(cluster.usage[vm_id])
+        writer.write({'time': clock.time(),
+                      'hosts': {cluster_id: [fake_backend.copy_host(host) for host in cluster.hosts.values()]},
+                      'vms': [dict(vm) for vm in cluster.vms.values() if vm['state'] not in TERMINATED_STATES],
+                      'host_metrics': {}},
+                     vm_usage)
+        clock.advance(clock.time() + interval)
+    writer.close()
+    return frames
+
+
+def _poisson(rng, mean):
+    # Knuth's algorithm is enough for small means
+    limit = math.exp(-mean)
+    count = 0
+    product = rng.random()
+    while product > limit:
+        count += 1
+        product *= rng.random()
+    return count
+
+
+def load_strategy_config(config_path, section, overrides, log_filename):
+    parser = configparser.RawConfigParser()
+    if not parser.read(config_path):
+        raise IOError('Config ' + config_path + ' is not found')
+    config = dict(parser.items(section))
+    config['name'] = section
+    # Shared snapshot of the running daemon must not be used in simulation
+    config.pop('snapshot_path', None)
+    for override in overrides:
+        key, value = override.split('=', 1)
+        config[key.strip()] = value.strip()
+    config['log_filename'] = log_filename
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay cluster traces against strategies in virtual time')
+    subparsers = parser.add_subparsers(dest='command')
+
+    replay = subparsers.add_parser('replay', help='run the strategy against the trace')
+    replay.add_argument('--trace', required=True)
+    replay.add_argument('--config', default='/etc/smartscheduler/config.cfg')
+    replay.add_argument('--strategy', required=True, help='section of the strategy in the config')
+    replay.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='override parameter of the strategy, can be repeated')
+    replay.add_argument('--new-vms', choices=NEW_VMS_MODES, default='pending')
+    replay.add_argument('--deploy-time', type=float, default=60)
+    replay.add_argument('--migration-time', type=float, default=120)
+    replay.add_argument('--cloud-latency', type=float, default=0)
+    replay.add_argument('--monitoring-latency', type=float, default=0)
+    replay.add_argument('--log-filename', default=os.devnull)
+    replay.add_argument('--output', help='save report to JSON file')
+
+    generate = subparsers.add_parser('generate', help='write a synthetic trace')
+    generate.add_argument('--trace', required=True)
+    generate.add_argument('--hosts', type=int, default=20)
+    generate.add_argument('--vms-per-host', type=int, default=10)
+    generate.add_argument('--days', type=float, default=7)
+    generate.add_argument('--interval', type=int, default=60)
+    generate.add_argument('--arrivals-per-hour', type=float, default=4)
+    generate.add_argument('--mean-lifetime-hours', type=float, default=48)
+    generate.add_argument('--usage', choices=fake_backend.USAGE_DISTRIBUTIONS, default='bimodal')
+    generate.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+    if args.command == 'generate':
+        frames = generate_trace(args.trace, args.hosts, args.vms_per_host, args.days, args.interval,
+                                args.arrivals_per_hour, args.mean_lifetime_hours, usage=args.usage, seed=args.seed)
+        print(str(frames) + ' frames are written to ' + args.trace)
+    elif args.command == 'replay':
+        config = load_strategy_config(args.config, args.strategy, args.set, args.log_filename)
+        module = importlib.machinery.SourceFileLoader(args.strategy, config['strategy_path']).load_module()
+        simulator = Simulator(module.target_class, config, args.trace, args.new_vms, args.deploy_time,
+                              args.migration_time, args.cloud_latency, args.monitoring_latency)
+        report = simulator.run()
+        print(json.dumps(report, indent=2, sort_keys=True))
+        if args.output:
+            with open(args.output, 'w') as output_file:
+                json.dump(report, output_file, indent=2, sort_keys=True)
+    else:
+        parser.print_help()
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
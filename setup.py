@@ -9,7 +9,8 @@ with open(path.join(here, 'README.MD'), encoding='utf-8') as f:
     long_description = f.read()
 
 requirements = [
-    "smartsched"
+    "smartsched",
+    "numpy>=1.20"
 ]
 
 setup(name='smartsched.daemon',
@@ -19,7 +20,7 @@ setup(name='smartsched.daemon',
       author='JINR LIT Cloud Team',
       author_email='gavelock+jinr@gmail.com',
       url='https://github.com/JINR-LIT/SmartScheduler-Core',
-      python_requires='~=3.4',
+      python_requires='>=3.9',
 
       classifiers=[
           'Development Status :: 3 - Alpha',
@@ -28,9 +29,10 @@ setup(name='smartsched.daemon',
           'Topic :: Software Development',
 
           'Programming Language :: Python :: 3',
-          'Programming Language :: Python :: 3.3',
-          'Programming Language :: Python :: 3.4',
-          'Programming Language :: Python :: 3.5',
+          'Programming Language :: Python :: 3.9',
+          'Programming Language :: Python :: 3.10',
+          'Programming Language :: Python :: 3.11',
+          'Programming Language :: Python :: 3.12',
       ],
 
       keywords='cloud api scheduler',
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Module for strategies based on asyncio.
+
+AsyncBaseStrategy runs an event loop in the strategy process. Its
+perform_strategy is a coroutine, so queries inside one cycle can overlap:
+synchronous cloud and monitoring handlers are called in a pool of threads
+by run_blocking and map_blocking. Signals are handled by the loop.
+"""
+import asyncio
+import functools
+import signal
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import base_strategy
+from . import metrics
+from . import parallel
+
+
+class AsyncBaseStrategy(base_strategy.BaseStrategy):
+    """Base class of strategies with async perform_strategy.
+
+    SmartDaemon loads it through target_class as any other strategy. The
+    schedule is the same as in BaseStrategy.run (sleep_time, adaptive
+    interval, SIGUSR1 wake up), SIGINT and SIGTERM stop the loop after the
+    current cycle, coroutines waiting in sleep are woken up at once.
+
+    Blocking handlers are called in an executor of executor_threads
+    threads (config, default 8). Run by shared_pool.SharedPool the strategy
+    gets its own loop which runs one cycle per perform_cycle call.
+
+    Usage:
+        class MyStrategy(async_strategy.AsyncBaseStrategy):
+            async def perform_strategy(self):
+                hosts = await self.run_blocking(self.cloud.get_hosts_of_cluster, cluster_id)
+                loads = await self.map_blocking(self.monitoring.get_host_load,
+                                                [(host['name'], 'host_cpu_load') for host in hosts])
+
+        target_class = MyStrategy
+    """
+
+    loop = None
+    wakeup_event = None
+
+    def __init__(self, config_dict):
+        base_strategy.BaseStrategy.__init__(self, config_dict)
+        self.executor_threads = int(self.config.get('executor_threads', 8))
+        self.executor = ThreadPoolExecutor(max_workers=self.executor_threads)
+
+    def wake_up(self):
+        """Start next cycle immediately. Safe to call from signal handlers and other threads."""
+        if self.loop is None or self.loop.is_closed():
+            base_strategy.BaseStrategy.wake_up(self)
+            return
+        self.loop.call_soon_threadsafe(self.set_wakeup_event)
+
+    def set_wakeup_event(self):
+        if self.wakeup_event is not None:
+            self.wakeup_event.set()
+
+    def get_loop(self):
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+        return self.loop
+
+    async def sleep(self, timeout):
+        """Sleep for timeout seconds or until wake_up or shutdown, the loop is not blocked.
+
+        Returns:
+            True if the strategy was woken up before timeout
+        """
+        if self.clock.is_virtual:
+            if not self.shutdown:
+                self.clock.sleep(timeout)
+            return False
+        if self.wakeup_event is None:
+            self.wakeup_event = asyncio.Event()
+        if not self.shutdown and timeout > 0 and not self.wakeup_event.is_set():
+            try:
+                await asyncio.wait_for(self.wakeup_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        woken = self.wakeup_event.is_set()
+        self.wakeup_event.clear()
+        return woken and not self.shutdown
+
+    async def run_blocking(self, function, *args, **kwargs):
+        """Call blocking function (e.g. cloud or monitoring handler) in the executor.
+
+        CPU time of the call is added to the current parallel.CpuAccount, if any.
+        """
+        return await self.get_loop().run_in_executor(
+            self.executor, parallel.charged(functools.partial(function, *args, **kwargs)))
+
+    async def map_blocking(self, function, args_list, max_parallel=None):
+        """Async counterpart of parallel.map_parallel.
+
+        At most max_parallel (default executor_threads) calls are executed at
+        the same time, exception raised by one call does not affect the others.
+
+        Returns:
+            [(result, error), ...] in the same order as args_list
+        """
+        semaphore = asyncio.Semaphore(max_parallel or self.executor_threads)
+
+        async def call(args):
+            async with semaphore:
+                try:
+                    return await self.run_blocking(function, *args), None
+                except Exception as err:
+                    return None, err
+
+        return await asyncio.gather(*[call(args) for args in args_list])
+
+    async def perform_cycle_async(self):
+        """Await perform_strategy with the same bookkeeping as BaseStrategy.perform_cycle."""
+        if self.wakeup_event is None:
+            self.wakeup_event = asyncio.Event()
+        start, profiler = self.begin_cycle()
+        try:
+            work_pending = await self.perform_strategy()
+            self.save_checkpoint()
+            return work_pending
+        except Exception:
+            self.metrics.increment(metrics.CYCLE_ERRORS)
+            raise
+        finally:
+            self.end_cycle(start, profiler)
+
+    def perform_cycle(self):
+        """Run one cycle in the loop of the strategy, used by shared_pool.SharedPool."""
+        return self.get_loop().run_until_complete(self.perform_cycle_async())
+
+    async def main(self):
+        if not self.managed:
+            # Handlers are called by the loop, not in the middle of a coroutine
+            loop = self.get_loop()
+            loop.add_signal_handler(signal.SIGINT, self.do_shutdown, signal.SIGINT, None)
+            loop.add_signal_handler(signal.SIGTERM, self.do_shutdown, signal.SIGTERM, None)
+            loop.add_signal_handler(signal.SIGUSR1, self.do_wakeup, signal.SIGUSR1, None)
+            loop.add_signal_handler(signal.SIGUSR2, self.do_profile, signal.SIGUSR2, None)
+        self.restore_checkpoint()
+        interval = self.sleep_time
+        next_run = self.clock.monotonic()
+        while True:
+            work_pending = await self.perform_cycle_async()
+            interval = self.get_next_interval(interval, work_pending)
+            next_run = max(next_run + interval, self.clock.monotonic())
+            if await self.sleep(next_run - self.clock.monotonic()):
+                self.logger.info('Woken up before schedule')
+                next_run = self.clock.monotonic()
+            if self.shutdown:
+                self.logger.info('Initiate shutdown procedure')
+                self.before_shutdown()
+                break
+
+    def run(self):
+        loop = self.get_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.main())
+        finally:
+            self.executor.shutdown(wait=True)
+            loop.close()
+
+    async def perform_strategy(self):
+        """Do one cycle of the strategy, see BaseStrategy.perform_strategy."""
+        pass
@@ -1,10 +1,20 @@
 #!/usr/bin/env python3
 
+import contextlib
 import signal
+import select
 import time
 import logging
+import os
 import sys
 
+from . import checkpoint
+from . import clock as clocks
+from . import cluster_snapshot
+from . import metrics
+from . import profiling
+from . import queue_logging
+
 
 class StreamToLogger(object):
     """
@@ -23,9 +33,15 @@ class StreamToLogger(object):
         for line in self.linebuf.splitlines():
             self.logger.log(self.log_level, line.rstrip())
 
-def create_strategy_runner(strategy, config_dict):
+def create_strategy_runner(strategy, config_dict, heartbeat=None, log_queue=None, metrics_queue=None):
     def run_strategy():
+        if heartbeat is not None:
+            heartbeat.reset()
+        # Logging is configured in constructor, so queue should be known before it
+        strategy.log_queue = log_queue
         runner = strategy(config_dict)
+        runner.heartbeat = heartbeat
+        runner.metrics_queue = metrics_queue
         runner.run()
     return run_strategy
 
@@ -33,41 +49,324 @@ class BaseStrategy:
     isRunning = False
     logger = None
     sleep_time = 10
+    # Bounds for adaptive interval, equal to sleep_time if not configured
+    min_sleep_time = None
+    max_sleep_time = None
     shutdown = False
+    # Heartbeat shared with the master process, see heartbeat.Heartbeat
+    heartbeat = None
+    # If set, records are put into the queue and written by the master, see queue_logging
+    log_queue = None
+    snapshot_reader = None
+    # If set, metrics are sent to the master after every cycle, see metrics.MetricsAggregator
+    metrics_queue = None
+    # Set by SIGUSR2, profiling starts with the next cycle, see profiling.CycleProfiler
+    profile_requested = False
+    profiler = None
+    # Source of current time, see clock. The simulator sets a virtual clock before
+    # the strategy is created, so waiting between cycles takes no real time.
+    clock = None
+    # If set, state of the strategy is saved there after every cycle and restored at startup,
+    # see get_checkpoint_state. Checkpoints of other checkpoint_version are not restored.
+    checkpoint_path = None
+    checkpoint_version = 1
+    # True if the strategy is run by shared_pool.SharedPool together with other strategies:
+    # signals and stdout/stderr of the process are left to the pool
+    managed = False
 
     def __init__(self, config_dict):
         self.config = config_dict
+        self.metrics = metrics.StrategyMetrics()
+        if self.clock is None:
+            self.clock = clocks.SystemClock()
+
+        # Self-pipe is used to interrupt waiting between cycles from signal handlers
+        self.wakeup_pipe = os.pipe()
+        for fd in self.wakeup_pipe:
+            os.set_blocking(fd, False)
 
-        signal.signal(signal.SIGINT, self.do_shutdown)
-        signal.signal(signal.SIGTERM, self.do_shutdown)
+        if not self.managed:
+            signal.signal(signal.SIGINT, self.do_shutdown)
+            signal.signal(signal.SIGTERM, self.do_shutdown)
+            signal.signal(signal.SIGUSR1, self.do_wakeup)
+            signal.signal(signal.SIGUSR2, self.do_profile)
 
         self.sleep_time = int(self.config['sleep_time'])
+        if 'min_sleep_time' in self.config:
+            self.min_sleep_time = int(self.config['min_sleep_time'])
+        if 'max_sleep_time' in self.config:
+            self.max_sleep_time = int(self.config['max_sleep_time'])
+        if self.config.get('checkpoint_path'):
+            self.checkpoint_path = self.config['checkpoint_path']
+        elif self.config.get('checkpoint_dir'):
+            self.checkpoint_path = checkpoint.get_checkpoint_path(self.config['checkpoint_dir'],
+                                                                  self.config.get('name', self.config['log_name']))
 
-        handler = logging.FileHandler(self.config['log_filename'])
         self.logger = logging.getLogger(self.config['log_name'])
         self.logger.setLevel(logging.getLevelName(self.config['log_level']))
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        handler.setFormatter(formatter)
+        if self.log_queue is not None:
+            handler = queue_logging.create_queue_handler(self.log_queue, self.config['log_filename'])
+        else:
+            handler = logging.FileHandler(self.config['log_filename'])
+            formatter = logging.Formatter(queue_logging.FORMAT)
+            handler.setFormatter(formatter)
         self.logger.addHandler(handler)
 
-        sl = StreamToLogger(self.logger, logging.INFO)
-        sys.stdout = sl
+        if not self.managed:
+            sl = StreamToLogger(self.logger, logging.INFO)
+            sys.stdout = sl
 
-        sl = StreamToLogger(self.logger, logging.ERROR)
-        sys.stderr = sl
+            sl = StreamToLogger(self.logger, logging.ERROR)
+            sys.stderr = sl
 
 
     def do_shutdown(self, signalnum, handler):
         if self.logger:
             self.logger.info('Shutdown signar received')
         self.shutdown = True
+        self.wake_up()
+
+    def do_wakeup(self, signalnum, handler):
+        self.wake_up()
+
+    def do_profile(self, signalnum, handler):
+        self.profile_requested = True
+
+    def wake_up(self):
+        """Start next cycle immediately. Safe to call from signal handlers and other threads."""
+        try:
+            os.write(self.wakeup_pipe[1], b'\0')
+        except OSError:
+            # Pipe is full, wake up is already pending
+            pass
+
+    def wait(self, timeout):
+        """Sleep for timeout seconds or until wake_up or shutdown.
+
+        Returns:
+            True if the strategy was woken up before timeout
+        """
+        if self.clock.is_virtual:
+            if not self.shutdown:
+                self.clock.sleep(timeout)
+            return False
+        woken = False
+        if not self.shutdown and timeout > 0:
+            readable, _, _ = select.select([self.wakeup_pipe[0]], [], [], timeout)
+            woken = len(readable) != 0
+        try:
+            while os.read(self.wakeup_pipe[0], 512):
+                woken = True
+        except OSError:
+            pass
+        return woken and not self.shutdown
+
+    def get_next_interval(self, interval, work_pending):
+        """Interval before the next cycle.
+
+        Strategies report pending work by returning True from perform_strategy
+        and idle state by returning False. In the first case the next cycle is
+        started after min_sleep_time, in the second one the interval is doubled
+        up to max_sleep_time. If nothing is returned sleep_time is used.
+        """
+        if work_pending is None:
+            return self.sleep_time
+        min_sleep_time = self.sleep_time if self.min_sleep_time is None else self.min_sleep_time
+        max_sleep_time = self.sleep_time if self.max_sleep_time is None else self.max_sleep_time
+        if work_pending:
+            return min_sleep_time
+        return min(max_sleep_time, max(self.sleep_time, interval * 2))
+
+    def get_cluster_snapshot(self):
+        """Latest cluster snapshot published by the master.
+
+        Returns:
+            snapshot dict (see snapshot_provider.SnapshotProvider) or None if
+            the shared snapshot is disabled, not available or older than
+            snapshot_max_age seconds. In the last case the strategy should
+            query the cloud by itself.
+        """
+        if 'snapshot_path' not in self.config:
+            return None
+        if self.snapshot_reader is None:
+            self.snapshot_reader = cluster_snapshot.SnapshotReader(self.config['snapshot_path'])
+        try:
+            timestamp, snapshot = self.snapshot_reader.read()
+        except cluster_snapshot.SnapshotError as err:
+            self.logger.warning(str(err))
+            return None
+        age = self.clock.time() - timestamp
+        if age > float(self.config.get('snapshot_max_age', 3 * self.sleep_time)):
+            self.logger.warning('Cluster snapshot is too old: {0:.0f} seconds'.format(age))
+            return None
+        return snapshot
+
+    def instrument(self, handler, handler_name):
+        """Wrap cloud or monitoring handler to count calls and measure their latency.
+
+        Usage:
+            self.cloud = self.instrument(common.get_cloud_handler(), 'cloud')
+        """
+        return metrics.InstrumentedHandler(handler, handler_name, self.metrics)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Mark a named phase of the cycle, the master sees it in the heartbeat.
+        Duration of the phase is recorded in metrics.
+
+        Usage:
+            with self.phase('build_deploy_mesh'):
+                self.build_deploy_mesh()
+        """
+        previous = None
+        if self.heartbeat is not None:
+            previous = self.heartbeat.phase()
+            self.heartbeat.set_phase(name)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.metrics.observe(metrics.PHASE_DURATION, (('phase', name), ), time.monotonic() - start)
+            if self.heartbeat is not None:
+                self.heartbeat.set_phase(previous)
 
+    def start_profiling(self):
+        """Profile the next cycles with settings from the request file or the config."""
+        self.profile_requested = False
+        if self.profiler is not None:
+            self.logger.warning('Profiling is already in progress')
+            return
+        name = self.config.get('name', self.config['log_name'])
+        profile_dir = self.config.get('profile_dir', profiling.DEFAULT_DIR)
+        request = profiling.read_request(profile_dir, name)
+        mode = request.get('mode', self.config.get('profile_mode', profiling.DEFAULT_MODE))
+        cycles = int(request.get('cycles', self.config.get('profile_cycles', profiling.DEFAULT_CYCLES)))
+        try:
+            self.profiler = profiling.CycleProfiler(mode, cycles, profile_dir, name, self.logger)
+        except (ValueError, OSError) as err:
+            self.logger.error('Profiling is not started: ' + str(err))
+            return
+        self.logger.info('Profiling of ' + str(cycles) + ' cycles started, mode: ' + mode)
+
+    def perform_cycle(self):
+        """Run perform_strategy, publish cycle start and end in the heartbeat and send metrics."""
+        start, profiler = self.begin_cycle()
+        try:
+            work_pending = self.perform_strategy()
+            self.save_checkpoint()
+            return work_pending
+        except Exception:
+            self.metrics.increment(metrics.CYCLE_ERRORS)
+            raise
+        finally:
+            self.end_cycle(start, profiler)
+
+    def begin_cycle(self):
+        """Start profiling if requested and publish cycle start.
+
+        Returns:
+            (start time, profiler or None) to be passed to end_cycle
+        """
+        if self.profile_requested:
+            self.start_profiling()
+        if self.heartbeat is not None:
+            self.heartbeat.cycle_started()
+        start = time.monotonic()
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.before_cycle()
+        return start, profiler
+
+    def end_cycle(self, start, profiler):
+        """Stop profiling of the cycle, record its duration and publish cycle end."""
+        if profiler is not None:
+            try:
+                profiler.after_cycle()
+            except OSError as err:
+                self.logger.error('Profiling is stopped: ' + str(err))
+                profiler.abort()
+            if profiler.finished:
+                self.profiler = None
+        self.metrics.observe(metrics.CYCLE_DURATION, (), time.monotonic() - start)
+        if self.heartbeat is not None:
+            self.heartbeat.cycle_finished()
+        self.publish_metrics()
+
+    def publish_metrics(self):
+        if self.metrics_queue is None:
+            return
+        try:
+            self.metrics_queue.put_nowait((self.config['name'], os.getpid(), self.metrics.snapshot()))
+        except Exception as err:
+            self.logger.warning('Metrics are not sent: ' + str(err))
+
+    def get_checkpoint_tag(self):
+        return type(self).__name__ + ':' + str(self.checkpoint_version)
+
+    def save_checkpoint(self):
+        """Save the state returned by get_checkpoint_state, errors are only logged."""
+        if self.checkpoint_path is None:
+            return
+        try:
+            with self.phase('save_checkpoint'):
+                state = self.get_checkpoint_state()
+                if state is None:
+                    return
+                checkpoint.save(self.checkpoint_path, self.clock.time(), self.get_checkpoint_tag(), state)
+        except Exception as err:
+            self.logger.error('Failed to save checkpoint to ' + self.checkpoint_path + ': ' + str(err))
+
+    def restore_checkpoint(self):
+        """Restore the state saved by the previous run of the strategy.
+
+        Checkpoints older than checkpoint_max_age seconds (default 3 * sleep_time),
+        written by another strategy class or checkpoint_version are discarded.
+
+        Returns:
+            True if the state was restored
+        """
+        if self.checkpoint_path is None or not os.path.exists(self.checkpoint_path):
+            return False
+        try:
+            timestamp, tag, state = checkpoint.load(self.checkpoint_path)
+        except checkpoint.CheckpointError as err:
+            self.logger.warning(str(err))
+            checkpoint.discard(self.checkpoint_path)
+            return False
+        age = self.clock.time() - timestamp
+        max_age = float(self.config.get('checkpoint_max_age', 3 * self.sleep_time))
+        if tag != self.get_checkpoint_tag():
+            self.logger.warning('Checkpoint of ' + tag + ' is discarded, expected ' + self.get_checkpoint_tag())
+            checkpoint.discard(self.checkpoint_path)
+            return False
+        if age > max_age:
+            self.logger.warning('Checkpoint is too old: {0:.0f} seconds, it is discarded'.format(age))
+            checkpoint.discard(self.checkpoint_path)
+            return False
+        try:
+            self.restore_checkpoint_state(state, age)
+        except Exception as err:
+            self.logger.error('Failed to restore checkpoint, starting from scratch')
+            self.logger.exception(err)
+            checkpoint.discard(self.checkpoint_path)
+            return False
+        self.logger.info('State restored from checkpoint of {0:.0f} seconds ago'.format(age))
+        return True
 
     def run(self):
+        self.restore_checkpoint()
         isRunning = True
+        interval = self.sleep_time
+        next_run = self.clock.monotonic()
         while isRunning:
-            self.perform_strategy()
-            time.sleep(self.sleep_time)
+            work_pending = self.perform_cycle()
+            interval = self.get_next_interval(interval, work_pending)
+            # Cycles are planned from the planned start of the previous one, so the time spent
+            # in perform_strategy does not shift the schedule. Missed cycles are not repeated.
+            next_run = max(next_run + interval, self.clock.monotonic())
+            if self.wait(next_run - self.clock.monotonic()):
+                self.logger.info('Woken up before schedule')
+                next_run = self.clock.monotonic()
             if self.shutdown:
                 if self.logger:
                     self.logger.info('Initiate shutdown procedure')
@@ -75,6 +374,25 @@ class BaseStrategy:
                 isRunning = False
 
     def perform_strategy(self):
+        """Do one cycle of the strategy.
+
+        Returns(Optional):
+            True if there is more work to do soon, False if strategy is idle.
+            See get_next_interval.
+        """
+        pass
+
+    def get_checkpoint_state(self):
+        """State to be saved after the cycle, picklable. None means nothing to save."""
+        return None
+
+    def restore_checkpoint_state(self, state, age):
+        """Apply the state returned by get_checkpoint_state of the previous run.
+
+        Args:
+            state: saved state
+            age: seconds since the state was saved
+        """
         pass
 
     def before_shutdown(self):
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Module for checkpoints of strategy state.
+
+A strategy saves its state after every cycle and restores it at startup, so
+a restarted strategy continues with in-flight deploys and collected usage
+statistics instead of starting from scratch.
+
+File layout: header (magic, format version, timestamp, payload length)
+followed by zlib compressed pickled payload {'tag': tag, 'state': state}.
+The file is written to a temporary file and renamed, so readers see either
+the previous or the new checkpoint, never a partial one.
+"""
+import os
+import pickle
+import struct
+import zlib
+
+MAGIC = b'SSCP'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sIdQ')
+SUFFIX = '.checkpoint'
+
+
+class CheckpointError(Exception):
+    pass
+
+
+def get_checkpoint_path(checkpoint_dir, name):
+    return os.path.join(checkpoint_dir, name + SUFFIX)
+
+
+def save(path, timestamp, tag, state, compression_level=6):
+    """Atomically replace the checkpoint.
+
+    Args:
+        timestamp: time of the state, used to detect stale checkpoints
+        tag: identifies the format of the state, checkpoint with other tag is not restored
+        state: picklable object
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    payload = zlib.compress(pickle.dumps({'tag': tag, 'state': state}, pickle.HIGHEST_PROTOCOL),
+                            compression_level)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as checkpoint_file:
+        checkpoint_file.write(HEADER.pack(MAGIC, FORMAT_VERSION, timestamp, len(payload)))
+        checkpoint_file.write(payload)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(tmp_path, path)
+    return HEADER.size + len(payload)
+
+
+def load(path):
+    """Read the checkpoint.
+
+    Returns:
+        (timestamp, tag, state)
+
+    Raises:
+        CheckpointError: if the file is missing or broken
+    """
+    try:
+        with open(path, 'rb') as checkpoint_file:
+            header = checkpoint_file.read(HEADER.size)
+            if len(header) != HEADER.size:
+                raise CheckpointError('Checkpoint ' + path + ' is too short')
+            magic, version, timestamp, length = HEADER.unpack(header)
+            if magic != MAGIC or version != FORMAT_VERSION:
+                raise CheckpointError('Unknown checkpoint format in ' + path)
+            data = checkpoint_file.read(length)
+    except OSError as err:
+        raise CheckpointError('Checkpoint is not available: ' + str(err))
+    if len(data) != length:
+        raise CheckpointError('Checkpoint ' + path + ' is truncated')
+    try:
+        payload = pickle.loads(zlib.decompress(data))
+    except Exception as err:
+        raise CheckpointError('Checkpoint ' + path + ' is broken: ' + str(err))
+    return timestamp, payload['tag'], payload['state']
+
+
+def discard(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Module for clocks used by strategies.
+
+Strategies take current time from self.clock. In the daemon it is the
+system clock, the simulator gives a virtual clock which jumps forward
+instead of sleeping.
+"""
+import datetime
+import heapq
+import itertools
+import time
+
+
+class SystemClock:
+    """Real time."""
+    is_virtual = False
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def utcnow(self):
+        return datetime.datetime.utcnow()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class VirtualClock:
+    """Time which is moved forward only by sleep and advance.
+
+    Callbacks scheduled by call_at are executed while the clock passes their
+    time, the clock shows exactly the scheduled time during the call.
+    """
+    is_virtual = True
+
+    def __init__(self, start=0.0):
+        self.now = float(start)
+        self.timers = []
+        self.counter = itertools.count()
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def utcnow(self):
+        return datetime.datetime.utcfromtimestamp(self.now)
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.advance(self.now + seconds)
+
+    def call_at(self, when, callback):
+        heapq.heappush(self.timers, (when, next(self.counter), callback))
+
+    def advance(self, target):
+        while self.timers and self.timers[0][0] <= target:
+            when, _, callback = heapq.heappop(self.timers)
+            self.now = max(self.now, when)
+            callback()
+        self.now = max(self.now, target)
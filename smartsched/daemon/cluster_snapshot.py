@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Module for the cluster snapshot shared by all strategy processes.
+
+The snapshot provider process (see snapshot_provider) refreshes hosts, VMs
+and host metrics once per interval and publishes them through a memory mapped
+file. Strategies read the latest snapshot instead of querying cloud and
+monitoring by themselves.
+
+File layout: header (magic, format version, sequence, timestamp, payload
+length) followed by pickled payload. Sequence is odd while the payload is
+being written, so readers retry if the sequence is odd or was changed during
+reading (seqlock).
+"""
+import mmap
+import os
+import pickle
+import struct
+import time
+
+MAGIC = b'SSNP'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sIQdQ')
+INITIAL_CAPACITY = 1024 * 1024
+READ_ATTEMPTS = 10
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class SnapshotWriter:
+    """Publishes snapshots to the memory mapped file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = max(os.fstat(self.fd).st_size, HEADER.size + INITIAL_CAPACITY)
+        os.ftruncate(self.fd, size)
+        self.mm = mmap.mmap(self.fd, size)
+        magic, version, self.sequence, _, _ = HEADER.unpack_from(self.mm)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self.sequence = 0
+        # Previous writer could be killed in the middle of writing
+        self.sequence += self.sequence % 2
+
+    def write(self, snapshot):
+        payload = pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL)
+        size = HEADER.size + len(payload)
+        if size > len(self.mm):
+            # File only grows, so mappings of readers stay valid
+            new_size = max(size, 2 * len(self.mm))
+            os.ftruncate(self.fd, new_size)
+            self.mm.close()
+            self.mm = mmap.mmap(self.fd, new_size)
+
+        self.sequence += 1
+        HEADER.pack_into(self.mm, 0, MAGIC, FORMAT_VERSION, self.sequence, time.time(), 0)
+        self.mm[HEADER.size:size] = payload
+        self.sequence += 1
+        HEADER.pack_into(self.mm, 0, MAGIC, FORMAT_VERSION, self.sequence, time.time(), len(payload))
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+
+
+class SnapshotReader:
+    """Reads the latest snapshot from the memory mapped file.
+
+    The payload is unpickled directly from the mapping without intermediate
+    copy. Every read returns new objects, so strategies can modify them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.mm = None
+
+    def _map(self):
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDONLY)
+        size = os.fstat(self.fd).st_size
+        if self.mm is None or len(self.mm) != size:
+            if self.mm is not None:
+                self.mm.close()
+            self.mm = mmap.mmap(self.fd, size, access=mmap.ACCESS_READ)
+
+    def read(self):
+        """Return (timestamp, snapshot) of the latest published snapshot.
+
+        Raises:
+            SnapshotError: if nothing is published yet or the file is broken
+        """
+        try:
+            self._map()
+        except (OSError, ValueError) as err:
+            raise SnapshotError('Snapshot is not available: ' + str(err))
+
+        for _ in range(READ_ATTEMPTS):
+            magic, version, sequence, timestamp, length = HEADER.unpack_from(self.mm)
+            if magic != MAGIC or version != FORMAT_VERSION:
+                raise SnapshotError('Unknown snapshot format in ' + self.path)
+            if sequence == 0:
+                raise SnapshotError('Snapshot is not published yet')
+            if sequence % 2 == 1:
+                time.sleep(0.01)
+                continue
+            if HEADER.size + length > len(self.mm):
+                self._map()
+            try:
+                with memoryview(self.mm)[HEADER.size:HEADER.size + length] as payload:
+                    snapshot = pickle.loads(payload)
+            except Exception:
+                snapshot = None
+            if HEADER.unpack_from(self.mm)[2] == sequence and snapshot is not None:
+                return timestamp, snapshot
+        raise SnapshotError('Snapshot is being rewritten too often')
+
+
+def hosts_of_clusters(snapshot, cluster_ids):
+    """Hosts of listed clusters from the snapshot or None if some cluster is not there."""
+    hosts = []
+    for cluster_id in cluster_ids:
+        if int(cluster_id) not in snapshot['hosts']:
+            return None
+        hosts.extend(snapshot['hosts'][int(cluster_id)])
+    return hosts
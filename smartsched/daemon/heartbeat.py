@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Module for heartbeats of strategy processes
+"""
+import time
+
+from multiprocessing import Array
+
+PHASE_LENGTH = 64
+CYCLE_START = 0
+CYCLE_END = 1
+
+
+class Heartbeat:
+    """Cycle start, cycle end and current phase of a strategy.
+
+    Values are kept in shared memory which is created by the master before
+    the strategy process is forked, so the master can read them without any
+    request to the strategy. Shared arrays have no locks: a strategy killed
+    in the middle of an update should not block the master.
+    """
+
+    def __init__(self):
+        self.times = Array('d', 2, lock=False)
+        self.phase_name = Array('c', PHASE_LENGTH, lock=False)
+
+    def reset(self):
+        self.times[CYCLE_START] = 0
+        self.times[CYCLE_END] = 0
+        self.phase_name.value = b''
+
+    def cycle_started(self):
+        self.times[CYCLE_START] = time.time()
+        self.set_phase('perform_strategy')
+
+    def cycle_finished(self):
+        self.times[CYCLE_END] = time.time()
+        self.set_phase('')
+
+    def set_phase(self, name):
+        self.phase_name.value = name.encode('utf-8')[:PHASE_LENGTH - 1]
+
+    def phase(self):
+        return self.phase_name.value.decode('utf-8', 'replace')
+
+    def cycle_start(self):
+        return self.times[CYCLE_START]
+
+    def cycle_end(self):
+        return self.times[CYCLE_END]
+
+    def in_cycle(self):
+        return self.times[CYCLE_START] > self.times[CYCLE_END]
+
+    def cycle_duration(self, now=None):
+        """Duration of the current cycle in seconds or 0 if strategy is sleeping."""
+        if not self.in_cycle():
+            return 0
+        if now is None:
+            now = time.time()
+        return now - self.times[CYCLE_START]
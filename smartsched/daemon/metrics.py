@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Module for performance metrics of strategies.
+
+Strategy processes collect cycle and phase timings and latency of cloud and
+monitoring calls. After every cycle the cumulative values are sent to the
+master which aggregates them and exports in Prometheus text format (for
+node_exporter textfile collector).
+"""
+import os
+import queue
+import threading
+import time
+
+# Upper bounds (seconds) of histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600, float('inf'))
+
+CYCLE_DURATION = 'smartsched_cycle_duration_seconds'
+CYCLE_ERRORS = 'smartsched_cycle_errors_total'
+PHASE_DURATION = 'smartsched_phase_duration_seconds'
+RPC_DURATION = 'smartsched_rpc_duration_seconds'
+RPC_ERRORS = 'smartsched_rpc_errors_total'
+MIGRATIONS = 'smartsched_migrations_total'
+MIGRATION_DURATION = 'smartsched_migration_duration_seconds'
+
+DESCRIPTIONS = {
+    CYCLE_DURATION: 'Duration of perform_strategy calls',
+    CYCLE_ERRORS: 'Amount of perform_strategy calls finished by exception',
+    PHASE_DURATION: 'Duration of named phases of strategy cycles',
+    RPC_DURATION: 'Latency of cloud and monitoring handler calls',
+    RPC_ERRORS: 'Amount of cloud and monitoring handler calls finished by exception',
+    MIGRATIONS: 'Amount of finished migrations by result',
+    MIGRATION_DURATION: 'Duration of successful live migrations',
+    'smartsched_strategy_up': 'Whether the strategy process is alive',
+    'smartsched_strategy_restarts_total': 'Amount of restarts of the strategy process',
+    'smartsched_strategy_uptime_seconds': 'Uptime of the current strategy process',
+}
+
+
+def _new_histogram():
+    return {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+
+
+class StrategyMetrics:
+    """Counters and histograms of one strategy process.
+
+    Keys of both dicts are (metric_name, labels) where labels is a tuple of
+    (label, value) pairs. The object is thread safe, handlers may be called
+    from thread pools.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, labels=(), value=1):
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = _new_histogram()
+            for index, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def snapshot(self):
+        """Picklable copy of all values."""
+        with self.lock:
+            histograms = {}
+            for key, histogram in self.histograms.items():
+                histograms[key] = {'buckets': list(histogram['buckets']),
+                                   'sum': histogram['sum'],
+                                   'count': histogram['count']}
+            return {'counters': dict(self.counters), 'histograms': histograms}
+
+
+class InstrumentedHandler:
+    """Proxy of cloud or monitoring handler which measures every call.
+
+    Usage:
+        self.cloud = metrics.InstrumentedHandler(common.get_cloud_handler(), 'cloud', self.metrics)
+    """
+
+    def __init__(self, handler, handler_name, strategy_metrics):
+        self._handler = handler
+        self._handler_name = handler_name
+        self._metrics = strategy_metrics
+
+    def __getattr__(self, name):
+        attribute = getattr(self._handler, name)
+        if not callable(attribute):
+            return attribute
+        labels = (('handler', self._handler_name), ('method', name))
+
+        def measured_call(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return attribute(*args, **kwargs)
+            except Exception:
+                self._metrics.increment(RPC_ERRORS, labels)
+                raise
+            finally:
+                self._metrics.observe(RPC_DURATION, labels, time.monotonic() - start)
+        return measured_call
+
+
+def _merge(target, snapshot):
+    for key, value in snapshot['counters'].items():
+        target['counters'][key] = target['counters'].get(key, 0) + value
+    for key, histogram in snapshot['histograms'].items():
+        total = target['histograms'].get(key)
+        if total is None:
+            total = target['histograms'][key] = _new_histogram()
+        total['buckets'] = [a + b for a, b in zip(total['buckets'], histogram['buckets'])]
+        total['sum'] += histogram['sum']
+        total['count'] += histogram['count']
+
+
+def _format_labels(labels):
+    return '{' + ','.join('{0}="{1}"'.format(label, str(value).replace('"', '\\"')) for label, value in labels) + '}'
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+class MetricsAggregator:
+    """Collects metrics sent by strategy processes and writes Prometheus text file.
+
+    Values of a strategy are cumulative per process. When a strategy is
+    restarted the last values of the previous process are kept as a base, so
+    exported counters do not go back.
+
+    Attributes:
+        metrics_queue: multiprocessing.Queue, items are (strategy, pid, snapshot)
+        path: output file
+        interval: seconds between file updates
+        processes: {strategy: SupervisedStrategy} for process state gauges
+    """
+
+    def __init__(self, metrics_queue, path, interval=15, processes=None):
+        self.metrics_queue = metrics_queue
+        self.path = path
+        self.interval = interval
+        self.processes = processes if processes is not None else {}
+        self.base = {}
+        self.current = {}
+        self.thread = None
+        self.isRunning = False
+
+    def start(self):
+        self.isRunning = True
+        self.thread = threading.Thread(target=self._run, name='MetricsAggregator')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.isRunning = False
+        self.metrics_queue.put(None)
+        self.thread.join()
+        self.write()
+
+    def add(self, strategy, pid, snapshot):
+        previous = self.current.get(strategy)
+        if previous is not None and previous[0] != pid:
+            base = self.base.setdefault(strategy, {'counters': {}, 'histograms': {}})
+            _merge(base, previous[1])
+        self.current[strategy] = (pid, snapshot)
+
+    def _run(self):
+        next_write = time.monotonic() + self.interval
+        while self.isRunning:
+            try:
+                item = self.metrics_queue.get(timeout=max(0, next_write - time.monotonic()))
+                if item is not None:
+                    self.add(*item)
+            except queue.Empty:
+                pass
+            if time.monotonic() >= next_write:
+                self.write()
+                next_write = time.monotonic() + self.interval
+
+    def collect(self):
+        """Totals of all strategies: {strategy: {'counters': ..., 'histograms': ...}}"""
+        totals = {}
+        for strategy in set(self.base) | set(self.current):
+            total = totals[strategy] = {'counters': {}, 'histograms': {}}
+            if strategy in self.base:
+                _merge(total, self.base[strategy])
+            if strategy in self.current:
+                _merge(total, self.current[strategy][1])
+        return totals
+
+    def format(self):
+        series = {}
+        for strategy, total in sorted(self.collect().items()):
+            for (name, labels), value in sorted(total['counters'].items()):
+                series.setdefault((name, 'counter'), []).append(
+                    name + _format_labels((('strategy', strategy), ) + labels) + ' ' + repr(value))
+            for (name, labels), histogram in sorted(total['histograms'].items()):
+                lines = series.setdefault((name, 'histogram'), [])
+                labels = (('strategy', strategy), ) + labels
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram['buckets']):
+                    cumulative += count
+                    lines.append(name + '_bucket' + _format_labels(labels + (('le', _format_bound(bound)), )) +
+                                 ' ' + str(cumulative))
+                lines.append(name + '_sum' + _format_labels(labels) + ' ' + repr(histogram['sum']))
+                lines.append(name + '_count' + _format_labels(labels) + ' ' + str(histogram['count']))
+
+        for strategy, process in sorted(self.processes.items()):
+            labels = _format_labels((('strategy', strategy), ))
+            series.setdefault(('smartsched_strategy_up', 'gauge'), []).append(
+                'smartsched_strategy_up' + labels + ' ' + ('1' if process.is_alive() else '0'))
+            series.setdefault(('smartsched_strategy_restarts_total', 'counter'), []).append(
+                'smartsched_strategy_restarts_total' + labels + ' ' + str(process.restarts))
+            series.setdefault(('smartsched_strategy_uptime_seconds', 'gauge'), []).append(
+                'smartsched_strategy_uptime_seconds' + labels + ' ' + repr(float(process.uptime())))
+
+        output = []
+        for (name, metric_type), lines in sorted(series.items()):
+            output.append('# HELP ' + name + ' ' + DESCRIPTIONS.get(name, name))
+            output.append('# TYPE ' + name + ' ' + metric_type)
+            output.extend(lines)
+        return '\n'.join(output) + '\n'
+
+    def write(self):
+        """Replace the file atomically, so the collector never reads half of it."""
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as metrics_file:
+            metrics_file.write(self.format())
+        os.replace(temporary_path, self.path)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Module for executing planned live migrations
+"""
+from . import metrics
+from . import parallel
+from . import vm_registry
+
+FAILED_STATES = ['FAILED']
+FAILED_LCM_STATES = ['FAILURE', 'UNKNOWN']
+# VM which is not running can be migrated back only in these states
+STABLE_STATES = ['POWEROFF']
+
+
+class MigrationExecutor:
+    """Runs planned migrations in parallel with bounded load of hosts.
+
+    Migrations are started in the planned order as long as limits allow:
+    at most max_parallel migrations in total, max_per_source from one host
+    and max_per_destination to one host, so no single network link is
+    saturated. A host receives VMs only after all earlier planned
+    migrations from it are finished, because the plan counts on the space
+    they free. State of all migrating VMs is polled together by bounded
+    ranges of their ids.
+
+    A migration which ended with the VM running on its source host is
+    retried up to max_retries times. If the VM failed or the migration did
+    not finish in timeout seconds, the VM is migrated back to its source
+    (rollback) as soon as it is stable (RUNNING or POWEROFF) on another
+    host. A VM which is still migrating or is in FAILURE is watched for
+    another timeout seconds and is reported failed if it does not settle.
+
+    Args:
+        cloud: cloud handler from smartsched.common
+        logger: logger of the strategy
+        clock: clock of the strategy, see clock
+        wait: callable(seconds) used to wait between polls, e.g. strategy.wait
+        should_stop: callable, if it returns True no new migrations are started
+        metrics: StrategyMetrics of the strategy or None
+
+    Usage:
+        executor = migration_executor.MigrationExecutor(self.cloud, self.logger, self.clock, self.wait)
+        report = executor.run([{'vm': vm_id, 'source': host_id, 'destination': host_id}, ...])
+    """
+
+    def __init__(self, cloud, logger, clock, wait, should_stop=None, max_parallel=4, max_per_source=1,
+                 max_per_destination=1, max_retries=1, timeout=1800, poll_interval=10, metrics=None):
+        self.cloud = cloud
+        self.logger = logger
+        self.clock = clock
+        self.wait = wait
+        self.should_stop = should_stop if should_stop is not None else lambda: False
+        self.max_parallel = max_parallel
+        self.max_per_source = max_per_source
+        self.max_per_destination = max_per_destination
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.metrics = metrics
+
+    def run(self, moves):
+        """Execute migrations and wait till all of them are finished.
+
+        Args:
+            moves: [{'vm': vm_id, 'source': host_id, 'destination': host_id}, ...] in planned order
+
+        Returns:
+            {'planned', 'succeeded', 'retried', 'rolled_back', 'failed', 'abandoned',
+             'duration': seconds, 'throughput': migrations per minute}
+        """
+        start = self.clock.monotonic()
+        report = {'planned': len(moves), 'succeeded': 0, 'retried': 0, 'rolled_back': 0, 'failed': 0,
+                  'abandoned': 0}
+        queued = []
+        # {host_id: set of planned positions of unfinished migrations from the host}
+        departures = {}
+        for position, move in enumerate(moves):
+            queued.append(dict(move, position=position, attempt=0, rollback=False))
+            departures.setdefault(move['source'], set()).add(position)
+        in_flight = {}
+
+        while queued or in_flight:
+            if self.should_stop():
+                report['abandoned'] += len(queued) + len(in_flight)
+                self.logger.warning('Migrations are interrupted, {0} are not finished'.format(
+                    len(queued) + len(in_flight)))
+                break
+            started = self.start_migrations(queued, in_flight, departures, report)
+            if in_flight:
+                self.wait(self.poll_interval)
+                self.poll(queued, in_flight, departures, report)
+            elif not started:
+                # Should not happen: the earliest planned migration is always startable
+                report['failed'] += len(queued)
+                self.logger.error('{0} migrations can not be started'.format(len(queued)))
+                break
+
+        report['duration'] = self.clock.monotonic() - start
+        report['throughput'] = 60.0 * report['succeeded'] / report['duration'] if report['duration'] > 0 else 0.0
+        return report
+
+    def is_startable(self, move, from_source, to_destination, departures):
+        if from_source.get(move['source'], 0) >= self.max_per_source:
+            return False
+        if to_destination.get(move['destination'], 0) >= self.max_per_destination:
+            return False
+        if move['rollback']:
+            return True
+        earlier = departures.get(move['destination'])
+        return not earlier or min(earlier) > move['position']
+
+    def start_migrations(self, queued, in_flight, departures, report):
+        """Start queued migrations allowed by the limits.
+
+        Returns:
+            amount of migrations which were tried to start
+        """
+        from_source = {}
+        to_destination = {}
+        for move in in_flight.values():
+            from_source[move['source']] = from_source.get(move['source'], 0) + 1
+            to_destination[move['destination']] = to_destination.get(move['destination'], 0) + 1
+        batch = []
+        for move in list(queued):
+            if len(in_flight) + len(batch) >= self.max_parallel:
+                break
+            if self.is_startable(move, from_source, to_destination, departures):
+                queued.remove(move)
+                batch.append(move)
+                from_source[move['source']] = from_source.get(move['source'], 0) + 1
+                to_destination[move['destination']] = to_destination.get(move['destination'], 0) + 1
+        if not batch:
+            return 0
+        # VM which is rolled back is not running, so it is migrated cold
+        results = parallel.map_parallel(self.cloud.migrate,
+                                        [(move['vm'], move['destination'], not move['rollback'], False)
+                                         for move in batch],
+                                        len(batch))
+        now = self.clock.monotonic()
+        for move, (result, error) in zip(batch, results):
+            if error is not None or result is False:
+                self.logger.error('Migration of vm {0} to host {1} is not started: {2}'.format(
+                    move['vm'], move['destination'], error if error is not None else 'rejected by cloud'))
+                self.on_failure(move, None, queued, in_flight, departures, report)
+                continue
+            self.logger.info('Migrating vm {0}: {1} --> {2}'.format(move['vm'], move['source'], move['destination']))
+            move['started'] = now
+            in_flight[move['vm']] = move
+        return len(batch)
+
+    def poll(self, queued, in_flight, departures, report):
+        vm_ids = list(in_flight)
+        try:
+            # Only in-flight ids are requested, by bounded ranges
+            vms = [vm for page in vm_registry.iter_vm_pages(self.cloud, vm_ids, vmStateFilter=-2) for vm in page]
+        except Exception as err:
+            self.logger.error('Failed to get state of migrating VMs: ' + str(err))
+            return
+        states = {}
+        for vm in vms:
+            states[vm['id']] = vm
+
+        now = self.clock.monotonic()
+        for vm_id in vm_ids:
+            move = in_flight[vm_id]
+            vm = states.get(vm_id)
+            if vm is None or vm['state'] == 'DONE':
+                del in_flight[vm_id]
+                self.logger.warning('VM {0} disappeared during migration'.format(vm_id))
+                report['abandoned'] += 1
+                self.finish(move, departures)
+                continue
+            if vm['lcm_state'] == 'RUNNING' and vm['hid'] == move['destination']:
+                del in_flight[vm_id]
+                self.on_success(move, now, report)
+                self.finish(move, departures)
+                continue
+            if move.get('settling'):
+                if vm['lcm_state'] == 'RUNNING' or vm['state'] in STABLE_STATES:
+                    del in_flight[vm_id]
+                    move['settling'] = False
+                    self.on_failure(move, vm, queued, in_flight, departures, report)
+                elif now - move['started'] > self.timeout:
+                    del in_flight[vm_id]
+                    report['failed'] += 1
+                    self.logger.error('VM {0} is not rolled back, it stays in state {1}/{2}'.format(
+                        vm_id, vm['state'], vm['lcm_state']))
+                    self.record('failed')
+                    self.finish(move, departures)
+                continue
+            failed = vm['state'] in FAILED_STATES or vm['lcm_state'] in FAILED_LCM_STATES
+            returned = vm['lcm_state'] == 'RUNNING' and vm['hid'] == move['source']
+            if failed or returned or now - move['started'] > self.timeout:
+                del in_flight[vm_id]
+                self.on_failure(move, vm, queued, in_flight, departures, report)
+
+    def on_success(self, move, now, report):
+        if move['rollback']:
+            report['rolled_back'] += 1
+            self.logger.info('VM {0} is rolled back to host {1}'.format(move['vm'], move['destination']))
+            self.record('rolled_back')
+            return
+        report['succeeded'] += 1
+        self.logger.info('VM {0} is migrated to host {1}'.format(move['vm'], move['destination']))
+        self.record('succeeded')
+        if self.metrics is not None:
+            self.metrics.observe(metrics.MIGRATION_DURATION, (), now - move['started'])
+
+    def on_failure(self, move, vm, queued, in_flight, departures, report):
+        """Retry the migration, roll it back, wait till the VM settles or give up."""
+        still_on_source = vm is None or (vm['lcm_state'] == 'RUNNING' and vm['hid'] == move['source'])
+        if move['rollback']:
+            report['failed'] += 1
+            self.logger.error('Rollback of vm {0} to host {1} failed'.format(move['vm'], move['destination']))
+            self.record('failed')
+            self.finish(move, departures)
+        elif still_on_source and move['attempt'] < self.max_retries:
+            move['attempt'] += 1
+            report['retried'] += 1
+            self.logger.warning('Migration of vm {0} failed, retry {1} of {2}'.format(
+                move['vm'], move['attempt'], self.max_retries))
+            queued.append(move)
+        elif still_on_source or vm['hid'] == move['source']:
+            # VM on its source is not rolled back even if it is not running
+            report['failed'] += 1
+            self.logger.error('Migration of vm {0} to host {1} failed'.format(move['vm'], move['destination']))
+            self.record('failed')
+            self.finish(move, departures)
+        elif vm['lcm_state'] != 'RUNNING' and vm['state'] not in STABLE_STATES:
+            # Cold migration of VM which is migrating or failed is not possible, so rollback waits
+            self.logger.warning('Migration of vm {0} to host {1} failed in state {2}/{3}, waiting for it '
+                                'to settle'.format(move['vm'], move['destination'], vm['state'], vm['lcm_state']))
+            move['settling'] = True
+            move['started'] = self.clock.monotonic()
+            in_flight[move['vm']] = move
+        else:
+            self.logger.error('Migration of vm {0} to host {1} failed in state {2}/{3}, rolling back'.format(
+                move['vm'], move['destination'], vm['state'], vm['lcm_state']))
+            self.finish(move, departures)
+            queued.insert(0, dict(move, source=vm['hid'], destination=move['source'], attempt=0,
+                                  rollback=True))
+
+    def finish(self, move, departures):
+        if not move['rollback']:
+            departures[move['source']].discard(move['position'])
+
+    def record(self, result):
+        if self.metrics is not None:
+            self.metrics.increment(metrics.MIGRATIONS, (('result', result), ))
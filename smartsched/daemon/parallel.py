@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Module for running blocking queries with bounded concurrency
+"""
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+_local = threading.local()
+
+
+def _call(function, args):
+    try:
+        return function(*args), None
+    except Exception as err:
+        return None, err
+
+
+def map_parallel(function, args_list, max_parallel=1):
+    """Call function for every element of args_list using a pool of threads.
+
+    At most max_parallel calls are executed at the same time. If max_parallel
+    is 1 or less the calls are done one by one in the current thread.
+    Exception raised by one call does not affect the others.
+
+    Args:
+        function: callable doing blocking query (cloud or monitoring)
+        args_list: list of tuples with positional arguments for every call
+        max_parallel: maximal amount of simultaneous calls
+
+    Returns:
+        [(result, error), ...] in the same order as args_list. error is None
+        for successful calls, result is None for failed ones.
+    """
+    args_list = list(args_list)
+    if max_parallel <= 1 or len(args_list) <= 1:
+        return [_call(function, args) for args in args_list]
+
+    function = charged(function)
+    with ThreadPoolExecutor(max_workers=min(max_parallel, len(args_list))) as executor:
+        futures = [executor.submit(_call, function, args) for args in args_list]
+        return [future.result() for future in futures]
+
+
+class CpuAccount:
+    """CPU time of the current thread and of the helper threads working for it.
+
+    time.thread_time() of one thread misses the work done by thread pools.
+    Calls made by map_parallel and other functions wrapped by charged in
+    the scope of the account add their CPU time to it too. Threads started
+    by other means are not counted.
+
+    Usage:
+        with parallel.CpuAccount() as account:
+            strategy.perform_cycle()
+        print(account.cpu)
+    """
+
+    def __init__(self):
+        self.cpu = 0.0
+        self.lock = threading.Lock()
+        self.start = None
+        self.previous = None
+
+    def add(self, seconds):
+        with self.lock:
+            self.cpu += seconds
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'account', None)
+        _local.account = self
+        self.start = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.add(time.thread_time() - self.start)
+        _local.account = self.previous
+
+
+def charged(function):
+    """Wrap function which is called in another thread, so its CPU time is added to the current CpuAccount.
+
+    The account is taken when charged is called. Function is returned as is if
+    there is no account.
+    """
+    account = getattr(_local, 'account', None)
+    if account is None:
+        return function
+
+    def charged_call(*args, **kwargs):
+        previous = getattr(_local, 'account', None)
+        # Helper threads started by the call are charged to the same account
+        _local.account = account
+        start = time.thread_time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            account.add(time.thread_time() - start)
+            _local.account = previous
+    return charged_call
+
+
+class PerThreadHandler:
+    """Proxy which gives every thread its own cloud or monitoring handler.
+
+    XML-RPC handlers keep one connection and can not be shared by the threads
+    of map_parallel. The handler of a thread is created by factory on the
+    first call made from that thread. Only methods are proxied and the handler
+    is chosen when the method is called, so a bound method like
+    self.cloud.migrate can be passed to map_parallel.
+
+    Usage:
+        self.cloud = self.instrument(parallel.PerThreadHandler(common.get_cloud_handler), 'cloud')
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._local = threading.local()
+
+    def _handler(self):
+        handler = getattr(self._local, 'handler', None)
+        if handler is None:
+            handler = self._local.handler = self._factory()
+        return handler
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            return getattr(self._handler(), name)(*args, **kwargs)
+        return call
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Module for the priority queue of pending VMs
+"""
+import heapq
+import itertools
+
+
+def age_priority(vm, first_seen, weights):
+    """The longest waiting VM first."""
+    return (first_seen, vm['id'])
+
+
+def size_priority(vm, first_seen, weights):
+    """The biggest VM first, so big VMs do not starve behind small ones."""
+    return (-vm['mem_allocated'], -vm['cpu_allocated'], first_seen, vm['id'])
+
+
+def weight_priority(vm, first_seen, weights):
+    """VMs of users and clusters with the highest weight first, older first among equal weights."""
+    return (-get_weight(vm, weights), first_seen, vm['id'])
+
+
+PRIORITIES = {'age': age_priority,
+              'size': size_priority,
+              'weight': weight_priority}
+
+
+def parse_weights(text):
+    """Parse weights like 'cluster:108=2, user:5=0.5' into {('cluster', '108'): 2.0, ('user', '5'): 0.5}."""
+    weights = {}
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        key, value = item.split('=')
+        kind, object_id = key.strip().split(':')
+        weights[(kind.strip(), object_id.strip())] = float(value)
+    return weights
+
+
+def get_weight(vm, weights):
+    """Product of weights of the VM owner and cluster, 1 if they are not listed."""
+    weight = 1.0
+    if vm.get('cluster_id'):
+        weight *= weights.get(('cluster', str(vm['cluster_id'][0])), 1.0)
+    if vm.get('uid') is not None:
+        weight *= weights.get(('user', str(vm['uid'])), 1.0)
+    return weight
+
+
+class PendingQueue:
+    """Pending VMs ordered by priority, kept between cycles.
+
+    The queue is synchronized with the list of pending VMs by update: new
+    VMs are pushed into the heap and VMs which are not pending anymore are
+    deleted lazily (their heap items are skipped and compacted later). The
+    time when VM was seen first is remembered while the VM is pending or
+    listed in keep, so a VM whose deploy failed does not lose its age.
+
+    Args:
+        priority: name from PRIORITIES or callable(vm, first_seen, weights) returning
+            sortable key, the smallest key goes first
+        weights: see parse_weights
+
+    Attributes:
+        entries: {vm_id: {'vm': vm, 'key': key, 'sequence': n}}
+        first_seen: {vm_id: timestamp}
+    """
+
+    def __init__(self, priority='age', weights=None):
+        if not callable(priority):
+            if priority not in PRIORITIES:
+                raise ValueError('Unknown priority ' + str(priority) + ', expected one of ' +
+                                 ', '.join(sorted(PRIORITIES)))
+            priority = PRIORITIES[priority]
+        self.priority = priority
+        self.weights = weights or {}
+        self.heap = []
+        self.entries = {}
+        self.first_seen = {}
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, vm_id):
+        return vm_id in self.entries
+
+    def push(self, vm, now):
+        """Add the VM or refresh its representation."""
+        first_seen = self.first_seen.setdefault(vm['id'], now)
+        key = self.priority(vm, first_seen, self.weights)
+        entry = self.entries.get(vm['id'])
+        if entry is not None and entry['key'] == key:
+            entry['vm'] = vm
+            return
+        sequence = next(self.counter)
+        self.entries[vm['id']] = {'vm': vm, 'key': key, 'sequence': sequence}
+        heapq.heappush(self.heap, (key, sequence, vm['id']))
+
+    def remove(self, vm_id):
+        """Delete the VM from the queue, its heap item is skipped later."""
+        if self.entries.pop(vm_id, None) is not None and len(self.heap) > 2 * len(self.entries) + 16:
+            self.compact()
+
+    def update(self, vms, now, keep=()):
+        """Synchronize the queue with the current list of pending VMs.
+
+        Only new VMs and VMs whose priority key changed are pushed into the
+        heap, the rest just get fresh representation. VMs which are not
+        pending anymore are invalidated lazily.
+
+        Args:
+            vms: all pending VMs
+            now: current time
+            keep: ids of VMs whose first_seen should be remembered though they are not pending
+                (e.g. VMs being deployed)
+        """
+        current = set()
+        for vm in vms:
+            current.add(vm['id'])
+            self.push(vm, now)
+        for vm_id in list(self.entries):
+            if vm_id not in current:
+                self.remove(vm_id)
+        keep = set(keep)
+        self.first_seen = {vm_id: first_seen for vm_id, first_seen in self.first_seen.items()
+                           if vm_id in current or vm_id in keep}
+
+    def _is_valid(self, item):
+        entry = self.entries.get(item[2])
+        return entry is not None and entry['sequence'] == item[1]
+
+    def compact(self):
+        self.heap = [item for item in self.heap if self._is_valid(item)]
+        heapq.heapify(self.heap)
+
+    def peek(self):
+        """VM with the highest priority or None."""
+        while self.heap and not self._is_valid(self.heap[0]):
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        return self.entries[self.heap[0][2]]['vm']
+
+    def pop(self):
+        """Remove and return VM with the highest priority or None."""
+        vm = self.peek()
+        if vm is not None:
+            heapq.heappop(self.heap)
+            del self.entries[vm['id']]
+        return vm
+
+    def ordered(self):
+        """All VMs in priority order, the queue is not changed."""
+        self.compact()
+        return [self.entries[item[2]]['vm'] for item in sorted(self.heap)]
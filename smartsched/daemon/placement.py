@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Module for batched placement checks of VMs against hosts
+"""
+import numpy as np
+
+# Host capacity, current allocation and usage. All values of the same resource
+# should be measured in the same units as in VM rows.
+HOST_FIELDS = ('cpu_max', 'mem_max', 'cpu_allocated', 'mem_allocated',
+               'cpu_used', 'mem_used', 'cpu_free', 'mem_free')
+# VM request, allocation, expected usage and limits which are allowed on the host
+VM_FIELDS = ('cpu_req', 'mem_req', 'cpu_allocated', 'mem_allocated', 'cpu_used', 'mem_used',
+             'cpu_max_ovc', 'mem_max_ovc', 'cpu_max_usage', 'mem_max_usage')
+# Scores of hosts for VM, the higher the better:
+#   best_fit - the fullest host after placement (the tightest fit)
+#   worst_fit - the emptiest host after placement (spreads VMs)
+#   least_fragmentation - the host where CPU and MEM stay the most balanced, so the rest
+#       of the host is not stranded by one exhausted resource; tighter fit wins among equal
+#   first_fit - the first feasible host in the order of host rows
+RANKINGS = ('best_fit', 'worst_fit', 'least_fragmentation', 'first_fit')
+DEFAULTS = {'cpu_free': np.inf, 'mem_free': np.inf,
+            'cpu_req': 0.0, 'mem_req': 0.0, 'cpu_used': 0.0, 'mem_used': 0.0,
+            'cpu_max_ovc': np.inf, 'mem_max_ovc': np.inf, 'cpu_max_usage': np.inf, 'mem_max_usage': np.inf}
+
+
+def _columns(rows, fields):
+    columns = {}
+    for field in fields:
+        default = DEFAULTS.get(field, 0.0)
+        columns[field] = np.array([row.get(field, default) for row in rows], dtype=np.float64)
+    return columns
+
+
+class PlacementEngine:
+    """Feasibility and fit score of every (VM, host) pair.
+
+    Host rows are converted into NumPy arrays once. All VMs are checked against
+    all hosts with broadcasting, the checks are:
+        (host_used + vm_used) / host_max <= vm_max_usage
+        (host_allocated + vm_allocated) / host_max <= vm_max_ovc
+        vm_req <= host_free
+    for CPU and MEM. Limits are given per VM, so VMs of different classes can
+    be checked in one batch.
+
+    Attributes:
+        hosts: {field: np.array} with one element per host
+    """
+
+    def __init__(self, host_rows):
+        self.hosts = _columns(host_rows, HOST_FIELDS)
+
+    def __len__(self):
+        return len(self.hosts['cpu_max'])
+
+    def set_host(self, index, host_row):
+        """Update state of one host after placement or migration."""
+        for field in HOST_FIELDS:
+            self.hosts[field][index] = host_row.get(field, DEFAULTS.get(field, 0.0))
+
+    def evaluate(self, vm_rows, ranking='best_fit'):
+        """Check all VMs against all hosts.
+
+        Args:
+            ranking: one of RANKINGS
+
+        Returns:
+            (feasible, score) - two arrays of shape (vms, hosts). feasible is
+            boolean, score ranks hosts for every VM (the higher the better),
+            by default it is the fill level of the host after placement
+            relative to allowed overcommit. Score of infeasible pair is -inf.
+        """
+        if ranking not in RANKINGS:
+            raise ValueError('Unknown ranking ' + str(ranking) + ', expected one of ' + ', '.join(RANKINGS))
+        vms = _columns(vm_rows, VM_FIELDS)
+        hosts = self.hosts
+        feasible = np.ones((len(vm_rows), len(self)), dtype=bool)
+        fills = {}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for resource in ('cpu', 'mem'):
+                host_max = hosts[resource + '_max'][None, :]
+                usage = (hosts[resource + '_used'][None, :] + vms[resource + '_used'][:, None]) / host_max
+                overc = (hosts[resource + '_allocated'][None, :] + vms[resource + '_allocated'][:, None]) / host_max
+                max_ovc = vms[resource + '_max_ovc'][:, None]
+
+                feasible &= usage <= vms[resource + '_max_usage'][:, None]
+                feasible &= overc <= max_ovc
+                feasible &= vms[resource + '_req'][:, None] <= hosts[resource + '_free'][None, :]
+                fills[resource] = np.where(np.isfinite(max_ovc), overc / max_ovc, overc)
+
+        fill = (fills['cpu'] + fills['mem']) / 2.0
+        if ranking == 'best_fit':
+            score = fill
+        elif ranking == 'worst_fit':
+            score = -fill
+        elif ranking == 'least_fragmentation':
+            score = fill - np.abs(fills['cpu'] - fills['mem'])
+        else:
+            score = np.broadcast_to(-np.arange(len(self), dtype=np.float64), feasible.shape)
+        score = np.where(feasible, score, -np.inf)
+        return feasible, score
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Module for on-demand profiling of strategy processes.
+
+Profiling of a running strategy is requested by SIGUSR2. Settings of the
+request are taken from the request file <profile_dir>/<strategy>.request
+(written by "SmartDaemon profile ...") or from the strategy config
+(profile_mode, profile_cycles). Results are written to profile_dir:
+    cprofile     - <strategy>-<timestamp>.prof with stats of all profiled cycles
+                   (open with pstats or snakeviz)
+    tracemalloc  - <strategy>-<timestamp>-<n>.tracemalloc snapshots taken before
+                   the first cycle and after every profiled cycle
+                   (load with tracemalloc.Snapshot.load)
+"""
+import cProfile
+import os
+import time
+import tracemalloc
+
+MODES = ['cprofile', 'tracemalloc']
+DEFAULT_MODE = 'cprofile'
+DEFAULT_CYCLES = 1
+DEFAULT_DIR = '/tmp'
+TRACEMALLOC_FRAMES = 25
+TOP_ALLOCATIONS = 10
+
+
+def get_request_path(profile_dir, strategy_name):
+    return os.path.join(profile_dir, strategy_name + '.request')
+
+
+def write_request(profile_dir, strategy_name, cycles=None, mode=None):
+    """Write the request file which is read by the strategy on SIGUSR2."""
+    if mode is not None and mode not in MODES:
+        raise ValueError('Unknown profile mode ' + mode + ', expected one of ' + ', '.join(MODES))
+    lines = []
+    if cycles is not None:
+        lines.append('cycles=' + str(int(cycles)))
+    if mode is not None:
+        lines.append('mode=' + mode)
+    os.makedirs(profile_dir, exist_ok=True)
+    path = get_request_path(profile_dir, strategy_name)
+    with open(path + '.tmp', 'w') as request_file:
+        request_file.write('\n'.join(lines) + '\n')
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def read_request(profile_dir, strategy_name):
+    """Read and remove the request file.
+
+    Returns:
+        {'cycles': ..., 'mode': ...} with keys present in the file, empty dict if there is no file
+    """
+    path = get_request_path(profile_dir, strategy_name)
+    try:
+        with open(path) as request_file:
+            content = request_file.read()
+        os.remove(path)
+    except FileNotFoundError:
+        return {}
+    request = {}
+    for line in content.splitlines():
+        if '=' in line:
+            key, value = line.split('=', 1)
+            request[key.strip()] = value.strip()
+    return request
+
+
+class CycleProfiler:
+    """Profiles the next cycles of a strategy.
+
+    Usage:
+        profiler = CycleProfiler('cprofile', 3, '/tmp', 'ranked', logger)
+        while not profiler.finished:
+            profiler.before_cycle()
+            perform_strategy()
+            profiler.after_cycle()
+    """
+
+    def __init__(self, mode, cycles, profile_dir, name, logger):
+        if mode not in MODES:
+            raise ValueError('Unknown profile mode ' + mode + ', expected one of ' + ', '.join(MODES))
+        self.mode = mode
+        self.cycles = max(1, int(cycles))
+        self.done = 0
+        self.logger = logger
+        self.path_prefix = os.path.join(profile_dir, name + '-' + time.strftime('%Y%m%d-%H%M%S'))
+        self.profile = None
+        self.previous_snapshot = None
+        self.finished = False
+        os.makedirs(profile_dir, exist_ok=True)
+        if self.mode == 'cprofile':
+            self.profile = cProfile.Profile()
+        else:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            try:
+                self.previous_snapshot = self.take_snapshot()
+            except OSError:
+                tracemalloc.stop()
+                raise
+
+    def before_cycle(self):
+        if self.profile is not None:
+            self.profile.enable()
+
+    def after_cycle(self):
+        self.done += 1
+        if self.profile is not None:
+            self.profile.disable()
+        else:
+            snapshot = self.take_snapshot()
+            self.log_top_allocations(snapshot)
+            self.previous_snapshot = snapshot
+        if self.done >= self.cycles:
+            self.finish()
+
+    def finish(self):
+        if self.profile is not None:
+            path = self.path_prefix + '.prof'
+            self.profile.dump_stats(path)
+            self.logger.info('Profile of ' + str(self.done) + ' cycles is written to ' + path)
+        else:
+            tracemalloc.stop()
+            self.logger.info('Tracemalloc snapshots are written to ' + self.path_prefix + '-*.tracemalloc')
+        self.finished = True
+
+    def abort(self):
+        if self.profile is not None:
+            self.profile.disable()
+        elif tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.finished = True
+
+    def take_snapshot(self):
+        # Memory of tracemalloc itself is not interesting
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        snapshot.dump(self.path_prefix + '-' + str(self.done) + '.tracemalloc')
+        return snapshot
+
+    def log_top_allocations(self, snapshot):
+        current, peak = tracemalloc.get_traced_memory()
+        self.logger.info('Cycle {0}: traced memory {1:.1f} MiB, peak {2:.1f} MiB'.format(
+            self.done, current / 1024 ** 2, peak / 1024 ** 2))
+        for stat in snapshot.compare_to(self.previous_snapshot, 'lineno')[:TOP_ALLOCATIONS]:
+            self.logger.info('  ' + str(stat))
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Module for asynchronous logging of the master and strategy processes.
+
+Processes put log records into one multiprocessing queue. The listener thread
+of the master takes records from the queue in batches, writes them into log
+files and flushes every file once per batch.
+"""
+import logging
+import logging.handlers
+import queue
+import threading
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class FileRouteFilter(logging.Filter):
+    """Marks records with the name of the file they should be written to."""
+
+    def __init__(self, log_filename):
+        logging.Filter.__init__(self)
+        self.log_filename = log_filename
+
+    def filter(self, record):
+        record.log_filename = self.log_filename
+        return True
+
+
+def create_queue_handler(log_queue, log_filename):
+    """Handler which only puts records of the process into the queue."""
+    handler = logging.handlers.QueueHandler(log_queue)
+    handler.addFilter(FileRouteFilter(log_filename))
+    return handler
+
+
+class BufferedFileHandler(logging.FileHandler):
+    """File handler which does not flush the stream after every record."""
+
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class QueueLogListener:
+    """Thread which writes records from the queue into log files.
+
+    All records which are in the queue (up to batch_size) are written at once
+    and every touched file is flushed once per batch.
+
+    Attributes:
+        log_queue: multiprocessing.Queue shared with all processes
+        default_filename: file for records without log_filename
+        batch_size: maximal amount of records written between flushes
+        handlers: {log_filename: BufferedFileHandler}
+    """
+
+    def __init__(self, log_queue, default_filename, batch_size=1000):
+        self.log_queue = log_queue
+        self.default_filename = default_filename
+        self.batch_size = batch_size
+        self.handlers = {}
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='QueueLogListener')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Write all records which are in the queue and stop the thread."""
+        self.log_queue.put(None)
+        self.thread.join()
+        for handler in self.handlers.values():
+            handler.close()
+
+    def _get_handler(self, log_filename):
+        if log_filename not in self.handlers:
+            handler = BufferedFileHandler(log_filename)
+            handler.setFormatter(logging.Formatter(FORMAT))
+            self.handlers[log_filename] = handler
+        return self.handlers[log_filename]
+
+    def _run(self):
+        isRunning = True
+        while isRunning:
+            batch = [self.log_queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.log_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            touched = set()
+            for record in batch:
+                if record is None:
+                    isRunning = False
+                    continue
+                handler = self._get_handler(getattr(record, 'log_filename', self.default_filename))
+                handler.handle(record)
+                touched.add(handler)
+            for handler in touched:
+                handler.flush()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Module for planning rebalancing migrations with respect to their cost
+"""
+import json
+import os
+
+from . import placement
+
+
+def _write_json(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as plan_file:
+        json.dump(data, plan_file, indent=2)
+    os.replace(tmp_path, path)
+
+
+def save_plans(path, plans):
+    """Write plans of several clusters as one JSON report.
+
+    Args:
+        plans: {cluster_id: Plan}
+    """
+    accepted = [plan for plan in plans.values() if plan.accepted]
+    _write_json(path, {'gain': sum(plan.gain for plan in accepted),
+                       'migrated_memory': sum(plan.get_migrated_memory() for plan in accepted),
+                       'clusters': {str(cluster_id): plan.to_dict() for cluster_id, plan in plans.items()}})
+
+
+def classify(value, threshold, band=0.0, previous=None):
+    """Class of the VM with hysteresis.
+
+    Class is 1 above threshold + band and 0 below threshold - band. Inside
+    the band the previous class is kept, so a VM near the threshold does not
+    flip between cycles.
+    """
+    if previous in [0, 1] and abs(value - threshold) <= band:
+        return previous
+    return 1 if value > threshold else 0
+
+
+def get_gain(value, threshold):
+    """Benefit (0..1] of placing the VM to hosts of its class.
+
+    VMs which are far from the class threshold gain more than VMs near it.
+    """
+    if threshold <= 0:
+        return 1.0
+    return max(1e-6, min(1.0, abs(value - threshold) / threshold))
+
+
+class Plan:
+    """Ordered list of planned migrations.
+
+    Attributes:
+        moves: [{'vm', 'source', 'destination', 'mem_allocated', 'gain', 'cost'}, ...]
+        gain: total gain of moves minus their cost
+        accepted: False if the gain is below the threshold, current placement should be kept
+    """
+
+    def __init__(self, moves, threshold):
+        self.moves = moves
+        self.gain = sum(move['gain'] - move['cost'] for move in moves)
+        self.threshold = threshold
+        self.accepted = len(moves) != 0 and self.gain >= threshold
+
+    def __len__(self):
+        return len(self.moves)
+
+    def get_migrated_memory(self):
+        return sum(move['mem_allocated'] for move in self.moves)
+
+    def to_dict(self):
+        return {'gain': self.gain,
+                'threshold': self.threshold,
+                'accepted': self.accepted,
+                'migrated_memory': self.get_migrated_memory(),
+                'moves': self.moves}
+
+    def save(self, path):
+        """Write the plan as JSON, e.g. to review dry runs."""
+        _write_json(path, self.to_dict())
+
+
+class RebalancePlanner:
+    """Chooses migrations which move VMs to hosts of their class.
+
+    Every move has a cost: move_cost plus memory_cost per GB of migrated
+    memory. A VM is moved only if its gain (see get_gain) is higher than the
+    cost of its move. VMs with the highest net gain are planned first, each
+    of them to the feasible host with the tightest fit. The plan is accepted
+    only if its total net gain reaches threshold, otherwise the current
+    placement is kept.
+
+    Args:
+        move_cost: cost of one migration
+        memory_cost: cost of migration of 1 GB of memory (mem_allocated is in KB)
+        threshold: minimal total net gain of the plan
+    """
+
+    def __init__(self, move_cost=0.0, memory_cost=0.0, threshold=0.0):
+        self.move_cost = move_cost
+        self.memory_cost = memory_cost
+        self.threshold = threshold
+
+    def get_cost(self, mem_allocated):
+        return self.move_cost + self.memory_cost * mem_allocated / 1024.0 ** 2
+
+    def plan(self, groups, host_rows, candidates):
+        """Plan migrations of candidates to hosts of their groups.
+
+        Args:
+            groups: {group: [host_id, ...]}, e.g. hosts of every rank
+            host_rows: {host_id: row with placement.HOST_FIELDS}, rows are not modified
+            candidates: [{'vm': vm_id, 'source': host_id, 'group': group, 'gain': gain,
+                          'row': row with placement.VM_FIELDS}, ...]
+
+        Returns:
+            Plan
+        """
+        host_rows = {host_id: dict(row) for host_id, row in host_rows.items()}
+        engines = {}
+        positions = {}
+        for group, host_ids in groups.items():
+            if not host_ids:
+                continue
+            engines[group] = placement.PlacementEngine([host_rows[host_id] for host_id in host_ids])
+            for index, host_id in enumerate(host_ids):
+                positions[host_id] = (group, index)
+
+        weighted = []
+        for candidate in candidates:
+            cost = self.get_cost(candidate['row']['mem_allocated'])
+            if candidate['gain'] > cost and candidate['group'] in engines:
+                weighted.append((candidate, cost))
+        # Bigger VMs are harder to place, so they go first among equal gains
+        weighted.sort(key=lambda x: (x[0]['gain'] - x[1], x[0]['row']['mem_allocated']), reverse=True)
+
+        moves = []
+        for candidate, cost in weighted:
+            group = candidate['group']
+            _, score = engines[group].evaluate([candidate['row']])
+            index = int(score[0].argmax())
+            if score[0][index] == -float('inf'):
+                continue
+            destination = groups[group][index]
+            for host_id, sign in [(candidate['source'], -1), (destination, 1)]:
+                row = host_rows[host_id]
+                for field in ['cpu_allocated', 'mem_allocated', 'cpu_used', 'mem_used']:
+                    row[field] = row.get(field, 0.0) + sign * candidate['row'].get(field, 0.0)
+                if host_id in positions:
+                    host_group, host_index = positions[host_id]
+                    engines[host_group].set_host(host_index, row)
+            moves.append({'vm': candidate['vm'],
+                          'source': candidate['source'],
+                          'destination': destination,
+                          'mem_allocated': candidate['row']['mem_allocated'],
+                          'gain': candidate['gain'],
+                          'cost': cost})
+        return Plan(moves, self.threshold)
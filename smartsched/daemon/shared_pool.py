@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Module for running many small strategies in one process.
+
+Strategies with execution=shared in their config section are not started
+in processes of their own. SmartDaemon starts one process with SharedPool
+which calls perform_strategy of all of them on a common pool of threads, so
+imported modules, handlers of the process and log handlers of the master
+are shared.
+"""
+import logging
+import os
+import select
+import signal
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import parallel
+from . import profiling
+from . import queue_logging
+from .base_strategy import StreamToLogger
+
+POOL_NAME = 'shared_pool'
+
+
+def create_pool_runner(entries, pool_config, log_queue=None, metrics_queue=None):
+    """Function which runs SharedPool in the process started by the master.
+
+    Args:
+        entries: [(name, target_class, config), ...]
+        pool_config: log_filename, log_name, log_level, shared_pool_size, shared_report_interval
+    """
+    def run_pool():
+        logger = logging.getLogger(pool_config['log_name'])
+        logger.setLevel(logging.getLevelName(pool_config['log_level']))
+        if log_queue is not None:
+            handler = queue_logging.create_queue_handler(log_queue, pool_config['log_filename'])
+        else:
+            handler = logging.FileHandler(pool_config['log_filename'])
+            handler.setFormatter(logging.Formatter(queue_logging.FORMAT))
+        logger.addHandler(handler)
+        sys.stdout = StreamToLogger(logger, logging.INFO)
+        sys.stderr = StreamToLogger(logger, logging.ERROR)
+
+        pool = SharedPool(entries, logger, int(pool_config.get('shared_pool_size', 4)),
+                          float(pool_config.get('shared_report_interval', 300)), log_queue, metrics_queue)
+        pool.run()
+    return run_pool
+
+
+class SharedPool:
+    """Timed cycles of several strategies on one pool of threads.
+
+    Every strategy keeps its own schedule (sleep_time and adaptive interval,
+    see BaseStrategy.get_next_interval) and a cycle of a strategy never
+    overlaps with its previous one. Exception raised by a strategy (in its
+    constructor or in a cycle) is logged and does not affect the others, a
+    failed cycle is retried after sleep_time. Strategies run in managed mode
+    (see BaseStrategy.managed): signals of the process are handled by the
+    pool.
+
+    Resource usage of every strategy (cycles, errors, wall and CPU time of
+    its threads) is logged every report_interval seconds and on shutdown.
+    CPU time covers the pool thread running the cycle and the helper threads
+    of parallel.map_parallel and AsyncBaseStrategy.run_blocking (see
+    parallel.CpuAccount), threads started by the strategy in other ways are
+    not counted. Memory is shared by all strategies and can not be split
+    between them.
+
+    Args:
+        entries: [(name, target_class, config), ...]
+        logger: logger of the pool
+        max_workers: amount of threads, i.e. of cycles running at the same time
+        report_interval: seconds, 0 disables periodical reports
+
+    Attributes:
+        strategies: {name: strategy}
+        usage: {name: {'cycles', 'errors', 'wall', 'cpu', 'last_wall', 'last_cpu'}}
+    """
+
+    def __init__(self, entries, logger, max_workers=4, report_interval=300, log_queue=None, metrics_queue=None):
+        self.logger = logger
+        self.max_workers = max_workers
+        self.report_interval = report_interval
+        self.shutdown = False
+        self.profile_requested = False
+        self.wakeup_all = False
+        self.lock = threading.Lock()
+
+        self.wakeup_pipe = os.pipe()
+        for fd in self.wakeup_pipe:
+            os.set_blocking(fd, False)
+
+        self.strategies = {}
+        self.usage = {}
+        for name, target_class, config in entries:
+            # Logging is configured in constructor, so queue should be known before it
+            target_class.log_queue = log_queue
+            target_class.managed = True
+            try:
+                strategy = target_class(config)
+            except Exception as err:
+                self.logger.error('Strategy ' + name + ' is not started: ' + str(err))
+                self.logger.exception(err)
+                continue
+            strategy.metrics_queue = metrics_queue
+            self.strategies[name] = strategy
+            self.usage[name] = {'cycles': 0, 'errors': 0, 'wall': 0.0, 'cpu': 0.0, 'last_wall': 0.0, 'last_cpu': 0.0}
+
+    def do_shutdown(self, signalnum, handler):
+        self.logger.info('Shutdown signal came to shared pool')
+        self.shutdown = True
+        for strategy in self.strategies.values():
+            strategy.shutdown = True
+            strategy.wake_up()
+        self.wake_up()
+
+    def do_wakeup(self, signalnum, handler):
+        self.wakeup_all = True
+        self.wake_up()
+
+    def do_profile(self, signalnum, handler):
+        self.profile_requested = True
+        self.wake_up()
+
+    def wake_up(self):
+        try:
+            os.write(self.wakeup_pipe[1], b'\0')
+        except OSError:
+            pass
+
+    def perform_cycle(self, name):
+        """Run one cycle of the strategy in a thread of the pool and account its usage."""
+        strategy = self.strategies[name]
+        start_wall = time.monotonic()
+        account = parallel.CpuAccount()
+        try:
+            with account:
+                return strategy.perform_cycle()
+        finally:
+            wall = time.monotonic() - start_wall
+            cpu = account.cpu
+            with self.lock:
+                usage = self.usage[name]
+                usage['cycles'] += 1
+                usage['wall'] += wall
+                usage['cpu'] += cpu
+                usage['last_wall'] = wall
+                usage['last_cpu'] = cpu
+
+    def forward_profile_requests(self):
+        self.profile_requested = False
+        for name, strategy in self.strategies.items():
+            profile_dir = strategy.config.get('profile_dir', profiling.DEFAULT_DIR)
+            if os.path.exists(profiling.get_request_path(profile_dir, name)):
+                self.logger.info('Profiling of ' + name + ' requested')
+                strategy.profile_requested = True
+
+    def report(self):
+        with self.lock:
+            for name in sorted(self.usage):
+                usage = self.usage[name]
+                self.logger.info('{0}: {1} cycles, {2} errors, wall {3:.1f} s, CPU {4:.1f} s, '
+                                 'last cycle: wall {5:.2f} s, CPU {6:.2f} s'.format(
+                                     name, usage['cycles'], usage['errors'], usage['wall'], usage['cpu'],
+                                     usage['last_wall'], usage['last_cpu']))
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.do_shutdown)
+        signal.signal(signal.SIGTERM, self.do_shutdown)
+        signal.signal(signal.SIGUSR1, self.do_wakeup)
+        signal.signal(signal.SIGUSR2, self.do_profile)
+        self.logger.info('Shared pool started with ' + str(len(self.strategies)) + ' strategies: ' +
+                         ', '.join(sorted(self.strategies)))
+
+        for name, strategy in self.strategies.items():
+            try:
+                strategy.restore_checkpoint()
+            except Exception as err:
+                self.logger.error('Checkpoint of ' + name + ' is not restored: ' + str(err))
+
+        now = time.monotonic()
+        next_run = {name: now for name in self.strategies}
+        intervals = {name: strategy.sleep_time for name, strategy in self.strategies.items()}
+        # {name: (future, start time)}
+        running = {}
+        stalled = set()
+        next_report = now + self.report_interval
+        executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=POOL_NAME)
+        while not self.shutdown:
+            now = time.monotonic()
+            for name, (future, started) in list(running.items()):
+                if future.done():
+                    del running[name]
+                    stalled.discard(name)
+                    next_run[name] = self.on_cycle_done(name, future, next_run[name], intervals, now)
+
+            if self.wakeup_all:
+                self.wakeup_all = False
+                for name in next_run:
+                    next_run[name] = min(next_run[name], now)
+            if self.profile_requested:
+                self.forward_profile_requests()
+
+            for name, strategy in self.strategies.items():
+                if name not in running and next_run[name] <= now:
+                    future = executor.submit(self.perform_cycle, name)
+                    future.add_done_callback(lambda future: self.wake_up())
+                    running[name] = (future, now)
+
+            # Threads can not be killed, stalled strategy is only reported
+            for name, (future, started) in running.items():
+                max_cycle_duration = float(self.strategies[name].config.get('max_cycle_duration', 0))
+                if 0 < max_cycle_duration < now - started and name not in stalled:
+                    stalled.add(name)
+                    self.logger.error('{0} is stalled: cycle takes {1:.0f} seconds (limit {2:.0f})'.format(
+                        name, now - started, max_cycle_duration))
+
+            if self.report_interval > 0 and now >= next_report:
+                self.report()
+                next_report = now + self.report_interval
+
+            timeout = next_report - now if self.report_interval > 0 else 3600
+            for name in self.strategies:
+                if name not in running:
+                    timeout = min(timeout, next_run[name] - now)
+            if not self.shutdown and timeout > 0:
+                select.select([self.wakeup_pipe[0]], [], [], timeout)
+            try:
+                while os.read(self.wakeup_pipe[0], 512):
+                    pass
+            except OSError:
+                pass
+
+        self.logger.info('Shared pool: waiting for ' + str(len(running)) + ' running cycles')
+        executor.shutdown(wait=True)
+        for name, strategy in self.strategies.items():
+            try:
+                strategy.logger.info('Initiate shutdown procedure')
+                strategy.before_shutdown()
+            except Exception as err:
+                self.logger.error('Shutdown of ' + name + ' failed: ' + str(err))
+        self.report()
+
+    def on_cycle_done(self, name, future, planned, intervals, now):
+        """Register the finished cycle.
+
+        Returns:
+            time of the next cycle of the strategy
+        """
+        strategy = self.strategies[name]
+        error = future.exception()
+        if error is not None:
+            with self.lock:
+                self.usage[name]['errors'] += 1
+            self.logger.error(name + ' cycle failed: ' + str(error) + '. Retry in ' + str(strategy.sleep_time) +
+                              ' seconds')
+            strategy.logger.error('Cycle failed', exc_info=error)
+            intervals[name] = strategy.sleep_time
+            return now + strategy.sleep_time
+        intervals[name] = strategy.get_next_interval(intervals[name], future.result())
+        # Same schedule as BaseStrategy.run: missed cycles are not repeated
+        return max(planned + intervals[name], now)
@@ -2,24 +2,48 @@
 
 import importlib.machinery
 import configparser
+import os
 import signal
 import sys
 import time
 import logging
+import multiprocessing
 
-from multiprocessing import Process
+from multiprocessing.connection import wait
 
 from . import base_daemon
 from . import base_strategy
+from . import heartbeat
+from . import metrics
+from . import profiling
+from . import queue_logging
+from . import shared_pool
+from . import snapshot_provider
+from . import supervisor
 from smartsched.common import StreamToLogger
 
 CONFIG_PATH = '/etc/smartscheduler/config.cfg'
+# Files written by one instance of a strategy, every worker of a sharded strategy gets its own
+WORKER_FILE_KEYS = ('checkpoint_path', 'plan_path')
+
+
+def get_worker_path(path, index):
+    """File of the worker: /a/plan.json -> /a/plan#1.json"""
+    root, ext = os.path.splitext(path)
+    return root + '#' + str(index) + ext
+
+
+def split_clusters(cluster_list, workers):
+    """Deal clusters round-robin into at most workers shards, none of them is empty."""
+    clusters = [x.strip() for x in cluster_list.split(',') if x.strip()]
+    return [clusters[index::workers] for index in range(min(workers, len(clusters)))]
 
 
 class SmartDaemon(base_daemon.BaseDaemon):
 
     counter = 0
     shutdown = False
+    profile_requested = False
     # config_path = '/etc/smartscheduler/config.cfg'
 
     def __init__(self, pidfile='/tmp/smartscheduler.pid', stdin='/dev/null', stdout='/dev/null', stderr='/dev/null'):
@@ -32,59 +56,345 @@ class SmartDaemon(base_daemon.BaseDaemon):
         handler = logging.FileHandler(self.config['log_filename'])
         self.logger = logging.getLogger(self.config['log_name'])
         self.logger.setLevel(logging.getLevelName(self.config['log_level']))
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        formatter = logging.Formatter(queue_logging.FORMAT)
         handler.setFormatter(formatter)
         self.logger.addHandler(handler)
         
         sl = StreamToLogger(self.logger, logging.ERROR)
         sys.stderr = sl
 
+        # Self-pipe allows to interrupt waiting for child processes by signal handler,
+        # created before the handlers are installed
+        self.wakeup_pipe = os.pipe()
+        for fd in self.wakeup_pipe:
+            os.set_blocking(fd, False)
+
         signal.signal(signal.SIGINT, self.do_shutdown)
         signal.signal(signal.SIGTERM, self.do_shutdown)
+        signal.signal(signal.SIGUSR2, self.do_profile)
 
     def do_shutdown(self, one, two):
         self.logger.info("Shutdown signal came to master")
         self.shutdown = True
+        try:
+            os.write(self.wakeup_pipe[1], b'\0')
+        except (OSError, AttributeError):
+            pass
+
+    def do_profile(self, one, two):
+        self.profile_requested = True
+        try:
+            os.write(self.wakeup_pipe[1], b'\0')
+        except (OSError, AttributeError):
+            pass
+
+    def get_profile_dir(self):
+        return self.config.get('profile_dir', profiling.DEFAULT_DIR)
+
+    def request_profile(self, strategy_name, cycles=None, mode=None):
+        """Ask the running daemon to profile the next cycles of the strategy.
+
+        Called from command line: the request file is written to profile_dir
+        and SIGUSR2 is sent to the master, which passes it to the strategy.
+        """
+        with open(self.pidfile) as pid_file:
+            pid = int(pid_file.read().strip())
+        path = profiling.write_request(self.get_profile_dir(), strategy_name, cycles, mode)
+        os.kill(pid, signal.SIGUSR2)
+        return path
 
     def run(self):
+        self.log_queue = None
+        if self.config.get('log_mode', 'file') == 'queue':
+            self.start_log_listener()
         self.logger.info('SmartDaemon Master process init - Susscess')
 
         self.start_time = time.time()
         self.processes = {}
+        # Names of worker processes of sharded strategies: {strategy: [worker, ...]}
+        self.workers = {}
+        # Names of strategies run by the shared pool process
+        self.shared_strategies = []
+        # Strategies send their metrics through the queue, see start_metrics_aggregator
+        self.metrics_queue = None
+        if 'metrics_path' in self.config:
+            self.metrics_queue = multiprocessing.Queue()
         strategy_list = self.config['strategies'].split(',')
         self.logger.info('Strategies found: ' + str(strategy_list))
+        strategy_configs = {}
         for strategy_name in strategy_list:
             strategy_config_parser = configparser.RawConfigParser()
             strategy_config_parser.read(CONFIG_PATH)
             strategy_config = dict(strategy_config_parser.items(strategy_name))
+            strategy_config['name'] = strategy_name
+            strategy_configs[strategy_name] = strategy_config
+
+        if 'snapshot_path' in self.config:
+            # Snapshot provider is started first, strategies read the snapshot it publishes
+            self.add_strategy('snapshot_provider', snapshot_provider.SnapshotProvider,
+                              self.get_snapshot_provider_config(strategy_configs))
+            for strategy_config in strategy_configs.values():
+                strategy_config.setdefault('snapshot_path', self.config['snapshot_path'])
+        for strategy_config in strategy_configs.values():
+            strategy_config.setdefault('profile_dir', self.get_profile_dir())
+            if self.config.get('checkpoint_dir'):
+                strategy_config.setdefault('checkpoint_dir', self.config['checkpoint_dir'])
 
+        shared_entries = []
+        for strategy_name, strategy_config in strategy_configs.items():
             #strategy = importlib.machinery.SourceFileLoader('strategy', self.config['strategy_path']).load_module()
             strategy_module = importlib.machinery.SourceFileLoader(strategy_name, strategy_config['strategy_path']).load_module()
-            strategy_runner = base_strategy.create_strategy_runner(strategy_module.target_class, strategy_config)
-            self.processes[strategy_name] = Process(target=strategy_runner)
+            for worker_name, worker_config in self.get_worker_configs(strategy_name, strategy_config):
+                if worker_config.get('execution', 'process') == 'shared':
+                    shared_entries.append((worker_name, strategy_module.target_class, worker_config))
+                else:
+                    self.add_strategy(worker_name, strategy_module.target_class, worker_config)
+        if shared_entries:
+            self.add_shared_pool(shared_entries)
 
         for strategy, process in self.processes.items():
             process.start()
-            self.logger.info(strategy + ' started')
+            self.logger.info(strategy + ' started (pid ' + str(process.process.pid) + ')')
+        if self.metrics_queue is not None:
+            self.start_metrics_aggregator()
 
+        health_check_interval = float(self.config.get('health_check_interval', 5))
+        next_health_check = time.monotonic()
         isRunning = True
         while isRunning:
-            self.counter += 1
-            current_time = time.time() - self.start_time
-            for strategy, process in self.processes.items():
-                message = "{0:.6f}".format(current_time) + ': (Health Check) ' + strategy + ' process is '
-                if process.is_alive():
-                    self.logger.info(message + 'OK')
-                else:
-                    self.logger.info(message + 'DEAD')
+            now = time.monotonic()
+            if now >= next_health_check:
+                self.health_check()
+                self.check_stalls()
+                next_health_check = now + health_check_interval
+
+            # Wait for exit of any strategy process, planned restart, health check or signal
+            timeout = next_health_check - now
+            for process in self.processes.values():
+                if process.next_start is not None:
+                    timeout = min(timeout, process.next_start - now)
+                if process.has_exited():
+                    # Reaped by is_alive, its sentinel is not waited on
+                    timeout = 0
+            sentinels = [process.process.sentinel for process in self.processes.values() if process.is_alive()]
+            wait(sentinels + [self.wakeup_pipe[0]], max(0, timeout))
+            try:
+                while os.read(self.wakeup_pipe[0], 512):
+                    pass
+            except OSError:
+                pass
 
-            time.sleep(5)
             if self.shutdown:
                 self.logger.info('Master: About to shutdown')
-                for strategy, process in self.processes.items():
-                    self.logger.info('Terminating ' + strategy + ' process')
-                    process.terminate()
+                self.logger.info('Terminating processes: ' + ', '.join(self.processes))
+                killed = supervisor.terminate_all(self.processes.values(),
+                                                  float(self.config.get('shutdown_timeout', 30)))
+                if killed:
+                    self.logger.error('Killed processes which did not stop in time: ' + ', '.join(killed))
+                if self.metrics_queue is not None:
+                    self.metrics_aggregator.stop()
+                if self.log_queue is not None:
+                    self.stop_log_listener()
                 isRunning = False
+                continue
+
+            for process in self.processes.values():
+                if process.has_exited():
+                    self.on_strategy_exit(process)
+
+            if self.profile_requested:
+                self.forward_profile_requests()
+
+            now = time.monotonic()
+            for strategy, process in self.processes.items():
+                if process.restart_due(now):
+                    process.restart()
+                    self.logger.info(strategy + ' restarted (pid ' + str(process.process.pid) + ', restart ' + str(process.restarts) + ')')
+
+    def start_log_listener(self):
+        """Switch master and strategies to asynchronous logging through the queue."""
+        self.log_queue = multiprocessing.Queue()
+        self.log_listener = queue_logging.QueueLogListener(self.log_queue, self.config['log_filename'],
+                                                           int(self.config.get('log_batch_size', 1000)))
+        self.log_listener.start()
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            handler.close()
+        self.logger.addHandler(queue_logging.create_queue_handler(self.log_queue, self.config['log_filename']))
+
+    def stop_log_listener(self):
+        self.log_listener.stop()
+
+    def start_metrics_aggregator(self):
+        """Export metrics of all strategies to metrics_path in Prometheus text format."""
+        self.metrics_aggregator = metrics.MetricsAggregator(self.metrics_queue, self.config['metrics_path'],
+                                                            float(self.config.get('metrics_interval', 15)),
+                                                            self.processes)
+        self.metrics_aggregator.start()
+        self.logger.info('Metrics are exported to ' + self.config['metrics_path'])
+
+    def add_strategy(self, strategy_name, target_class, strategy_config):
+        strategy_heartbeat = heartbeat.Heartbeat()
+        strategy_runner = base_strategy.create_strategy_runner(target_class, strategy_config, strategy_heartbeat,
+                                                               self.log_queue, self.metrics_queue)
+        self.processes[strategy_name] = supervisor.SupervisedStrategy(
+            strategy_name, strategy_runner, strategy_heartbeat,
+            max_cycle_duration=float(strategy_config.get('max_cycle_duration', 0)),
+            kill_on_stall=strategy_config.get('kill_on_stall', 'no').lower() in ['yes', 'true', 'on', '1'],
+            backoff=float(self.config.get('restart_backoff', 1)),
+            backoff_max=float(self.config.get('restart_backoff_max', 300)),
+            max_restarts=int(self.config.get('max_restarts', 5)),
+            crash_loop_window=float(self.config.get('crash_loop_window', 600)))
+
+    def add_shared_pool(self, entries):
+        """Run strategies with execution=shared in one process, see shared_pool.SharedPool.
+
+        The process is supervised as one strategy named shared_pool and logs to
+        the master log.
+        """
+        pool_config = {'log_filename': self.config['log_filename'],
+                       'log_name': 'SharedPool',
+                       'log_level': self.config['log_level'],
+                       'shared_pool_size': self.config.get('shared_pool_size', '4'),
+                       'shared_report_interval': self.config.get('shared_report_interval', '300')}
+        runner = shared_pool.create_pool_runner(entries, pool_config, self.log_queue, self.metrics_queue)
+        self.processes[shared_pool.POOL_NAME] = supervisor.SupervisedStrategy(
+            shared_pool.POOL_NAME, runner,
+            backoff=float(self.config.get('restart_backoff', 1)),
+            backoff_max=float(self.config.get('restart_backoff_max', 300)),
+            max_restarts=int(self.config.get('max_restarts', 5)),
+            crash_loop_window=float(self.config.get('crash_loop_window', 600)))
+        self.shared_strategies = [name for name, _, _ in entries]
+        self.logger.info('Shared pool runs ' + ', '.join(self.shared_strategies))
+
+    def get_worker_configs(self, strategy_name, strategy_config):
+        """Configs of processes of the strategy.
+
+        With workers=N in the strategy section its cluster_list is split into
+        N shards (see split_clusters) and every shard is handled by its own
+        process named strategy#i, so one slow cluster does not block the
+        others. Workers log to the same log_filename as log_name#i, files
+        listed in WORKER_FILE_KEYS get #i suffix. Each worker is supervised
+        separately.
+
+        Returns:
+            [(process name, config), ...]
+        """
+        workers = int(strategy_config.get('workers', 1))
+        if workers <= 1:
+            return [(strategy_name, strategy_config)]
+        shards = split_clusters(strategy_config.get('cluster_list', ''), workers)
+        if len(shards) <= 1:
+            self.logger.warning(strategy_name + ' has workers=' + str(workers) + ', but ' + str(len(shards)) +
+                                ' clusters, it runs in one process')
+            return [(strategy_name, strategy_config)]
+
+        result = []
+        for index, shard in enumerate(shards):
+            worker_name = strategy_name + '#' + str(index)
+            worker_config = dict(strategy_config)
+            worker_config['name'] = worker_name
+            worker_config['log_name'] = strategy_config['log_name'] + '#' + str(index)
+            worker_config['cluster_list'] = ','.join(shard)
+            for key in WORKER_FILE_KEYS:
+                if worker_config.get(key):
+                    worker_config[key] = get_worker_path(worker_config[key], index)
+            result.append((worker_name, worker_config))
+            self.logger.info(worker_name + ' handles clusters ' + worker_config['cluster_list'])
+        self.workers[strategy_name] = [worker_name for worker_name, _ in result]
+        return result
+
+    def get_snapshot_provider_config(self, strategy_configs):
+        """Config of snapshot provider, by default it covers clusters of all strategies."""
+        cluster_list = self.config.get('snapshot_clusters')
+        if cluster_list is None:
+            clusters = set()
+            for strategy_config in strategy_configs.values():
+                clusters.update(int(x) for x in strategy_config.get('cluster_list', '').split(',') if x.strip())
+            cluster_list = ','.join(str(x) for x in sorted(clusters))
+        return {'name': 'snapshot_provider',
+                'snapshot_path': self.config['snapshot_path'],
+                'profile_dir': self.get_profile_dir(),
+                'trace_path': self.config.get('trace_path', ''),
+                'trace_keyframe_interval': self.config.get('trace_keyframe_interval', '60'),
+                'trace_vm_usage': self.config.get('trace_vm_usage', 'no'),
+                'sleep_time': self.config.get('snapshot_interval', '60'),
+                'cluster_list': cluster_list,
+                'max_parallel_queries': self.config.get('snapshot_parallel_queries', '1'),
+                'log_filename': self.config['log_filename'],
+                'log_name': 'SnapshotProvider',
+                'log_level': self.config['log_level']}
+
+    def forward_profile_requests(self):
+        """Send SIGUSR2 to strategies which have a profile request file."""
+        self.profile_requested = False
+        pool = self.processes.get(shared_pool.POOL_NAME)
+        for strategy in self.shared_strategies:
+            if not os.path.exists(profiling.get_request_path(self.get_profile_dir(), strategy)):
+                continue
+            if pool.is_alive():
+                self.logger.info('Profiling of ' + strategy + ' requested')
+                os.kill(pool.process.pid, signal.SIGUSR2)
+            else:
+                self.logger.warning('Profiling of ' + strategy + ' requested, but shared pool is not running')
+        for strategy, process in self.processes.items():
+            if not os.path.exists(profiling.get_request_path(self.get_profile_dir(), strategy)):
+                continue
+            if process.is_alive():
+                self.logger.info('Profiling of ' + strategy + ' requested')
+                os.kill(process.process.pid, signal.SIGUSR2)
+            else:
+                self.logger.warning('Profiling of ' + strategy + ' requested, but it is not running')
+
+    def on_strategy_exit(self, process):
+        delay = process.on_exit()
+        message = process.name + ' process exited with code ' + str(process.process.exitcode)
+        if process.finished:
+            self.logger.info(message + '. It is finished and is not restarted')
+        elif delay is None:
+            self.logger.error(message + '. It crashed ' + str(len(process.crash_times)) + ' times in ' +
+                              str(process.crash_loop_window) + ' seconds, giving up')
+        else:
+            self.logger.error(message + '. Restart in ' + str(delay) + ' seconds')
+
+    def check_stalls(self):
+        for strategy, process in self.processes.items():
+            duration = process.check_stall()
+            if duration is None:
+                continue
+            message = '{0} is stalled: cycle takes {1:.0f} seconds (limit {2:.0f}), phase: {3}'.format(
+                strategy, duration, process.max_cycle_duration, process.heartbeat.phase())
+            if process.kill_on_stall:
+                self.logger.error(message + '. Killing it')
+                process.kill()
+            else:
+                self.logger.error(message)
+
+    def health_check(self):
+        current_time = time.time() - self.start_time
+        for strategy, process in self.processes.items():
+            message = "{0:.6f}".format(current_time) + ': (Health Check) ' + strategy + ' process is '
+            if process.is_alive() and process.stalled:
+                message += 'STALLED (phase: ' + process.heartbeat.phase() + ')'
+            elif process.is_alive():
+                message += 'OK'
+            elif process.given_up:
+                message += 'DEAD (crash loop)'
+            elif process.finished:
+                message += 'FINISHED'
+            else:
+                message += 'DEAD'
+            self.logger.info(message + ' (uptime {0:.0f}s, restarts {1})'.format(process.uptime(), process.restarts))
+        for strategy, workers in self.workers.items():
+            # Workers run by the shared pool are reported by the pool
+            workers = [worker for worker in workers if worker in self.processes]
+            if not workers:
+                continue
+            alive = [worker for worker in workers if self.processes[worker].is_alive()]
+            stalled = [worker for worker in alive if self.processes[worker].stalled]
+            self.logger.info("{0:.6f}: (Health Check) {1}: {2} of {3} workers are running, {4} stalled".format(
+                current_time, strategy, len(alive), len(workers), len(stalled)))
+
 
 if __name__ == "__main__":
     x = SmartDaemon('/tmp/daemon-example.pid')
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Module for the process which refreshes the shared cluster snapshot
+"""
+import time
+
+import smartsched.common as common
+
+from . import base_strategy
+from . import cluster_snapshot
+from . import parallel
+from . import trace
+
+# Host metrics which are put into the snapshot: (metric, aggregation)
+HOST_METRICS = [('host_cpu_load', 'max'),
+                ('host_mem_used_percent', 'max'),
+                ('host_cpu_count', 'last'),
+                ('host_mem_total_bytes', 'last')]
+
+
+class SnapshotProvider(base_strategy.BaseStrategy):
+    """Strategy which refreshes the shared cluster snapshot.
+
+    It is started by SmartDaemon if snapshot_path is set in the daemon section.
+    Snapshot content:
+        {'time': timestamp,
+         'hosts': {cluster_id: [host, ...]},
+         'vms': [vm, ...],
+         'host_metrics': {host_name: {metric: {time: value}}}}
+
+    If trace_path is set, every snapshot is also appended to the trace for
+    the simulator, with the last usage probe of every running VM if
+    trace_vm_usage is enabled.
+    """
+
+    def __init__(self, config):
+        base_strategy.BaseStrategy.__init__(self, config)
+        self.cluster_list = [int(x) for x in config['cluster_list'].split(',') if x.strip()]
+        self.max_parallel_queries = int(config.get('max_parallel_queries', 1))
+        self.writer = cluster_snapshot.SnapshotWriter(config['snapshot_path'])
+        self.trace_writer = None
+        if config.get('trace_path'):
+            self.trace_writer = trace.TraceWriter(config['trace_path'],
+                                                  int(config.get('trace_keyframe_interval', 60)))
+        self.trace_vm_usage = config.get('trace_vm_usage', 'no').lower() in ['yes', 'true', 'on', '1']
+
+        self.cloud = self.instrument(parallel.PerThreadHandler(common.get_cloud_handler), 'cloud')
+        self.monitoring = self.instrument(parallel.PerThreadHandler(common.get_monitoring_handler), 'monitoring')
+
+    def get_host_metrics(self, host):
+        metrics = {}
+        for metric, aggregation in HOST_METRICS:
+            metrics[metric] = self.monitoring.get_host_load(host['name'], metric, period='5m', group_by='10m',
+                                                            aggregation=aggregation)
+        return metrics
+
+    def get_vm_usage(self, vm):
+        """The last usage probe of the VM: {'cpu': ratio, 'mem': ratio} or None."""
+        rows = self.monitoring.get_ovz_vm(vm['id'], ['mem', 'cpu', 'num_cpu'], limit=1)
+        for row in rows:
+            if 'cpu' in row and 'mem' in row and row.get('num'):
+                return {'cpu': round(row['cpu'] / row['num'] / 100.0, 3),
+                        'mem': round(0.01 * row['mem'], 3)}
+        return None
+
+    def record_trace(self, snapshot):
+        vm_usage = {}
+        if self.trace_vm_usage:
+            running_vms = [vm for vm in snapshot['vms'] if vm['lcm_state'] == 'RUNNING']
+            results = parallel.map_parallel(self.get_vm_usage, [(vm, ) for vm in running_vms],
+                                            self.max_parallel_queries)
+            for vm, (usage, error) in zip(running_vms, results):
+                if usage is not None:
+                    vm_usage[vm['id']] = usage
+        self.trace_writer.write(snapshot, vm_usage)
+
+    def perform_strategy(self):
+        snapshot = {'time': time.time(), 'hosts': {}, 'vms': [], 'host_metrics': {}}
+        try:
+            snapshot['vms'] = self.cloud.get_vms_repr()
+            hosts = []
+            for cluster_id in self.cluster_list:
+                snapshot['hosts'][cluster_id] = self.cloud.get_hosts_of_cluster(cluster_id)
+                hosts.extend(snapshot['hosts'][cluster_id])
+
+            results = parallel.map_parallel(self.get_host_metrics, [(host, ) for host in hosts],
+                                            self.max_parallel_queries)
+            for host, (metrics, error) in zip(hosts, results):
+                if error is not None:
+                    self.logger.error('Failed to get metrics of host ' + str(host['name']) + ': ' + str(error))
+                    continue
+                snapshot['host_metrics'][host['name']] = metrics
+        except Exception as err:
+            # Strategies keep using the previous snapshot until it becomes too old
+            self.logger.error('Failed to refresh cluster snapshot')
+            self.logger.exception(err)
+            return
+
+        self.writer.write(snapshot)
+        self.logger.info('Snapshot published: {0} hosts, {1} vms in {2:.1f} seconds'.format(
+            len(hosts), len(snapshot['vms']), time.time() - snapshot['time']))
+        if self.trace_writer is not None:
+            try:
+                self.record_trace(snapshot)
+            except Exception as err:
+                self.logger.error('Failed to record trace')
+                self.logger.exception(err)
+
+    def before_shutdown(self):
+        self.writer.close()
+        if self.trace_writer is not None:
+            self.trace_writer.close()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Module for supervising strategy processes of SmartDaemon
+"""
+import os
+import signal
+import time
+
+from multiprocessing import Process
+
+
+class SupervisedStrategy:
+    """Strategy process which is restarted with exponential backoff.
+
+    If the process crashes more than max_restarts times within
+    crash_loop_window seconds the strategy is considered to be in a crash
+    loop and is not restarted anymore.
+
+    If the strategy spends more than max_cycle_duration seconds in one cycle
+    (according to its heartbeat) it is considered stalled.
+
+    Attributes:
+        name: strategy (config section) name
+        runner: function which is executed in the strategy process
+        heartbeat: heartbeat.Heartbeat shared with the strategy process or None
+        process: current multiprocessing.Process or None
+        restarts: amount of restarts since the daemon start
+        given_up: True if the strategy is in a crash loop
+        finished: True if the process exited with code 0, it is not a crash and is not restarted
+        stalled: True if the stall of the current cycle is already reported
+        exit_handled: False while exit of the started process is not registered by on_exit
+    """
+
+    def __init__(self, name, runner, heartbeat=None, max_cycle_duration=0, kill_on_stall=False,
+                 backoff=1, backoff_max=300, max_restarts=5, crash_loop_window=600):
+        self.name = name
+        self.runner = runner
+        self.heartbeat = heartbeat
+        self.max_cycle_duration = max_cycle_duration
+        self.kill_on_stall = kill_on_stall
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.max_restarts = max_restarts
+        self.crash_loop_window = crash_loop_window
+
+        self.process = None
+        self.restarts = 0
+        self.started_at = None
+        self.next_start = None
+        self.crash_times = []
+        self.given_up = False
+        self.finished = False
+        self.stalled = False
+        self.exit_handled = True
+
+    def start(self):
+        if self.heartbeat is not None:
+            self.heartbeat.reset()
+        self.stalled = False
+        self.finished = False
+        self.exit_handled = False
+        self.process = Process(target=self.runner, name=self.name)
+        self.process.start()
+        self.started_at = time.monotonic()
+        self.next_start = None
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def has_exited(self):
+        """True if the process has finished and its exit is not handled yet.
+
+        Checked for every process, not only for the ones whose sentinel was
+        ready: is_alive() reaps a finished child, so its exit can be noticed
+        outside of waiting on sentinels.
+        """
+        return self.process is not None and not self.exit_handled and self.process.exitcode is not None
+
+    def uptime(self):
+        if not self.is_alive():
+            return 0
+        return time.monotonic() - self.started_at
+
+    def on_exit(self):
+        """Register exit of the process and plan the restart.
+
+        Clean exit (code 0) is not counted as a crash, the strategy is
+        considered finished and is not restarted.
+
+        Returns:
+            delay in seconds before restart or None if the strategy is given up or finished
+        """
+        self.process.join()
+        self.exit_handled = True
+        if self.process.exitcode == 0:
+            self.finished = True
+            self.next_start = None
+            return None
+        now = time.monotonic()
+        self.crash_times = [crash for crash in self.crash_times if now - crash < self.crash_loop_window]
+        self.crash_times.append(now)
+        if len(self.crash_times) > self.max_restarts:
+            self.given_up = True
+            self.next_start = None
+            return None
+        delay = min(self.backoff_max, self.backoff * 2 ** (len(self.crash_times) - 1))
+        self.next_start = now + delay
+        return delay
+
+    def check_stall(self):
+        """Check duration of the current cycle.
+
+        Returns:
+            duration of the cycle in seconds if it exceeds max_cycle_duration
+            and was not reported yet, None otherwise
+        """
+        if self.heartbeat is None or self.max_cycle_duration <= 0 or not self.is_alive():
+            return None
+        duration = self.heartbeat.cycle_duration()
+        if duration <= self.max_cycle_duration:
+            self.stalled = False
+            return None
+        if self.stalled:
+            return None
+        self.stalled = True
+        return duration
+
+    def kill(self):
+        """Kill stalled strategy. Exit is handled by the master as a crash."""
+        if self.is_alive():
+            os.kill(self.process.pid, signal.SIGKILL)
+
+    def restart_due(self, now):
+        return self.next_start is not None and now >= self.next_start
+
+    def restart(self):
+        self.restarts += 1
+        self.start()
+
+    def terminate(self, timeout=30):
+        """Ask the strategy to stop, kill it if it does not finish in timeout seconds."""
+        return terminate_all([self], timeout)
+
+
+def terminate_all(strategies, timeout=30):
+    """Stop strategies at the same time.
+
+    SIGTERM is sent to all of them first, then they are waited for until the
+    common deadline, so shutdown takes at most timeout seconds however many
+    strategies hang. Strategies which are still running are killed.
+
+    Returns:
+        names of killed strategies
+    """
+    running = [strategy for strategy in strategies if strategy.is_alive()]
+    for strategy in running:
+        strategy.process.terminate()
+    deadline = time.monotonic() + timeout
+    for strategy in running:
+        strategy.process.join(max(0, deadline - time.monotonic()))
+    killed = []
+    for strategy in running:
+        if strategy.is_alive():
+            os.kill(strategy.process.pid, signal.SIGKILL)
+            strategy.process.join()
+            killed.append(strategy.name)
+    return killed
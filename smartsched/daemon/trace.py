@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Module for recorded traces of cluster state.
+
+A trace is a sequence of cluster snapshots (see snapshot_provider) with
+optional usage of VMs. It is recorded by the snapshot provider if trace_path
+is set in the daemon section and replayed by the simulator.
+
+File layout: file header (magic, format version) followed by frames. Every
+frame has a header (timestamp, frame type, payload length) and zlib
+compressed pickled payload. Key frames contain the full state, delta frames
+only entries which were changed or removed since the previous frame, so a
+cluster where few VMs change per minute takes little space. Key frames are
+written every keyframe_interval frames and at the start of every recording.
+
+Payload: {'clusters': {cluster_id: [host_id, ...]},
+          'hosts': (changed, removed), 'vms': (changed, removed),
+          'host_metrics': (changed, removed), 'vm_usage': (changed, removed)}
+where changed is {key: value} and removed is [key, ...].
+"""
+import os
+import pickle
+import struct
+import zlib
+
+MAGIC = b'SSTR'
+FORMAT_VERSION = 1
+FILE_HEADER = struct.Struct('<4sI')
+FRAME_HEADER = struct.Struct('<dBI')
+KEY_FRAME = 0
+DELTA_FRAME = 1
+MAPS = ['hosts', 'vms', 'host_metrics', 'vm_usage']
+
+
+class TraceError(Exception):
+    pass
+
+
+def _diff(previous, current):
+    changed = {}
+    for key, value in current.items():
+        if key not in previous or previous[key] != value:
+            changed[key] = value
+    removed = [key for key in previous if key not in current]
+    return changed, removed
+
+
+def _snapshot_maps(snapshot, vm_usage):
+    """Cluster snapshot as maps by key: hosts by id, VMs by id, metrics by host name."""
+    clusters = {}
+    hosts = {}
+    for cluster_id, cluster_hosts in snapshot['hosts'].items():
+        clusters[cluster_id] = [host['id'] for host in cluster_hosts]
+        for host in cluster_hosts:
+            hosts[host['id']] = host
+    return clusters, {'hosts': hosts,
+                      'vms': {vm['id']: vm for vm in snapshot['vms']},
+                      'host_metrics': dict(snapshot['host_metrics']),
+                      'vm_usage': dict(vm_usage or {})}
+
+
+class TraceWriter:
+    """Appends snapshots to the trace file.
+
+    Args:
+        keyframe_interval: amount of frames between key frames
+    """
+
+    def __init__(self, path, keyframe_interval=60, compression_level=6):
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self.compression_level = compression_level
+        self.previous = None
+        self.frames = 0
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(FILE_HEADER.pack(MAGIC, FORMAT_VERSION))
+        else:
+            # Previous recording could be interrupted in the middle of a frame
+            self.file.truncate(_get_complete_length(path))
+            self.file.seek(0, os.SEEK_END)
+
+    def write(self, snapshot, vm_usage=None):
+        """Append the snapshot.
+
+        Args:
+            snapshot: {'time': timestamp, 'hosts': {cluster_id: [host, ...]},
+                       'vms': [vm, ...], 'host_metrics': {host_name: ...}}
+            vm_usage: {vm_id: {'cpu': ratio, 'mem': ratio}}
+        """
+        clusters, current = _snapshot_maps(snapshot, vm_usage)
+        frame_type = DELTA_FRAME
+        if self.previous is None or self.frames % self.keyframe_interval == 0:
+            frame_type = KEY_FRAME
+            previous = {name: {} for name in MAPS}
+        else:
+            previous = self.previous
+        payload = {'clusters': clusters}
+        for name in MAPS:
+            payload[name] = _diff(previous[name], current[name])
+        data = zlib.compress(pickle.dumps(payload, pickle.HIGHEST_PROTOCOL), self.compression_level)
+        self.file.write(FRAME_HEADER.pack(snapshot['time'], frame_type, len(data)))
+        self.file.write(data)
+        self.file.flush()
+        self.previous = current
+        self.frames += 1
+
+    def close(self):
+        self.file.close()
+
+
+def _check_header(header, path):
+    if len(header) != FILE_HEADER.size:
+        raise TraceError('Trace file ' + path + ' is too short')
+    magic, version = FILE_HEADER.unpack(header)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise TraceError('Unknown trace format in ' + path)
+
+
+def _get_complete_length(path):
+    """Length of the file without incomplete last frame."""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as trace_file:
+        _check_header(trace_file.read(FILE_HEADER.size), path)
+        position = FILE_HEADER.size
+        while True:
+            header = trace_file.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                return position
+            length = FRAME_HEADER.unpack(header)[2]
+            if position + FRAME_HEADER.size + length > size:
+                return position
+            position += FRAME_HEADER.size + length
+            trace_file.seek(position)
+
+
+class TraceReader:
+    """Replays the trace file frame by frame.
+
+    Usage:
+        for frame in trace.TraceReader(path):
+            frame['time'], frame['vms'][vm_id], frame['changes']['vms']
+
+    Frame content:
+        {'time': timestamp,
+         'key_frame': True if the frame is a key frame,
+         'hosts': {cluster_id: [host, ...]},
+         'vms': {vm_id: vm},
+         'host_metrics': {host_name: {metric: log}},
+         'vm_usage': {vm_id: {'cpu': ratio, 'mem': ratio}},
+         'changes': {map_name: (changed_keys, removed_keys)}}
+
+    Maps of the frame are updated in place by the next frame, so they should
+    be copied if they are needed later.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        state = {name: {} for name in MAPS}
+        with open(self.path, 'rb') as trace_file:
+            _check_header(trace_file.read(FILE_HEADER.size), self.path)
+            while True:
+                header = trace_file.read(FRAME_HEADER.size)
+                if len(header) < FRAME_HEADER.size:
+                    # The last frame may be incomplete if the recording was interrupted
+                    return
+                timestamp, frame_type, length = FRAME_HEADER.unpack(header)
+                data = trace_file.read(length)
+                if len(data) < length:
+                    return
+                payload = pickle.loads(zlib.decompress(data))
+
+                changes = {}
+                for name in MAPS:
+                    if frame_type == KEY_FRAME:
+                        state[name] = {}
+                    changed, removed = payload[name]
+                    state[name].update(changed)
+                    for key in removed:
+                        state[name].pop(key, None)
+                    changes[name] = (list(changed), removed)
+
+                hosts = {}
+                for cluster_id, host_ids in payload['clusters'].items():
+                    hosts[cluster_id] = [state['hosts'][host_id] for host_id in host_ids if host_id in state['hosts']]
+                yield {'time': timestamp,
+                       'key_frame': frame_type == KEY_FRAME,
+                       'hosts': hosts,
+                       'vms': state['vms'],
+                       'host_metrics': state['host_metrics'],
+                       'vm_usage': state['vm_usage'],
+                       'changes': changes}
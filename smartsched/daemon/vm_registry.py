@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Module for VM registry shared by strategies
+"""
+
+
+def iter_id_ranges(vm_ids, page_size=500, max_gap=None):
+    """Split VM ids into (startId, endId) ranges for paginated requests.
+
+    A range holds at most page_size of the ids. It is also closed when the
+    next id is more than max_gap (page_size by default) away from the last
+    one, so a page does not drag VMs of other clusters between distant ids.
+    """
+    if max_gap is None:
+        max_gap = page_size
+    vm_ids = sorted(set(int(vm_id) for vm_id in vm_ids))
+    start = None
+    count = 0
+    for index, vm_id in enumerate(vm_ids):
+        if start is None:
+            start = vm_id
+        count += 1
+        last = index == len(vm_ids) - 1
+        if last or count >= page_size or vm_ids[index + 1] - vm_id > max_gap:
+            yield start, vm_id
+            start = None
+            count = 0
+
+
+def iter_vm_pages(cloud, vm_ids, page_size=500, max_gap=None, vmStateFilter=-1):
+    """Fetch VMs with given ids page by page.
+
+    Every page is one get_vms_repr call for a range of ids (see
+    iter_id_ranges), state is filtered by the cloud. VMs of the range which
+    are not listed in vm_ids are dropped before the page is yielded.
+
+    Yields:
+        lists of VMs
+    """
+    wanted = set(int(vm_id) for vm_id in vm_ids)
+    for start, end in iter_id_ranges(wanted, page_size, max_gap):
+        vms = cloud.get_vms_repr(startId=start, endId=end, vmStateFilter=vmStateFilter)
+        yield [vm for vm in vms if int(vm['id']) in wanted]
+
+
+class VMRegistry:
+    """Representations of VMs indexed by VM id.
+
+    The registry is filled by one bulk get_vms_repr call per cycle and gives
+    O(1) lookups afterwards. VMs which are missing in the registry are fetched
+    together by a few follow-up requests of bounded id ranges instead of one
+    get_vm_repr call per VM.
+
+    Attributes:
+        cloud: cloud handler from smartsched.common
+        logger: logger of the strategy which owns the registry
+        vms: {vm_id: vm_repr}
+    """
+
+    def __init__(self, cloud, logger=None):
+        self.cloud = cloud
+        self.logger = logger
+        self.vms = {}
+        # VMs which were not found even after follow-up fetch
+        self.unknown_ids = set()
+
+    def __contains__(self, vm_id):
+        return int(vm_id) in self.vms
+
+    def __len__(self):
+        return len(self.vms)
+
+    def refresh(self, **kwargs):
+        """Replace content of the registry by the result of one get_vms_repr call.
+
+        Args:
+            kwargs: passed to cloud.get_vms_repr as is (startId, endId, vmStateFilter)
+
+        Returns:
+            list of fetched VMs
+        """
+        vms = self.cloud.get_vms_repr(**kwargs)
+        self.reset(vms)
+        return vms
+
+    def stream(self, vm_ids, page_size=500, max_gap=None, vmStateFilter=-1):
+        """Replace content of the registry by VMs with given ids fetched page by page.
+
+        Only listed VMs are kept, so memory and transfer depend on the amount
+        of requested VMs rather than on the size of the whole cloud. The
+        registry is filled while the result is consumed.
+
+        Yields:
+            fetched VMs one by one
+        """
+        self.vms = {}
+        self.unknown_ids = set()
+        pages = 0
+        for page in iter_vm_pages(self.cloud, vm_ids, page_size, max_gap, vmStateFilter):
+            pages += 1
+            self.add(page)
+            for vm in page:
+                yield vm
+        if self.logger:
+            self.logger.debug('Fetched ' + str(len(self.vms)) + ' VMs in ' + str(pages) + ' pages')
+
+    def reset(self, vms):
+        """Replace content of the registry by already fetched VMs (e.g. from cluster snapshot)."""
+        self.vms = {}
+        self.unknown_ids = set()
+        self.add(vms)
+
+    def add(self, vms):
+        """Put already fetched VMs into the registry."""
+        for vm in vms:
+            self.vms[int(vm['id'])] = vm
+
+    def values(self):
+        return self.vms.values()
+
+    def get(self, vm_id):
+        """Return VM by id or None if cloud does not know such VM."""
+        vm_id = int(vm_id)
+        if vm_id not in self.vms:
+            self.prefetch([vm_id])
+        return self.vms.get(vm_id)
+
+    def get_many(self, vm_ids):
+        """Return list of VMs for given ids. Unknown VMs are skipped."""
+        vm_ids = [int(vm_id) for vm_id in vm_ids]
+        self.prefetch(vm_ids)
+        return [self.vms[vm_id] for vm_id in vm_ids if vm_id in self.vms]
+
+    def prefetch(self, vm_ids, page_size=500, max_gap=None):
+        """Fetch all VMs missing in the registry.
+
+        Missing ids are grouped into bounded ranges (see iter_id_ranges), one
+        request per range, so a few distant ids do not fetch the whole cloud.
+        """
+        missing = set()
+        for vm_id in vm_ids:
+            vm_id = int(vm_id)
+            if vm_id not in self.vms and vm_id not in self.unknown_ids:
+                missing.add(vm_id)
+        if not missing:
+            return
+
+        if self.logger:
+            self.logger.info('Fetching ' + str(len(missing)) + ' VMs missing in registry')
+        for page in iter_vm_pages(self.cloud, missing, page_size, max_gap, vmStateFilter=-2):
+            self.add(page)
+
+        not_found = missing.difference(self.vms)
+        if not_found:
+            self.unknown_ids.update(not_found)
+            if self.logger:
+                self.logger.info('No vm found with id ' + ', '.join(str(x) for x in sorted(not_found)))
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Module for vectorized usage statistics of VMs.
+
+Monitoring rows are converted into NumPy arrays, corrupted probes become
+NaN. Raw probes of every VM are kept for the window, and statistics of all
+VMs are calculated in one batch: probes are put into a (vms, probes) matrix
+padded with NaN, so NaN-aware reductions work on all VMs at once.
+"""
+import calendar
+import datetime
+import warnings
+
+import numpy as np
+
+METRICS = ('cpu', 'mem')
+# Besides these, percentiles are given as 'p' followed by a number, e.g. 'p95' or 'p99.9'
+STATISTICS = ('mean', 'min', 'max', 'ewma')
+
+
+def check_statistic(name):
+    """Raise ValueError if the statistic is unknown."""
+    if name in STATISTICS:
+        return
+    if name.startswith('p'):
+        try:
+            if 0 <= float(name[1:]) <= 100:
+                return
+        except ValueError:
+            pass
+    raise ValueError('Unknown statistic ' + str(name) + ', expected one of ' + ', '.join(STATISTICS) +
+                     ' or percentile like p95')
+
+
+def to_timestamp(value):
+    """Convert probe time to unix timestamp.
+
+    Monitoring may return time as datetime, as number of seconds (or
+    nanoseconds) since epoch or as ISO 8601 string like
+    '2018-10-10T10:00:00.123456789Z'. None is returned for unknown values.
+    """
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+    if isinstance(value, (int, float)):
+        # Influx returns epoch in nanoseconds if precision is not specified
+        while value > 1e11:
+            value = value / 1000.0
+        return float(value)
+    try:
+        value = str(value).rstrip('Z')
+        fraction = ''
+        if '.' in value:
+            value, fraction = value.split('.', 1)
+        parsed = datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        return None
+    timestamp = float(calendar.timegm(parsed.utctimetuple()))
+    if fraction.isdigit():
+        timestamp += float('0.' + fraction)
+    return timestamp
+
+
+def to_timestamps(values):
+    """Convert probe times to unix timestamps, NaN for unknown values.
+
+    ISO 8601 strings are parsed by NumPy at once, other values one by one
+    (see to_timestamp).
+    """
+    if len(values) and all(isinstance(value, str) for value in values):
+        try:
+            parsed = np.array([value.rstrip('Z') for value in values], dtype='datetime64[ns]')
+            return parsed.astype(np.int64) / 1e9
+        except ValueError:
+            pass
+    timestamps = [to_timestamp(value) for value in values]
+    return np.array([np.nan if timestamp is None else timestamp for timestamp in timestamps], dtype=np.float64)
+
+
+def parse_rows(rows, cpu_allocated, now):
+    """Convert monitoring rows of one VM into arrays.
+
+    CPU and MEM usage ratio is stored: 0 <= ratio <= 1. Probes without cpu,
+    mem or num are corrupted and have NaN values.
+
+    Args:
+        rows: [{'time': t, 'cpu': percent of all cores, 'mem': percent, 'num': cores}, ...]
+        cpu_allocated: is used instead of num equal to 0
+        now: is used as time of probes without time
+
+    Returns:
+        (timestamps, {'cpu': array, 'mem': array}, True if all probes have time)
+    """
+    cpu = np.full(len(rows), np.nan)
+    mem = np.full(len(rows), np.nan)
+    for index, row in enumerate(rows):
+        # Some probes are corrupted. We need to ignore them.
+        if 'cpu' not in row or 'mem' not in row or 'num' not in row:
+            continue
+        # Sometimes number of cores is equal to 0 which is wrong. It happens if VM require a
+        # fraction of a core, like 0.3 core.
+        num = row['num'] if row['num'] else cpu_allocated
+        cpu[index] = row['cpu'] / num / 100.0  # CPU is measured in 0.0 < 1.0 range
+        mem[index] = 0.01 * row['mem']         # Mem is measured in 0.0 < 100.0 range
+    timestamps = to_timestamps([row.get('time') for row in rows])
+    unknown = np.isnan(timestamps)
+    timestamps[unknown] = now
+    return timestamps, {'cpu': cpu, 'mem': mem}, not unknown.any()
+
+
+def _matrix(arrays):
+    """Put 1D arrays as rows of a matrix padded with NaN."""
+    lengths = np.array([len(array) for array in arrays], dtype=np.int64)
+    matrix = np.full((len(arrays), max(lengths.max(), 1) if len(arrays) else 1), np.nan)
+    if lengths.sum():
+        rows = np.repeat(np.arange(len(arrays)), lengths)
+        columns = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        matrix[rows, columns] = np.concatenate(arrays)
+    return matrix
+
+
+def ewma(matrix, alpha):
+    """Exponentially weighted moving average of every row, NaN values are skipped."""
+    result = np.full(matrix.shape[0], np.nan)
+    for column in matrix.T:
+        present = ~np.isnan(column)
+        started = ~np.isnan(result)
+        update = present & started
+        result[update] = alpha * column[update] + (1 - alpha) * result[update]
+        first = present & ~started
+        result[first] = column[first]
+    return result
+
+
+def compute(matrix, statistics, alpha=0.3):
+    """Statistics of every row of the matrix, NaN values are ignored.
+
+    Returns:
+        {statistic: array with one value per row}, NaN for rows without values
+    """
+    result = {}
+    with warnings.catch_warnings(), np.errstate(invalid='ignore'):
+        # All-NaN rows give NaN with RuntimeWarning
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for name in statistics:
+            if name == 'mean':
+                result[name] = np.nanmean(matrix, axis=1)
+            elif name == 'min':
+                result[name] = np.nanmin(matrix, axis=1)
+            elif name == 'max':
+                result[name] = np.nanmax(matrix, axis=1)
+            elif name == 'ewma':
+                result[name] = ewma(matrix, alpha)
+            else:
+                result[name] = np.nanpercentile(matrix, float(name[1:]), axis=1)
+    return result
+
+
+class UsageWindow:
+    """Raw usage probes of many VMs for the last window seconds.
+
+    Attributes:
+        window: length of the window in seconds
+        entries: {key: {'last_seen': timestamp, 'time': array, 'cpu': array, 'mem': array}}
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.entries = {}
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def last_seen(self, key):
+        """Timestamp of the newest merged probe or None."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        return entry['last_seen']
+
+    def merge(self, key, timestamps, values, incremental=True):
+        """Add new probes of the object.
+
+        Args:
+            key: object id
+            timestamps: array of probe times
+            values: {metric: array}, NaN marks corrupted probe which only moves last_seen forward
+            incremental: if False previous probes of the object are replaced and the next
+                fetch should be full (last_seen stays None)
+
+        Returns:
+            amount of merged valid probes
+        """
+        if not incremental or key not in self.entries:
+            self.entries[key] = {'last_seen': None, 'time': np.empty(0)}
+            for metric in METRICS:
+                self.entries[key][metric] = np.empty(0)
+        entry = self.entries[key]
+
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        new = np.ones(len(timestamps), dtype=bool)
+        if entry['last_seen'] is not None:
+            new = timestamps > entry['last_seen']
+        order = np.argsort(timestamps[new], kind='stable')
+        new_timestamps = timestamps[new][order]
+        if incremental and len(new_timestamps):
+            entry['last_seen'] = float(new_timestamps[-1])
+
+        valid = np.ones(len(new_timestamps), dtype=bool)
+        new_values = {}
+        for metric in METRICS:
+            new_values[metric] = np.asarray(values[metric], dtype=np.float64)[new][order]
+            valid &= ~np.isnan(new_values[metric])
+        entry['time'] = np.concatenate([entry['time'], new_timestamps[valid]])
+        for metric in METRICS:
+            entry[metric] = np.concatenate([entry[metric], new_values[metric][valid]])
+        return int(valid.sum())
+
+    def expire(self, now):
+        """Drop probes which are out of the window."""
+        border = now - self.window
+        for entry in self.entries.values():
+            if len(entry['time']) and entry['time'][0] < border:
+                keep = entry['time'] >= border
+                for field in ('time', ) + METRICS:
+                    entry[field] = entry[field][keep]
+
+    def retain(self, keys):
+        """Forget all objects except listed ones."""
+        keys = set(keys)
+        for key in list(self.entries):
+            if key not in keys:
+                del self.entries[key]
+
+    def aggregate(self, keys, statistics=('mean', 'min', 'max'), alpha=0.3):
+        """Statistics of all listed objects in one batch.
+
+        Args:
+            statistics: names from STATISTICS or percentiles like 'p95'
+            alpha: smoothing factor of ewma, weight of the newest probe
+
+        Returns:
+            {key: {'count': n, metric: {statistic: value}}} with None for
+            objects without valid probes in the window
+        """
+        keys = list(keys)
+        result = {}
+        present = [key for key in keys if key in self.entries and len(self.entries[key]['time'])]
+        for key in keys:
+            result[key] = None
+        if not present:
+            return result
+        counts = [len(self.entries[key]['time']) for key in present]
+        values = {}
+        for metric in METRICS:
+            values[metric] = compute(_matrix([self.entries[key][metric] for key in present]), statistics, alpha)
+        for index, key in enumerate(present):
+            stats = {'count': counts[index]}
+            for metric in METRICS:
+                stats[metric] = {}
+                for name in statistics:
+                    stats[metric][name] = float(values[metric][name][index])
+            result[key] = stats
+        return result
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Module for host load report, an example of asyncio based strategy
+"""
+import smartsched.common as common
+import smartsched.daemon.async_strategy as async_strategy
+import smartsched.daemon.snapshot_provider as snapshot_provider
+
+
+class HostLoadStrategy(async_strategy.AsyncBaseStrategy):
+    """Logs CPU and MEM load of all hosts of cluster_list.
+
+    Hosts of all clusters and metrics of all hosts are queried at the same
+    time, so the cycle takes about as long as the slowest query.
+    """
+
+    def __init__(self, config):
+        async_strategy.AsyncBaseStrategy.__init__(self, config)
+        self.cluster_list = [int(x) for x in config['cluster_list'].split(',')]
+        self.cloud = self.instrument(common.get_cloud_handler(), 'cloud')
+        self.monitoring = self.instrument(common.get_monitoring_handler(), 'monitoring')
+
+    async def perform_strategy(self):
+        with self.phase('get_hosts'):
+            results = await self.map_blocking(self.cloud.get_hosts_of_cluster,
+                                              [(cluster_id, ) for cluster_id in self.cluster_list])
+        hosts = []
+        for cluster_id, (cluster_hosts, error) in zip(self.cluster_list, results):
+            if error is not None:
+                self.logger.error('Failed to get hosts of cluster ' + str(cluster_id) + ': ' + str(error))
+                continue
+            hosts.extend(cluster_hosts)
+
+        args_list = [(host['name'], metric, '5m', '10m', aggregation)
+                     for host in hosts for metric, aggregation in snapshot_provider.HOST_METRICS[:2]]
+        with self.phase('get_host_load'):
+            loads = await self.map_blocking(self.monitoring.get_host_load, args_list)
+        for index, host in enumerate(hosts):
+            values = []
+            for load, error in loads[2 * index:2 * index + 2]:
+                values.append(max(load.values()) if error is None and load else None)
+            self.logger.info('Host {0}: CPU load {1}, MEM used {2}%'.format(host['name'], values[0], values[1]))
+
+
+target_class = HostLoadStrategy
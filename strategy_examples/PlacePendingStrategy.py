@@ -6,11 +6,17 @@ import sys
 
 import logging
 import smartsched.daemon.base_strategy as base_strategy
+import smartsched.daemon.cluster_snapshot as cluster_snapshot
+import smartsched.daemon.pending_queue as pending_queue
+import smartsched.daemon.placement as placement
+import smartsched.daemon.snapshot_provider as snapshot_provider
+import smartsched.daemon.vm_registry as vm_registry
 import smartsched.common as common
 
 RESOLVED_STATES = ['RUNNING', 'FAILURE']
 
 class PlacePendingStrategy(base_strategy.BaseStrategy):
+    checkpoint_version = 4
     # Allowed achievable overcommit
     cpu_max_ovc = 3
     mem_max_ovc = 2
@@ -23,12 +29,23 @@ class PlacePendingStrategy(base_strategy.BaseStrategy):
 
     # Matrix for all possible deployments of all pending VMs
     deploy_mesh = []
+    # Host snapshots and placement engines the mesh was built from: {cluster_key: {...}}
+    mesh_clusters = {}
+    mesh_built_time = 0
+    # seconds, mesh is rebuilt from fresh snapshot when it is older, reservations of deploying VMs are kept
+    mesh_max_age = 600
+
+    # Shared cluster snapshot of the current mesh or None
+    cluster_snapshot = None
 
     isDeploying = False
-    current_vm = None
-    current_host = None
-    # Count deploy time and compare with TIME_COUNT_MAX
-    deploying_time_count = 0
+    # Amount of VMs which could be deployed at the same time
+    max_parallel_deploys = 1
+    # VMs which are being deployed: {vm_id: {'entry': mesh_entry, 'host_id': id, 'host_index': i, 'started': time}}
+    deploying = {}
+    # Deployed VMs whose allocation may be not visible in the host snapshots yet:
+    # {vm_id: {..., 'finished': time}}, see carry_reservations
+    deployed = {}
 
     def __init__(self, config):
         base_strategy.BaseStrategy.__init__(self, config)
@@ -39,53 +56,105 @@ class PlacePendingStrategy(base_strategy.BaseStrategy):
         self.cluster_list = [int(x) for x in config['cluster_list'].split(',')]
 
         # Get parameters
-        self.cpu_max_ovc = config['cpu_max_ovc']
-        self.mem_max_ovc = config['mem_max_ovc']
-        self.cpu_max_usage = config['cpu_max_usage']
-        self.mem_max_usage = config['mem_max_usage']
-        self.fresh_vm_timeframe = config['fresh_vm_timeframe'] # hours
-        self.deploy_waiting_time = config['deploy_waiting_time'] # seconds
+        self.cpu_max_ovc = float(config['cpu_max_ovc'])
+        self.mem_max_ovc = float(config['mem_max_ovc'])
+        self.cpu_max_usage = float(config['cpu_max_usage'])
+        self.mem_max_usage = float(config['mem_max_usage'])
+        self.fresh_vm_timeframe = float(config['fresh_vm_timeframe']) # hours
+        self.deploy_waiting_time = int(config['deploy_waiting_time']) # seconds
+        self.max_parallel_deploys = int(config.get('max_parallel_deploys', 1))
+        self.mesh_max_age = int(config.get('mesh_max_age', 600)) # seconds
+        self.deploy_mesh = []
+        self.mesh_clusters = {}
+        self.deploying = {}
+        self.deployed = {}
+        # Pending VMs are deployed in order of pending_priority to the best host by host_ranking
+        self.pending_queue = pending_queue.PendingQueue(config.get('pending_priority', 'age'),
+                                                       pending_queue.parse_weights(config.get('pending_weights', '')))
+        self.host_ranking = config.get('host_ranking', 'best_fit')
+        if self.host_ranking not in placement.RANKINGS:
+            raise ValueError('Unknown host_ranking ' + self.host_ranking + ', expected one of ' +
+                             ', '.join(placement.RANKINGS))
 
-        sl = common.StreamToLogger(self.logger, logging.INFO)
-        sys.stdout = sl
+        if not self.managed:
+            sl = common.StreamToLogger(self.logger, logging.INFO)
+            sys.stdout = sl
 
-        sl = common.StreamToLogger(self.logger, logging.ERROR)
-        sys.stderr = sl
+            sl = common.StreamToLogger(self.logger, logging.ERROR)
+            sys.stderr = sl
 
-        self.cloud = common.get_cloud_handler()
-        self.influx_handler = common.get_monitoring_handler()
+        self.cloud = self.instrument(common.get_cloud_handler(), 'cloud')
+        self.influx_handler = self.instrument(common.get_monitoring_handler(), 'monitoring')
+        self.vm_registry = vm_registry.VMRegistry(self.cloud, self.logger)
 
     def perform_strategy(self):
         try:
-            if self.deploy_mesh == [] and not self.isDeploying:
-                self.logger.info('Build deploy mesh')
-                self.build_deploy_mesh()
-                return
+            if self.isDeploying:
+                self.logger.info('Check deploying process')
+                with self.phase('check_deploy'):
+                    self.check_deploy()
         except Exception as err:
-            self.logger.error("Error during build_deploy_mesh")
+            self.logger.error("Error during check_deploy")
             self.logger.exception(err)
 
         try:
-            if self.deploy_mesh != [] and not self.isDeploying:
-                self.logger.info('Try to deploy vm')
-                self.try_deploy()
-                return
+            mesh_expired = self.clock.time() - self.mesh_built_time > self.mesh_max_age
+            if (self.deploy_mesh == [] and not self.isDeploying) or mesh_expired:
+                self.logger.info('Build deploy mesh')
+                with self.phase('build_deploy_mesh'):
+                    self.build_deploy_mesh()
         except Exception as err:
-            self.logger.error("Error during try_deploy")
+            self.logger.error("Error during build_deploy_mesh")
             self.logger.exception(err)
 
         try:
-            if self.isDeploying:
-                self.logger.info('Check deploying process')
-                self.check_deploy()
-                return
+            if self.deploy_mesh != [] and len(self.deploying) < self.max_parallel_deploys:
+                self.logger.info('Try to deploy vm')
+                with self.phase('try_deploy'):
+                    self.try_deploy()
         except Exception as err:
             self.logger.error("Error during try_deploy")
             self.logger.exception(err)
 
+        # Check deploying VMs and use the rest of the mesh sooner
+        return self.isDeploying or self.deploy_mesh != []
+
+    def get_checkpoint_state(self):
+        # Placement engines are rebuilt from host snapshots, deploying entries share
+        # objects with the mesh and the snapshots, pickle keeps these references.
+        return {'deploy_mesh': self.deploy_mesh,
+                'mesh_snapshots': {key: cluster['snapshot'] for key, cluster in self.mesh_clusters.items()},
+                'mesh_built_time': self.mesh_built_time,
+                'deploying': self.deploying,
+                'deployed': self.deployed,
+                'first_seen': self.pending_queue.first_seen}
+
+    def restore_checkpoint_state(self, state, age):
+        self.deploy_mesh = state['deploy_mesh']
+        self.mesh_clusters = {}
+        for cluster_key, snapshot in state['mesh_snapshots'].items():
+            self.mesh_clusters[cluster_key] = {'snapshot': snapshot,
+                                               'engine': placement.PlacementEngine(snapshot)}
+        self.mesh_built_time = state['mesh_built_time']
+        self.deploying = state['deploying']
+        self.deployed = state['deployed']
+        self.isDeploying = len(self.deploying) != 0
+        self.pending_queue.first_seen = state['first_seen']
+        self.logger.info('Restored {0} deploying VMs and {1} mesh entries'.format(len(self.deploying),
+                                                                                 len(self.deploy_mesh)))
+
     def build_deploy_mesh(self):
         pending_vm_list = self.cloud.get_pending_unscheduled()
         self.logger.info('There are ' + str(len(pending_vm_list)) + ' pending machines')
+        # All VMs are fetched by one request (or taken from the shared cluster snapshot), host
+        # snapshots are built once per cycle for every cluster and shared by all pending VMs
+        self.cluster_snapshot = self.get_cluster_snapshot()
+        if self.cluster_snapshot is not None:
+            self.vm_registry.reset(self.cluster_snapshot['vms'])
+        else:
+            self.vm_registry.refresh()
+        cluster_vms = {}
+        allowed_vms = []
         for vm in pending_vm_list:
             if not vm['cluster_id']: # if clusters is None
                 self.logger.info(str(vm['id']) + ' Have no cluster information')
@@ -93,104 +162,229 @@ class PlacePendingStrategy(base_strategy.BaseStrategy):
             if (len(self.cluster_list) != 0) and (vm['cluster_id'][0] not in self.cluster_list):
                 self.logger.info(str(vm['id']) + ' is not on allowed cluster')
                 continue
-            hosts = self.cloud.get_hosts_of_cluster(vm['cluster_id'])
-            host_candidates = []
-            for host in hosts:
-                # Get logs of CPU and MEM, usage and load
-                host_cpu_usage_log = self.influx_handler.get_host_load(host['name'], 'host_cpu_load', period='5m', group_by='10m', aggregation='max')
-                host_mem_usage_log = self.influx_handler.get_host_load(host['name'], 'host_mem_used_percent', period='5m', group_by='10m', aggregation='max')
-                host_cpu_total_log = self.influx_handler.get_host_load(host['name'], 'host_cpu_count', period='5m', group_by='10m', aggregation='last')
-                host_mem_total_log = self.influx_handler.get_host_load(host['name'], 'host_mem_total_bytes', period='5m', group_by='10m', aggregation='last')
-
-                # Get current total value and "Worst case" usage
-                host_cpu_usage = max([host_cpu_usage_log[x] for x in host_cpu_usage_log])
-                host_mem_usage = max([host_mem_usage_log[x] for x in host_mem_usage_log])
-                host_cpu_total = host_cpu_total_log[max(host_cpu_total_log.keys())]
-                host_mem_total = host_mem_total_log[max(host_mem_total_log.keys())]
-
-                # Build list of VMs on host
-                host_vms = []
-                for vm_id in host['vms']:
-                    host_vms.append(self.cloud.get_vm_repr(int(vm_id)))
-                # Get data about new VMs
-                fresh_vms = []
-                for running_vm in host_vms:
-                    if running_vm['rstime'] != datetime(1970, 1, 1, 0, 0):
-                        if datetime.utcnow() - running_vm['rstime'] < timedelta(hours=self.fresh_vm_timeframe):
-                            fresh_vms.append(running_vm)
-                # Correct host CPU and MEM usage for new VMs (let it be MAX)
-                for running_vm in fresh_vms:
-                    host_cpu_usage += 1.0 * running_vm['cpu_allocated'] / host['usage_cpu']['max']
-                    host_mem_usage += 1.0 * running_vm['mem_allocated'] / host['usage_mem']['max']
-
-                isHostFree = True
-                # Check if usage of host is not too heavy
-                if host_cpu_usage > self.cpu_max_usage:
-                    isHostFree = False
-                if host_mem_usage > self.mem_max_usage:
-                    isHostFree = False
-
-                # Calculate amount of free resources on the host
-                host_cpu_used = host_cpu_usage / 100.0 * host_cpu_total
-                host_mem_used = host_mem_usage / 100.0 * host_mem_total
-                host_cpu_free = host_cpu_total - host_cpu_used
-                host_mem_free = host_mem_total - host_mem_used
-
-                # Check that host have enoyugh capacity to hold new VM
-                if vm['cpu_req'] > host_cpu_free:
-                    isHostFree = False
-                if vm['mem_req'] * 1024.0 > host_mem_free:
-                    isHostFree = False
-
-                # Calculate future OVC ratio for cpu and memory
-                host_cpu_ovc_expected = host['usage_cpu']['ratio_overc'] + vm['cpu_allocated'] / host['usage_cpu']['max']
-                host_mem_ovc_expected = host['usage_mem']['ratio_overc'] + vm['mem_allocated'] / host['usage_mem']['max']
-                
-                # Check that OVC ratio will not be exceeded
-                if host_cpu_ovc_expected > self.cpu_max_ovc:
-                    isHostFree = False
-                if host_mem_ovc_expected > self.mem_max_ovc:
-                    isHostFree = False
-
-                # If host passed all checks
-                if isHostFree:
-                    host_candidates.append(host)
-
-            if len(host_candidates) != 0:
-                self.deploy_mesh.append({'vm':vm, 'hosts':host_candidates})
-            else:
-                self.logger.info("No free hosts for vm " + str(vm['id']))
+            if vm['id'] in self.deploying:
+                # Cloud may list VM as pending for a while after the deploy request
+                continue
+            cluster_vms.setdefault(tuple(vm['cluster_id']), []).append(vm)
+            allowed_vms.append(vm)
 
-    def try_deploy(self):
-        self.current_vm = self.deploy_mesh[0]['vm']
-        self.current_host = self.deploy_mesh[0]['hosts'][0]
+        # The queue is kept between cycles, only changes of the pending list are applied
+        self.pending_queue.update(allowed_vms, self.clock.time(), keep=self.deploying)
 
-        self.logger.info('Try deploy VM {_vm_id} deployed on {_hostname}'.format(_vm_id=self.current_vm['id'], _hostname=self.current_host['name']))
-        self.cloud.deploy(self.current_vm['id'], self.current_host['id'], False)
-        self.isDeploying = True
-        self.deploying_time_count = 0
+        self.deploy_mesh = []
+        self.mesh_clusters = {}
+        self.mesh_built_time = self.clock.time()
+        # Clusters of deploying VMs are rebuilt too, their reservations are moved to the new snapshots
+        deploys = list(self.deploying.values()) + list(self.deployed.values())
+        cluster_keys = set(cluster_vms) | {deploy['entry']['cluster'] for deploy in deploys}
+        for cluster_key in cluster_keys:
+            snapshot = self.build_host_snapshot(list(cluster_key))
+            self.mesh_clusters[cluster_key] = {'snapshot': snapshot,
+                                               'engine': placement.PlacementEngine(snapshot)}
+        self.carry_reservations(self.deploying)
+        self.carry_reservations(self.deployed)
+        # Shared snapshot may be taken before the deploy was done, hosts fetched now show it
+        snapshot_time = self.cluster_snapshot['time'] if self.cluster_snapshot is not None else None
+        for vm_id, deploy in list(self.deployed.items()):
+            if deploy['host_index'] is None or snapshot_time is None or snapshot_time > deploy['finished']:
+                del self.deployed[vm_id]
+        for vm in self.pending_queue.ordered():
+            self.deploy_mesh.append({'vm': vm,
+                                     'cluster': tuple(vm['cluster_id']),
+                                     'row': self.get_vm_placement_row(vm)})
+        # All pending VMs of the cluster are checked against all hosts at once
+        for cluster_key in cluster_vms:
+            self.update_mesh(cluster_key)
 
+    def build_host_snapshot(self, cluster_id):
+        """Collect current state of every host in the cluster.
 
-    def check_deploy(self):
-        self.deploying_time_count += self.sleep_time
-        deployed_vm = self.cloud.get_vms_repr(startId=self.current_vm['id'], endId=self.current_vm['id'], vmStateFilter=-2)[0]
-        self.logger.info('Status: {}'.format(deployed_vm['lcm_state']))
-        if deployed_vm['lcm_state'] == 'RUNNING':
-            self.isDeploying = False
-            self.deploy_mesh = []
-            self.logger.info('Deploy successful for vm: ' + str(self.current_vm['id']))
-            return
-        
-        if deployed_vm['state'] == 'FAILED' or deployed_vm['lcm_state'] == 'FAILURE':
-            self.isDeploying = False
-            self.deploy_mesh = []
-            self.logger.error('Failed to deploy vm: ' + str(self.current_vm['id']))
+        Monitoring and cloud are queried once per host. The result is reused
+        for all pending VMs of the cycle.
+
+        Returns:
+            [{'host': host, 'cpu_usage': %, 'mem_usage': %, ...}, ...] with all
+            fields of placement.HOST_FIELDS. Free resources are measured in
+            cores and bytes, the rest is measured in units of host['usage_*'].
+        """
+        hosts = None
+        if self.cluster_snapshot is not None:
+            hosts = cluster_snapshot.hosts_of_clusters(self.cluster_snapshot, cluster_id)
+        if hosts is None:
+            hosts = self.cloud.get_hosts_of_cluster(cluster_id)
+        self.vm_registry.prefetch([vm_id for host in hosts for vm_id in host['vms']])
+        snapshot = []
+        for host in hosts:
+            # Get logs of CPU and MEM, usage and load
+            host_logs = self.get_host_load_logs(host)
+            host_cpu_usage_log = host_logs['host_cpu_load']
+            host_mem_usage_log = host_logs['host_mem_used_percent']
+            host_cpu_total_log = host_logs['host_cpu_count']
+            host_mem_total_log = host_logs['host_mem_total_bytes']
+
+            # Get current total value and "Worst case" usage
+            host_cpu_usage = max([host_cpu_usage_log[x] for x in host_cpu_usage_log])
+            host_mem_usage = max([host_mem_usage_log[x] for x in host_mem_usage_log])
+            host_cpu_total = host_cpu_total_log[max(host_cpu_total_log.keys())]
+            host_mem_total = host_mem_total_log[max(host_mem_total_log.keys())]
+
+            # Build list of VMs on host
+            host_vms = self.vm_registry.get_many(host['vms'])
+            # Get data about new VMs
+            fresh_vms = []
+            for running_vm in host_vms:
+                if running_vm['rstime'] != datetime(1970, 1, 1, 0, 0):
+                    if self.clock.utcnow() - running_vm['rstime'] < timedelta(hours=self.fresh_vm_timeframe):
+                        fresh_vms.append(running_vm)
+            # Correct host CPU and MEM usage for new VMs (let it be MAX)
+            for running_vm in fresh_vms:
+                host_cpu_usage += 1.0 * running_vm['cpu_allocated'] / host['usage_cpu']['max']
+                host_mem_usage += 1.0 * running_vm['mem_allocated'] / host['usage_mem']['max']
+
+            # Calculate amount of free resources on the host
+            host_cpu_used = host_cpu_usage / 100.0 * host_cpu_total
+            host_mem_used = host_mem_usage / 100.0 * host_mem_total
+
+            snapshot.append({'host': host,
+                             'cpu_usage': host_cpu_usage,
+                             'mem_usage': host_mem_usage,
+                             'cpu_max': host['usage_cpu']['max'],
+                             'mem_max': host['usage_mem']['max'],
+                             'cpu_allocated': host['usage_cpu']['ratio_overc'] * host['usage_cpu']['max'],
+                             'mem_allocated': host['usage_mem']['ratio_overc'] * host['usage_mem']['max'],
+                             'cpu_used': host_cpu_usage / 100.0 * host['usage_cpu']['max'],
+                             'mem_used': host_mem_usage / 100.0 * host['usage_mem']['max'],
+                             'cpu_free': host_cpu_total - host_cpu_used,
+                             'mem_free': host_mem_total - host_mem_used})
+        return snapshot
+
+    def get_host_load_logs(self, host):
+        """Host metrics from the shared cluster snapshot or from monitoring."""
+        if self.cluster_snapshot is not None and host['name'] in self.cluster_snapshot['host_metrics']:
+            return self.cluster_snapshot['host_metrics'][host['name']]
+        logs = {}
+        for metric, aggregation in snapshot_provider.HOST_METRICS:
+            logs[metric] = self.influx_handler.get_host_load(host['name'], metric, period='5m', group_by='10m', aggregation=aggregation)
+        return logs
+
+    def get_vm_placement_row(self, vm):
+        """Requirements of pending VM and limits for the placement engine."""
+        return {'cpu_req': vm['cpu_req'],
+                'mem_req': vm['mem_req'] * 1024.0,
+                'cpu_allocated': vm['cpu_allocated'],
+                'mem_allocated': vm['mem_allocated'],
+                'cpu_max_ovc': self.cpu_max_ovc,
+                'mem_max_ovc': self.mem_max_ovc,
+                # Host usage is measured in percents
+                'cpu_max_usage': self.cpu_max_usage / 100.0,
+                'mem_max_usage': self.mem_max_usage / 100.0}
+
+    def update_mesh(self, cluster_key):
+        """Recheck mesh entries of the cluster against current state of its hosts.
+
+        Feasible hosts of every VM are sorted by host_ranking, the best one
+        goes first. VMs which do not fit any host anymore are removed from the mesh.
+        """
+        cluster = self.mesh_clusters[cluster_key]
+        entries = [entry for entry in self.deploy_mesh if entry['cluster'] == cluster_key]
+        if not entries:
             return
-        if self.deploying_time_count > self.deploy_waiting_time:
-            self.isDeploying = False
-            self.deploy_mesh = []
-            self.logger.error('Deploy Timeout for vm: ' + str(self.current_vm['id']))
+        feasible, score = cluster['engine'].evaluate([entry['row'] for entry in entries], self.host_ranking)
+        for entry, vm_feasible, vm_score in zip(entries, feasible, score):
+            entry['host_indexes'] = sorted([int(host_index) for host_index in vm_feasible.nonzero()[0]],
+                                           key=lambda host_index: -vm_score[host_index])
+            entry['hosts'] = [cluster['snapshot'][host_index]['host'] for host_index in entry['host_indexes']]
+            if len(entry['hosts']) == 0:
+                self.logger.info("No free hosts for vm " + str(entry['vm']['id']))
+                self.deploy_mesh.remove(entry)
+
+    def reserve_host(self, entry, host_index, sign=1):
+        """Account resources of deploying VM on the host (or release them if sign is -1).
+
+        Deploying VM is counted with its max possible usage, like fresh VMs in
+        the snapshot. Other VMs of the mesh are rechecked against the new state.
+        Nothing is done if host_index is None.
+        """
+        if host_index is None:
             return
+        cluster = self.mesh_clusters[entry['cluster']]
+        host_state = cluster['snapshot'][host_index]
+        row = entry['row']
+        for resource in ['cpu', 'mem']:
+            host_state[resource + '_allocated'] += sign * row[resource + '_allocated']
+            host_state[resource + '_used'] += sign * row[resource + '_allocated']
+            host_state[resource + '_free'] -= sign * row[resource + '_req']
+        cluster['engine'].set_host(host_index, host_state)
+        self.update_mesh(entry['cluster'])
+
+    def carry_reservations(self, deploys):
+        """Reserve resources of deploying or just deployed VMs on their hosts in the rebuilt snapshots.
+
+        Allocation of a VM may be not visible in the state of its host until
+        the deploy is done. Hosts are found by id, their order may change. VM
+        which is already listed on its host is accounted by the snapshot, its
+        host_index is set to None, so it is not released twice.
+        """
+        for vm_id, deploy in deploys.items():
+            snapshot = self.mesh_clusters[deploy['entry']['cluster']]['snapshot']
+            deploy['host_index'] = None
+            for host_index, host_state in enumerate(snapshot):
+                if host_state['host']['id'] != deploy['host_id']:
+                    continue
+                if str(vm_id) not in [str(host_vm_id) for host_vm_id in host_state['host']['vms']]:
+                    deploy['host_index'] = host_index
+                    self.reserve_host(deploy['entry'], host_index)
+                break
+            else:
+                self.logger.warning('Host {0} of deploying vm {1} is not in cluster anymore'.format(
+                    deploy['host_id'], vm_id))
+
+    def try_deploy(self):
+        while self.deploy_mesh != [] and len(self.deploying) < self.max_parallel_deploys:
+            entry = self.deploy_mesh.pop(0)
+            vm = entry['vm']
+            host = entry['hosts'][0]
+            host_index = entry['host_indexes'][0]
+
+            self.logger.info('Try deploy VM {_vm_id} deployed on {_hostname}'.format(_vm_id=vm['id'], _hostname=host['name']))
+            self.cloud.deploy(vm['id'], host['id'], False)
+            self.pending_queue.remove(vm['id'])
+            self.deploying[vm['id']] = {'entry': entry, 'host_id': host['id'], 'host_index': host_index,
+                                        'started': self.clock.time()}
+            self.isDeploying = True
+            self.reserve_host(entry, host_index)
+
+    def check_deploy(self):
+        # State of all deploying VMs is received together, only their ids are requested
+        vm_ids = list(self.deploying)
+        deployed_vms = {}
+        for page in vm_registry.iter_vm_pages(self.cloud, vm_ids, vmStateFilter=-2):
+            for vm in page:
+                deployed_vms[vm['id']] = vm
+
+        for vm_id in vm_ids:
+            deploy = self.deploying[vm_id]
+            deployed_vm = deployed_vms.get(vm_id)
+            if deployed_vm is not None:
+                self.logger.info('Status of vm {}: {}'.format(vm_id, deployed_vm['lcm_state']))
+                if deployed_vm['lcm_state'] == 'RUNNING':
+                    del self.deploying[vm_id]
+                    # Host stays reserved till the mesh is rebuilt from a snapshot which shows the VM
+                    deploy['finished'] = self.clock.time()
+                    self.deployed[vm_id] = deploy
+                    self.logger.info('Deploy successful for vm: ' + str(vm_id))
+                    continue
+
+                if deployed_vm['state'] == 'FAILED' or deployed_vm['lcm_state'] == 'FAILURE':
+                    del self.deploying[vm_id]
+                    self.reserve_host(deploy['entry'], deploy['host_index'], -1)
+                    self.logger.error('Failed to deploy vm: ' + str(vm_id))
+                    continue
+            if self.clock.time() - deploy['started'] > self.deploy_waiting_time:
+                del self.deploying[vm_id]
+                self.reserve_host(deploy['entry'], deploy['host_index'], -1)
+                self.logger.error('Deploy Timeout for vm: ' + str(vm_id))
+        self.isDeploying = len(self.deploying) != 0
 
 target_class = PlacePendingStrategy
 
@@ -3,14 +3,21 @@
 Module for ranged strategy
 """
 from pprint import pprint as pp
-import datetime
 import logging
+import math
 import sys
 import smartsched.common as common
 import smartsched.daemon.base_strategy as base_strategy
+import smartsched.daemon.cluster_snapshot as cluster_snapshot
+import smartsched.daemon.migration_executor as migration_executor
+import smartsched.daemon.parallel as parallel
+import smartsched.daemon.rebalance as rebalance
+import smartsched.daemon.vm_registry as vm_registry
+import smartsched.daemon.vm_stats as vm_stats
 
 
 class RankedStrategy(base_strategy.BaseStrategy):
+    checkpoint_version = 3
 
     def __init__(self, config):
         base_strategy.BaseStrategy.__init__(self, config)
@@ -25,6 +32,18 @@ class RankedStrategy(base_strategy.BaseStrategy):
             self.logger.warning('sleep_time is less than min_lifetime. I will use min_lifetime + 100 as a sleep_time')
         self.cluster_list = [int(x) for x in config['cluster_list'].split(',')]
         self.psquare = float(config['psquare'])
+        # Statistic of CPU and MEM usage used for the distance: mean, min, max, ewma or percentile like p95
+        self.psquare_statistic = config.get('psquare_statistic', 'mean')
+        vm_stats.check_statistic(self.psquare_statistic)
+        self.ewma_alpha = float(config.get('ewma_alpha', 0.3))
+        # Class of VM is kept while its distance is within psquare +- psquare_hysteresis
+        self.psquare_hysteresis = float(config.get('psquare_hysteresis', 0))
+        # VMs on hosts of cluster_list are fetched by pages of at most vm_page_size ids
+        self.vm_page_size = int(config.get('vm_page_size', 500))
+        # Amount of simultaneous monitoring queries
+        self.max_parallel_queries = int(config.get('max_parallel_queries', 1))
+        # Amount of clusters fetched and rebalanced at the same time, all of them by default
+        self.max_parallel_clusters = int(config.get('max_parallel_clusters', len(self.cluster_list)))
 
         # Get parameters
         self.cpu_max_ovc_0 = float(config['cpu_max_ovc_0'])
@@ -36,35 +55,114 @@ class RankedStrategy(base_strategy.BaseStrategy):
         self.cpu_max_usage_1 = float(config['cpu_max_usage_1'])
         self.mem_max_usage_1 = float(config['mem_max_usage_1'])
 
-        sl = common.StreamToLogger(self.logger, logging.INFO)
-        sys.stdout = sl
-
-        sl = common.StreamToLogger(self.logger, logging.ERROR)
-        sys.stderr = sl
-
-        self.cloud = common.get_cloud_handler()
-        self.monitoring = common.get_monitoring_handler()
-
+        if not self.managed:
+            sl = common.StreamToLogger(self.logger, logging.INFO)
+            sys.stdout = sl
+
+            sl = common.StreamToLogger(self.logger, logging.ERROR)
+            sys.stderr = sl
+
+        self.cloud = self.instrument(parallel.PerThreadHandler(common.get_cloud_handler), 'cloud')
+        self.monitoring = self.instrument(parallel.PerThreadHandler(common.get_monitoring_handler), 'monitoring')
+        self.vm_registry = vm_registry.VMRegistry(self.cloud, self.logger)
+        self.migration_executor = migration_executor.MigrationExecutor(
+            self.cloud, self.logger, self.clock, self.wait, lambda: self.shutdown,
+            max_parallel=int(config.get('max_parallel_migrations', 4)),
+            max_per_source=int(config.get('max_migrations_per_source', 1)),
+            max_per_destination=int(config.get('max_migrations_per_destination', 1)),
+            max_retries=int(config.get('migration_retries', 1)),
+            timeout=int(config.get('migration_timeout', 1800)),
+            poll_interval=int(config.get('migration_poll_interval', 10)),
+            metrics=self.metrics)
+        self.planner = rebalance.RebalancePlanner(float(config.get('migration_cost', 0)),
+                                                  float(config.get('migration_memory_cost', 0)),
+                                                  float(config.get('rebalance_threshold', 0)))
+        # Migrations are only planned and logged (and saved to plan_path if it is set)
+        self.dry_run = config.get('dry_run', 'no').lower() in ['yes', 'true', 'on', '1']
+        self.plan_path = config.get('plan_path')
+        # Classes of VMs and ranks of hosts of the previous cycle: {id: class}
+        self.vm_classes = {}
+        self.host_ranks = {}
+        # Usage probes of VMs for the last min_lifetime seconds, kept between cycles
+        self.usage_stats = vm_stats.UsageWindow(self.min_lifetime)
+
+        # Shared cluster snapshot of the current cycle or None
+        self.cluster_snapshot = None
+        # OpenVZ hosts of cluster_list: {host_id: host} and {cluster_id: {host_id: host}}
+        self.ovz_hosts = {}
+        self.ovz_hosts_of_clusters = {}
         self.hosts = []
         self.vms = []
-        self.clusters = []
-        self.initial_rank = 0
+        # Hosts of every rank in every cluster: {cluster_id: {rank: [host, ...]}}
+        self.clusters = {}
+
+    def get_checkpoint_state(self):
+        # VM classes are recalculated from usage stats every cycle, previous classes and ranks
+        # are needed for hysteresis
+        return {'window': self.usage_stats.window,
+                'entries': self.usage_stats.entries,
+                'vm_classes': self.vm_classes,
+                'host_ranks': self.host_ranks}
+
+    def restore_checkpoint_state(self, state, age):
+        self.vm_classes = state['vm_classes']
+        self.host_ranks = state['host_ranks']
+        if state['window'] != self.usage_stats.window:
+            self.logger.warning('Usage stats of the checkpoint have other window, they are not restored')
+            return
+        self.usage_stats.entries = state['entries']
+        self.usage_stats.expire(self.clock.time())
+        self.logger.info('Restored usage stats of ' + str(len(self.usage_stats.entries)) + ' VMs')
 
     def get_ovz_hosts_ids(self):
-        """ Returns list if ovz host ids in allowd clusters."""
-        all_hosts = []
+        """ Returns set of ovz host ids in allowed clusters.
+        Hosts of clusters which are not in the cluster snapshot are fetched concurrently,
+        a cluster whose hosts can not be fetched is skipped in this cycle. """
+        hosts_of_clusters = {}
+        missing = []
+        for cluster_id in self.cluster_list:
+            hosts = None
+            if self.cluster_snapshot is not None:
+                hosts = cluster_snapshot.hosts_of_clusters(self.cluster_snapshot, [cluster_id])
+            if hosts is None:
+                missing.append(cluster_id)
+            else:
+                hosts_of_clusters[cluster_id] = hosts
+        results = parallel.map_parallel(self.cloud.get_hosts_of_cluster, [(cluster_id, ) for cluster_id in missing],
+                                        self.max_parallel_clusters)
+        for cluster_id, (hosts, error) in zip(missing, results):
+            if error is not None:
+                self.logger.error('Failed to get hosts of cluster ' + str(cluster_id) + ': ' + str(error))
+                continue
+            hosts_of_clusters[cluster_id] = hosts
+
+        self.ovz_hosts = {}
+        self.ovz_hosts_of_clusters = {}
         for cluster_id in self.cluster_list:
-            all_hosts = self.cloud.get_hosts_of_cluster(cluster_id)
-        ovz_hosts_ids = set()
-        for host in all_hosts:
-            if host['im_mad'] == self.IM_MAD_OVZ_ID:
-                ovz_hosts_ids.add(host['id'])
-        return ovz_hosts_ids
+            if cluster_id not in hosts_of_clusters:
+                continue
+            ovz_hosts = {}
+            for host in hosts_of_clusters[cluster_id]:
+                # Host listed by several clusters is managed as a part of the first one
+                if host['im_mad'] == self.IM_MAD_OVZ_ID and host['id'] not in self.ovz_hosts:
+                    ovz_hosts[host['id']] = host
+            self.ovz_hosts_of_clusters[cluster_id] = ovz_hosts
+            self.ovz_hosts.update(ovz_hosts)
+        return set(self.ovz_hosts)
 
     def get_running_vms_on_hosts(self, hosts_ids):
         """ Return vms running on the hosts ids listed in host_ids.
-        Checks if vm is running right now (not stopped): start_time > end_time """
-        vms = self.cloud.get_vms_repr()
+        Checks if vm is running right now (not stopped): start_time > end_time
+
+        Without cluster snapshot only VMs listed by the hosts are fetched: they
+        are streamed by pages of ids, DONE VMs are filtered by the cloud. """
+        if self.cluster_snapshot is not None:
+            vms = self.cluster_snapshot['vms']
+            self.vm_registry.reset(vms)
+        else:
+            vm_ids = [vm_id for host_id in hosts_ids if host_id in self.ovz_hosts
+                      for vm_id in self.ovz_hosts[host_id]['vms']]
+            vms = self.vm_registry.stream(vm_ids, self.vm_page_size, vmStateFilter=-1)
         vms_on_hosts = []
         for vm in vms:
             if (vm['retime'] < vm['rstime']) and vm['hid'] in hosts_ids:
@@ -72,262 +170,395 @@ class RankedStrategy(base_strategy.BaseStrategy):
         return vms_on_hosts
 
     def give_class_to_vms(self):
+        now = self.clock.time()
+        # Forget VMs which are not running anymore and probes which are out of the window
+        self.usage_stats.retain([vm['id'] for vm in self.vms])
+        vm_ids = set(vm['id'] for vm in self.vms)
+        self.vm_classes = {vm_id: vm_class for vm_id, vm_class in self.vm_classes.items() if vm_id in vm_ids}
+        self.usage_stats.expire(now)
+
+        long_lived_vms = []
         for vm in self.vms:
-            vm['lifetime'] = datetime.datetime.utcnow() - vm['rstime']
+            vm['lifetime'] = self.clock.utcnow() - vm['rstime']
             if vm['lifetime'].total_seconds() < self.min_lifetime:
                 vm['class'] = 2
                 continue
-            current_mon = self.monitoring.get_ovz_vm(vm['id'], ['mem', 'cpu', 'num_cpu'], limit=int(self.min_lifetime/60))
-            # For current vm get max, min and average CPU and MEM usage ratio:
-            # 0 <= ratio <= 1
-            mem_min = 10000
-            mem_max = -1
-            cpu_min = 1000
-            cpu_max = -1
-
-            mem_cumulative = 0
-            cpu_cumulative = 0
-            probes_count = 0
-
-            corrupted = 0
-            for row in current_mon:
-                # Some probes are corrupted. We need to ignore them.
-                if 'cpu' not in row or 'mem' not in row or 'num' not in row:
-                    corrupted += 1
-                    continue
-                probes_count += 1
-
-                # Sometimes number of cores is equal to 0 which is wrong. We do not rely on that
-                # metric so we can ignore it. It happens if VM require a fraction of a core,
-                # like 0.3 core.
-                if row['num'] == 0:
-                    row['num'] = vm['cpu_allocated']
-
-                cpu_percent = row['cpu'] / row['num'] / 100.0
-                if row['mem'] < mem_min:
-                    mem_min = row['mem']
-                if row['mem'] > mem_max:
-                    mem_max = row['mem']
-                if cpu_percent < cpu_min:
-                    cpu_min = cpu_percent
-                if cpu_percent > cpu_max:
-                    cpu_max = cpu_percent
-
-                mem_cumulative += row['mem']
-                cpu_cumulative += cpu_percent
-
-            mem_avg = 0.01 * mem_cumulative / probes_count # Mem is measured in 0.0 < 100.0 range
-            mem_min = 0.01 * mem_min
-            mem_max = 0.01 * mem_max
-
-            cpu_avg = 1.0 * cpu_cumulative / probes_count  # CPU is measured in 0.0 < 1.0 range
-            
-            vm['mem_min'] = mem_min
-            vm['cpu_min'] = cpu_min
-            vm['mem_max'] = mem_max
-            vm['cpu_max'] = cpu_max
-            vm['mem_avg'] = mem_avg
-            vm['cpu_avg'] = cpu_avg
-            vm['class'] = 0
-            # So when min, max and average consumption is received we can use two of them as an
-            # input for calculating P * P - the distance between (0, 0) point and point
-            # representing the VM on the plot with axes CPU usage, MEM usage.
-            p = mem_avg * mem_avg + cpu_avg * cpu_avg # Here we use average
-            if p > self.psquare:
-                vm['class'] = 1
-            if p <= self.psquare:
-                vm['class'] = 0
+            long_lived_vms.append(vm)
+
+        # Monitoring queries are independent, so they are issued in parallel. Only probes which
+        # are newer than the last seen one are requested.
+        args_list = [(vm, self.get_probes_limit(vm, now)) for vm in long_lived_vms]
+        monitoring = parallel.map_parallel(self.get_vm_monitoring, args_list, self.max_parallel_queries)
+        monitored_vms = []
+        for vm, (current_mon, error) in zip(long_lived_vms, monitoring):
+            if error is not None:
+                self.logger.error('Failed to get monitoring for vm ' + str(vm['id']) + ': ' + str(error))
+                vm['class'] = 2
+                continue
+            self.merge_vm_probes(vm, current_mon, now)
+            monitored_vms.append(vm)
+
+        # Statistics of all VMs are calculated in one batch
+        statistics = set(['mean', 'min', 'max', self.psquare_statistic])
+        all_stats = self.usage_stats.aggregate([vm['id'] for vm in monitored_vms], statistics, self.ewma_alpha)
+        for vm in monitored_vms:
+            self.classify_vm(vm, all_stats[vm['id']])
+        # VMs which are not RUNNING (e.g. being migrated) are not moved
+        for vm in self.vms:
+            if vm['lcm_state'] != 'RUNNING':
+                vm['class'] = 2
+
+    def get_probes_limit(self, vm, now):
+        """Amount of probes (one per minute) which are not merged into usage stats yet."""
+        full_limit = int(self.min_lifetime/60)
+        last_seen = self.usage_stats.last_seen(vm['id'])
+        if last_seen is None:
+            return full_limit
+        return max(1, min(full_limit, int(math.ceil((now - last_seen) / 60.0)) + 1))
+
+    def get_vm_monitoring(self, vm, limit):
+        return self.monitoring.get_ovz_vm(vm['id'], ['mem', 'cpu', 'num_cpu'], limit=limit)
+
+    def merge_vm_probes(self, vm, current_mon, now):
+        """Merge fresh monitoring probes of the vm into the usage window."""
+        timestamps, values, complete = vm_stats.parse_rows(current_mon, vm['cpu_allocated'], now)
+        # Without probe time it is impossible to merge only new probes
+        self.usage_stats.merge(vm['id'], timestamps, values, incremental=complete)
+
+    def classify_vm(self, vm, stats):
+        """Give class to VM by its usage stats (see vm_stats.UsageWindow.aggregate)."""
+        if stats is None:
+            self.logger.info('No valid probes for vm ' + str(vm['id']))
+            vm['class'] = 2
+            return
+        vm['mem_min'] = stats['mem']['min']
+        vm['cpu_min'] = stats['cpu']['min']
+        vm['mem_max'] = stats['mem']['max']
+        vm['cpu_max'] = stats['cpu']['max']
+        vm['mem_avg'] = stats['mem']['mean']
+        vm['cpu_avg'] = stats['cpu']['mean']
+        mem_usage = stats['mem'][self.psquare_statistic]
+        cpu_usage = stats['cpu'][self.psquare_statistic]
+        # So when min, max and average consumption is received we can use two of them as an
+        # input for calculating P * P - the distance between (0, 0) point and point
+        # representing the VM on the plot with axes CPU usage, MEM usage.
+        p = mem_usage * mem_usage + cpu_usage * cpu_usage # Average by default, see psquare_statistic
+        vm['p'] = p
+        vm['class'] = rebalance.classify(p, self.psquare, self.psquare_hysteresis, self.vm_classes.get(vm['id']))
+        self.vm_classes[vm['id']] = vm['class']
 
     def get_vm(self, vm_id):
-        """Function to get vm from list of vms"""
-        for vm in self.vms:
-            if vm['id'] == vm_id:
-                return vm
-        self.logger.info('No vm found with id ' + str(vm_id))
-        return self.cloud.get_vm_repr(vm_id)
+        """Function to get vm from registry of vms"""
+        return self.vm_registry.get(vm_id)
 
     def get_hosts_classified(self, hosts_ids):
-        """ Get hosts representation and get host's classes """
-        hosts = []
-        for host_id in list(hosts_ids):
-            host = self.cloud.get_host_repr(host_id)
+        """ Get hosts representation and get host's classes.
+        Hosts are taken from the result of get_ovz_hosts_ids, no request per host is made.
+        VMs of the hosts should be already in the registry (see prefetch_host_vms). """
+        hosts = [self.ovz_hosts[host_id] for host_id in hosts_ids]
+        for host in hosts:
             count = {0: 0, 1: 0, 2: 0}
             for vm_id in host['vms']:
                 vm = self.get_vm(int(vm_id))
-                if vm['lcm_state'] != 'RUNNING':
-                    vm['class'] = 2
-                if 'class' in vm.keys():
-                    count[vm['class']] += 1
-                else:
+                if vm is None:
                     count[2] += 1
+                    continue
+                count[vm.get('class', 2)] += 1
             host['count'] = count
             # host['class'] = get_host_class(host)
-            hosts.append(host)
         return hosts
 
-    def get_initial_rank(self):
-        total_0 = sum([host['count'][0] for host in self.hosts])
-        total_1 = sum([host['count'][1] for host in self.hosts])
-        print('Amount of 0: {0},\tAmount if 1: {1}'.format(total_0, total_1))
+    def prefetch_host_vms(self):
+        """ Fetch VMs of all managed hosts which are not in registry yet by a few requests.
+        It is done before clusters are rebalanced in parallel, so rebalance_cluster only reads
+        the registry and does not query the cloud from the worker threads. """
+        self.vm_registry.prefetch([vm_id for host in self.ovz_hosts.values() for vm_id in host['vms']])
+
+    def get_initial_rank(self, hosts):
+        total_0 = sum([host['count'][0] for host in hosts])
+        total_1 = sum([host['count'][1] for host in hosts])
+        self.logger.info('Amount of 0: {0},\tAmount if 1: {1}'.format(total_0, total_1))
         initial_rank = 0
         if total_0 < total_1:
             initial_rank = 1
         return initial_rank
 
-    def calculate_host_avg_usage(self):
-        for host in self.hosts:
+    def calculate_host_avg_usage(self, hosts):
+        for host in hosts:
             tmp_mem_used = 0
             tmp_cpu_used = 0
             for vm_id in host['vms']:
                 vm = self.get_vm(int(vm_id))
                 #if 'class' in vm.keys() and vm['class'] < 2:
-                if vm['retime'] < vm['rstime']:
-                    tmp_mem_used += int(vm['mem_avg'] * vm['mem_allocated'])
-                    tmp_cpu_used += int(vm['cpu_avg'] * vm['cpu_allocated'])
+                if vm is not None and vm['retime'] < vm['rstime']:
+                    # Young VMs have no usage stats yet, their whole allocation is counted
+                    tmp_mem_used += int(vm.get('mem_avg', 1.0) * vm['mem_allocated'])
+                    tmp_cpu_used += int(vm.get('cpu_avg', 1.0) * vm['cpu_allocated'])
             host['usage_mem']['used_avg'] = tmp_mem_used
             host['usage_cpu']['used_avg'] = tmp_cpu_used
 
-    def form_rank_clusters(self):
+    def form_rank_clusters(self, hosts, vms, initial_rank):
+        """ Split hosts into ranks by resources requested by VMs of every class.
+        Ranks of the previous cycle are only read here, perform_strategy saves the new ones. """
         clusters = {0:[], 1:[], 2:[]}
         mem_requested = {0: 0, 1: 0, 2: 0}
         cpu_requested = {0: 0, 1: 0, 2: 0}
 
-        for vm in self.vms:
+        for vm in vms:
             mem_requested[vm['class']] += vm['mem_allocated']
             cpu_requested[vm['class']] += vm['cpu_allocated']
 
-        another_rank = (self.initial_rank + 1) % 2
-        # Sort hosts by amount of initial rank in reversed order.
-        # It allows to make less migrations later.
-        self.hosts.sort(key=lambda x: x['count'][self.initial_rank], reverse=True)
-        for host in self.hosts:
-            if mem_requested[self.initial_rank] > 0 or cpu_requested[self.initial_rank] > 0:
-                mem_requested[self.initial_rank] -= host['usage_mem']['max'] * (self.mem_max_ovc_0 if self.initial_rank == 0 else self.mem_max_ovc_1)
-                cpu_requested[self.initial_rank] -= host['usage_cpu']['max'] * (self.cpu_max_ovc_0 if self.initial_rank == 0 else self.cpu_max_ovc_1)
-                clusters[self.initial_rank].append(host)
-            elif mem_requested[another_rank] > 0 or cpu_requested[another_rank] > 0:
-                mem_requested[another_rank] -= host['usage_mem']['max'] * (self.mem_max_ovc_0 if another_rank == 0 else self.mem_max_ovc_1)
-                cpu_requested[another_rank] -= host['usage_cpu']['max'] * (self.cpu_max_ovc_0 if another_rank == 0 else self.cpu_max_ovc_1)
-                clusters[another_rank].append(host)
-            else:
-                clusters[2].append(host)
+        another_rank = (initial_rank + 1) % 2
+        # Every rank takes its hosts of the previous cycle first, then free hosts and only then hosts of
+        # the other rank, hosts with more VMs of the rank go first. It allows to make less migrations later.
+        remaining = list(hosts)
+        for rank in [initial_rank, another_rank]:
+            remaining.sort(key=lambda x: (self.host_ranks.get(x['id']) == rank,
+                                          self.host_ranks.get(x['id']) not in [0, 1],
+                                          x['count'][rank]), reverse=True)
+            limits = self.get_class_limits(rank)
+            while remaining and (mem_requested[rank] > 0 or cpu_requested[rank] > 0):
+                host = remaining.pop(0)
+                mem_requested[rank] -= host['usage_mem']['max'] * limits['mem_max_ovc']
+                cpu_requested[rank] -= host['usage_cpu']['max'] * limits['cpu_max_ovc']
+                clusters[rank].append(host)
+        clusters[2] = remaining
 
         self.logger.info(str(len(clusters[0])) + ' ' + str(len(clusters[1])) + ' ' + str(len(clusters[2])))
         return clusters
 
-    def add_temporary_host_usages(self):
-        for host in self.hosts:
+    def add_temporary_host_usages(self, hosts):
+        for host in hosts:
             host['vms_v'] = []
             for vm_id in host['vms']:
                 host['vms_v'].append(vm_id)
             host['usage_mem_v'] = host['usage_mem'].copy()
             host['usage_cpu_v'] = host['usage_cpu'].copy()
 
-    def check_migration(self, vm, host, original_host):
-        if vm['class'] not in [0, 1]:
-            return False
-        mem_allocated = host['usage_mem_v']['allocated'] + vm['mem_allocated']
-        cpu_allocated = host['usage_cpu_v']['allocated'] + vm['cpu_allocated']
-        mem_used = host['usage_mem_v']['used_avg'] + vm['mem_avg'] * vm['mem_allocated']
-        cpu_used = host['usage_cpu_v']['used_avg'] + vm['cpu_avg'] * vm['cpu_allocated']
-        mem_usage_ratio = mem_used / host['usage_mem_v']['max']
-        cpu_usage_ratio = cpu_used / host['usage_cpu_v']['max']
-        mem_overc_ratio = mem_allocated / host['usage_mem_v']['max']
-        cpu_overc_ratio = cpu_allocated / host['usage_cpu_v']['max']
-
-        isAllowed = True
-        if vm['class'] == 0:
-            if mem_overc_ratio > self.mem_max_ovc_0:
-                isAllowed = False
-            if cpu_overc_ratio > self.cpu_max_ovc_0:
-                isAllowed = False
-            if mem_usage_ratio > self.mem_max_usage_0:
-                isAllowed = False
-            if cpu_usage_ratio > self.cpu_max_usage_0:
-                isAllowed = False
-
-        if vm['class'] == 1:
-            if mem_overc_ratio > self.mem_max_ovc_1:
-                isAllowed = False
-            if cpu_overc_ratio > self.cpu_max_ovc_1:
-                isAllowed = False
-            if mem_usage_ratio > self.mem_max_usage_1:
-                isAllowed = False
-            if cpu_usage_ratio > self.cpu_max_usage_1:
-                isAllowed = False
-
-        if isAllowed:
-            host['usage_mem_v']['allocated'] = mem_allocated
-            host['usage_cpu_v']['allocated'] = cpu_allocated
-            host['usage_mem_v']['used_avg'] = mem_used
-            host['usage_cpu_v']['used_avg'] = cpu_used
-            host['usage_mem_v']['ratio_overc'] = mem_overc_ratio
-            host['usage_cpu_v']['ratio_overc'] = cpu_overc_ratio
-            host['usage_mem_v']['ratio_used'] = mem_usage_ratio
-            host['usage_cpu_v']['ratio_used'] = cpu_usage_ratio
-
-            print('Migrating VM ID:', vm['id'], ', ', original_host['id'], ' --> ', host['id'])
-            host['vms_v'].append(str(vm['id']))
-            print(original_host['vms_v'])
-            original_host['vms_v'].remove(str(vm['id']))
-            original_host['usage_mem_v']['allocated'] -= vm['mem_allocated']
-            original_host['usage_cpu_v']['allocated'] -= vm['cpu_allocated']
-            original_host['usage_mem_v']['used_avg'] -= vm['mem_avg'] * vm['mem_allocated']
-            original_host['usage_cpu_v']['used_avg'] -= vm['cpu_avg'] * vm['cpu_allocated']
-            original_host['usage_mem_v']['ratio_used'] = original_host['usage_mem_v']['used_avg'] / original_host['usage_mem_v']['max']
-            original_host['usage_cpu_v']['ratio_used'] = original_host['usage_cpu_v']['used_avg'] / original_host['usage_cpu_v']['max']
-            original_host['usage_mem_v']['ratio_overc'] = original_host['usage_mem_v']['allocated'] / original_host['usage_mem_v']['max']
-            original_host['usage_cpu_v']['ratio_overc'] = original_host['usage_cpu_v']['allocated'] / original_host['usage_cpu_v']['max']
-            return True
-        return False
-
-    def do_migrations(self):
-        """ Do all possible migrations"""
-        # Sort hosts in clusters in order to migrate from the busiest host
-        for rank in self.clusters:
-            self.clusters[rank].sort(key=lambda x: ((1-x['usage_mem']['used_avg'])*x['usage_mem']['max'], (1-x['usage_cpu']['used_avg'])*x['usage_cpu']['max']))
-
-        # Start with migration of 0 rank
+    def get_class_limits(self, vm_class):
+        """Overcommit and usage limits allowed for hosts of given rank."""
+        if vm_class == 0:
+            return {'cpu_max_ovc': self.cpu_max_ovc_0, 'mem_max_ovc': self.mem_max_ovc_0,
+                    'cpu_max_usage': self.cpu_max_usage_0, 'mem_max_usage': self.mem_max_usage_0}
+        return {'cpu_max_ovc': self.cpu_max_ovc_1, 'mem_max_ovc': self.mem_max_ovc_1,
+                'cpu_max_usage': self.cpu_max_usage_1, 'mem_max_usage': self.mem_max_usage_1}
+
+    def get_vm_placement_row(self, vm):
+        """Allocation and average usage of classified VM for the placement engine."""
+        row = {'cpu_allocated': vm['cpu_allocated'],
+               'mem_allocated': vm['mem_allocated'],
+               'cpu_used': vm['cpu_avg'] * vm['cpu_allocated'],
+               'mem_used': vm['mem_avg'] * vm['mem_allocated']}
+        row.update(self.get_class_limits(vm['class']))
+        return row
+
+    def get_host_placement_row(self, host):
+        """Temporary (after planned migrations) state of host for the placement engine."""
+        return {'cpu_max': host['usage_cpu_v']['max'],
+                'mem_max': host['usage_mem_v']['max'],
+                'cpu_allocated': host['usage_cpu_v']['allocated'],
+                'mem_allocated': host['usage_mem_v']['allocated'],
+                'cpu_used': host['usage_cpu_v']['used_avg'],
+                'mem_used': host['usage_mem_v']['used_avg']}
+
+    def apply_migration(self, vm, host, original_host):
+        """Move VM between temporary host usages."""
+        for resource in ['mem', 'cpu']:
+            usage = host['usage_' + resource + '_v']
+            usage['allocated'] += vm[resource + '_allocated']
+            usage['used_avg'] += vm[resource + '_avg'] * vm[resource + '_allocated']
+            usage['ratio_overc'] = usage['allocated'] / usage['max']
+            usage['ratio_used'] = usage['used_avg'] / usage['max']
+
+            usage = original_host['usage_' + resource + '_v']
+            usage['allocated'] -= vm[resource + '_allocated']
+            usage['used_avg'] -= vm[resource + '_avg'] * vm[resource + '_allocated']
+            usage['ratio_overc'] = usage['allocated'] / usage['max']
+            usage['ratio_used'] = usage['used_avg'] / usage['max']
+
+        self.logger.debug('Migrating VM ID: ' + str(vm['id']) + ', ' + str(original_host['id']) + ' --> ' + str(host['id']))
+        host['vms_v'].append(str(vm['id']))
+        original_host['vms_v'].remove(str(vm['id']))
+
+    def keep_previous_ranks(self, clusters):
+        """ Ranks where hosts of rank 0 and 1 in the previous cycle keep it, other hosts get the rank
+        they have in clusters.
+
+        Returns:
+            ({rank: [host, ...]}, [id of host whose rank is changed by clusters, ...])
+        """
+        kept = {0: [], 1: [], 2: []}
+        changed = []
+        for rank in clusters:
+            for host in clusters[rank]:
+                previous = self.host_ranks.get(host['id'])
+                if previous in [0, 1] and previous != rank:
+                    kept[previous].append(host)
+                    changed.append(host['id'])
+                else:
+                    kept[rank].append(host)
+        return kept, changed
+
+    def plan_migrations(self, clusters):
+        """ Plan migrations of VMs to hosts of their rank within one cluster.
+        Temporary host usages are only read, see do_migrations.
+
+        Returns:
+            rebalance.Plan
+        """
+        groups = {}
+        host_rows = {}
+        for rank in clusters:
+            for host in clusters[rank]:
+                host_rows[host['id']] = self.get_host_placement_row(host)
+            if rank in [0, 1]:
+                groups[rank] = [host['id'] for host in clusters[rank]]
+
+        candidates = []
         for rank in [0, 1]:
-            self.logger.info('Dealing with rank ' + str(rank))
-            for host in self.clusters[rank]:
-                self.logger.info('Migrating from host' + str(host['id']))
-                candidates = []
+            for host in clusters[rank]:
                 for vm_id in host['vms']:
                     vm = self.get_vm(int(vm_id))
-                    if 'class' in vm.keys() and vm['class'] != rank:
-                        candidates.append(vm)
-                # In order to try to migrae big vms first
-                candidates.sort(key=lambda x: (x['mem_allocated'], x['cpu_allocated']), reverse=True)
-                for vm in candidates:
-                    for dest_host in self.clusters[vm['class']]:
-                        if self.check_migration(vm, dest_host, host):
-                            migration = self.cloud.migrate(vm['id'], dest_host['id'], True, False)
-                            self.logger.info(str(migration))
-                            break
-
-    def perform_strategy(self):
-        hosts_ids = self.get_ovz_hosts_ids()
-        self.vms = self.get_running_vms_on_hosts(hosts_ids)
-        self.give_class_to_vms()
-        self.hosts = self.get_hosts_classified(hosts_ids, )
-        self.initial_rank = self.get_initial_rank()
-
-        for host in self.hosts:
+                    if vm is not None and vm.get('class') in [0, 1] and vm['class'] != rank:
+                        candidates.append({'vm': vm['id'],
+                                           'source': host['id'],
+                                           'group': vm['class'],
+                                           'gain': rebalance.get_gain(vm['p'], self.psquare),
+                                           'row': self.get_vm_placement_row(vm)})
+        return self.planner.plan(groups, host_rows, candidates)
+
+    def get_placement_gain(self, clusters, plan):
+        """ Gain of VMs which are on hosts of their class after the plan minus cost of its migrations.
+        Moves of the plan are counted only if it is accepted. """
+        ranks = {}
+        for rank in clusters:
+            for host in clusters[rank]:
+                ranks[host['id']] = rank
+        destinations = {}
+        gain = 0.0
+        if plan.accepted:
+            destinations = {move['vm']: move['destination'] for move in plan.moves}
+            gain -= sum(move['cost'] for move in plan.moves)
+        for rank in clusters:
+            for host in clusters[rank]:
+                for vm_id in host['vms']:
+                    vm = self.get_vm(int(vm_id))
+                    if vm is None or vm.get('class') not in [0, 1]:
+                        continue
+                    if ranks[destinations.get(vm['id'], host['id'])] == vm['class']:
+                        gain += rebalance.get_gain(vm['p'], self.psquare)
+        return gain
+
+    def do_migrations(self, hosts, plan):
+        """Apply migrations of the accepted plan to temporary host usages."""
+        if not plan.accepted:
+            return
+        hosts_by_id = {}
+        for host in hosts:
+            hosts_by_id[host['id']] = host
+        for move in plan.moves:
+            self.apply_migration(self.get_vm(move['vm']), hosts_by_id[move['destination']],
+                                 hosts_by_id[move['source']])
+
+    def rebalance_cluster(self, cluster_id):
+        """ Classify hosts of one cluster and plan migrations of its VMs.
+        Clusters are independent, VMs are moved only between hosts of their cluster.
+        It is called from several threads at once: shared state of the strategy (registry,
+        VMs and previous ranks) is only read, results are merged by perform_strategy.
+
+        Returns:
+            (hosts, {rank: [host, ...]}, rebalance.Plan)
+        """
+        hosts_ids = set(self.ovz_hosts_of_clusters[cluster_id])
+        vms = [vm for vm in self.vms if vm['hid'] in hosts_ids]
+        hosts = self.get_hosts_classified(hosts_ids)
+        initial_rank = self.get_initial_rank(hosts)
+
+        for host in hosts:
             self.logger.info('ID: {3}\t({4}/{5}) \tCPU Total: {0}  \tOVC: {1:.2f}\tReal: {2:.2f}'.format(host['usage_cpu']['max'], host['usage_cpu']['ratio_overc'], host['usage_cpu']['ratio_used'], host['id'], host['count'][0], host['count'][1]))
             self.logger.info('\t\tMEM Total: {0}  \tOVC: {1:.2f}\tReal: {2:.2f}'.format(host['usage_mem']['max'], host['usage_mem']['ratio_overc'], host['usage_mem']['ratio_used']))
 
-        self.calculate_host_avg_usage()
-        self.clusters = self.form_rank_clusters()
-        self.add_temporary_host_usages()
-        self.do_migrations()
+        self.calculate_host_avg_usage(hosts)
+        self.add_temporary_host_usages(hosts)
+        clusters = self.form_rank_clusters(hosts, vms, initial_rank)
+        plan = self.plan_migrations(clusters)
+        # Hosts keep their previous rank unless changing it pays off: the net gain of the placement
+        # with new ranks, migrations they imply included, should exceed rebalance_threshold
+        kept, changed = self.keep_previous_ranks(clusters)
+        if changed:
+            kept_plan = self.plan_migrations(kept)
+            change_gain = self.get_placement_gain(clusters, plan) - self.get_placement_gain(kept, kept_plan)
+            if change_gain > self.planner.threshold:
+                self.logger.info('Ranks of hosts {0} are changed, gain {1:.2f}'.format(changed, change_gain))
+            else:
+                self.logger.info('Ranks of hosts {0} are kept, gain of changing them is {1:.2f}'.format(
+                    changed, change_gain))
+                clusters, plan = kept, kept_plan
+        self.do_migrations(hosts, plan)
+        return hosts, clusters, plan
 
-        for rank in self.clusters:
-            self.logger.info('Rank:' + str(rank))
-            for host in self.clusters[rank]:
-                self.logger.info('    Host ID: ' + str(host['id']))
-                for vm_id in host['vms_v']:
-                    vm = self.get_vm(int(vm_id))
-                    self.logger.info('        VM ID: ' + str(vm['id']) + ' - ' + str(vm['class']) if 'class' in vm else '')
+    def perform_strategy(self):
+        self.cluster_snapshot = self.get_cluster_snapshot()
+        with self.phase('get_running_vms_on_hosts'):
+            hosts_ids = self.get_ovz_hosts_ids()
+            self.vms = self.get_running_vms_on_hosts(hosts_ids)
+        with self.phase('give_class_to_vms'):
+            self.give_class_to_vms()
+        # Ranks of hosts which are not managed anymore are forgotten
+        self.host_ranks = {host_id: rank for host_id, rank in self.host_ranks.items() if host_id in hosts_ids}
+
+        # Clusters are classified and planned in parallel, migrations of all clusters are
+        # executed together
+        cluster_ids = sorted(self.ovz_hosts_of_clusters)
+        with self.phase('rebalance_clusters'):
+            self.prefetch_host_vms()
+            results = parallel.map_parallel(self.rebalance_cluster, [(cluster_id, ) for cluster_id in cluster_ids],
+                                            self.max_parallel_clusters)
+        self.hosts = []
+        self.clusters = {}
+        plans = {}
+        moves = []
+        for cluster_id, (result, error) in zip(cluster_ids, results):
+            if error is not None:
+                self.logger.error('Failed to rebalance cluster {0}: {1}'.format(cluster_id, error), exc_info=error)
+                continue
+            hosts, clusters, plan = result
+            self.hosts.extend(hosts)
+            self.clusters[cluster_id] = clusters
+            for rank in clusters:
+                for host in clusters[rank]:
+                    self.host_ranks[host['id']] = rank
+            plans[cluster_id] = plan
+            self.logger.info('Cluster {0} plan: {1} of {2} misplaced VMs, {3:.0f} MB of memory, gain {4:.2f}'.format(
+                cluster_id, len(plan), sum(host['count'][1 - rank] for rank in [0, 1] for host in clusters[rank]),
+                plan.get_migrated_memory() / 1024.0, plan.gain))
+            for move in plan.moves:
+                self.logger.info('    VM {vm}: {source} --> {destination}, gain {gain:.2f}, cost {cost:.2f}'.format(**move))
+            if plan and not plan.accepted:
+                self.logger.info('Gain of the plan of cluster {0} is below rebalance_threshold, '
+                                 'current placement is kept'.format(cluster_id))
+            elif plan:
+                moves.extend(plan.moves)
+        if self.plan_path:
+            rebalance.save_plans(self.plan_path, plans)
+        if moves and self.dry_run:
+            self.logger.info('Dry run, migrations are not executed')
+        elif moves:
+            with self.phase('execute_migrations'):
+                report = self.migration_executor.run(moves)
+            self.logger.info('Migrations: {planned} planned, {succeeded} succeeded, {retried} retried, '
+                             '{rolled_back} rolled back, {failed} failed, {abandoned} abandoned in {duration:.0f} '
+                             'seconds ({throughput:.1f} per minute)'.format(**report))
+
+        for cluster_id in sorted(self.clusters):
+            for rank in self.clusters[cluster_id]:
+                self.logger.info('Cluster: ' + str(cluster_id) + ' Rank:' + str(rank))
+                for host in self.clusters[cluster_id][rank]:
+                    self.logger.info('    Host ID: ' + str(host['id']))
+                    for vm_id in host['vms_v']:
+                        vm = self.get_vm(int(vm_id))
+                        if vm is None:
+                            continue
+                        self.logger.debug('        VM ID: ' + str(vm['id']) + ' - ' + str(vm['class']) if 'class' in vm else '')
 
 target_class = RankedStrategy
@@ -0,0 +1,44 @@
+import importlib.util
+import itertools
+import os
+
+import pytest
+
+import fake_backend
+import smartsched.daemon.clock as clocks
+
+STRATEGIES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'strategy_examples')
+START_TIME = 1500000000.0
+
+_modules = itertools.count()
+
+
+@pytest.fixture
+def virtual_clock():
+    return clocks.VirtualClock(START_TIME)
+
+
+@pytest.fixture
+def make_strategy(tmp_path, monkeypatch):
+    """Construct an example strategy working on the fake cluster in virtual time.
+
+    Usage:
+        strategy = make_strategy('PlacePendingStrategy.py', cluster, {'sleep_time': '10', ...})
+    """
+    common = pytest.importorskip('smartsched.common')
+
+    def make(file_name, cluster, config):
+        monkeypatch.setattr(common, 'get_cloud_handler', lambda: fake_backend.FakeCloud(cluster))
+        monkeypatch.setattr(common, 'get_monitoring_handler', lambda: fake_backend.FakeMonitoring(cluster))
+        # Fresh module for every test, so class attributes do not leak between tests
+        spec = importlib.util.spec_from_file_location('test_strategy_' + str(next(_modules)),
+                                                      os.path.join(STRATEGIES_DIR, file_name))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        strategy_class = module.target_class
+        strategy_class.clock = cluster.clock
+        strategy_class.managed = True
+        config = dict(config, name='test', log_filename=str(tmp_path / 'strategy.log'),
+                      log_name='test.' + module.__name__, log_level='INFO')
+        return strategy_class(config)
+    return make
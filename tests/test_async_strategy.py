@@ -0,0 +1,102 @@
+import asyncio
+import itertools
+import threading
+import time
+
+import pytest
+
+from smartsched.daemon import async_strategy
+from smartsched.daemon import metrics
+from smartsched.daemon import parallel
+
+_names = itertools.count()
+
+
+class CountingStrategy(async_strategy.AsyncBaseStrategy):
+    managed = True
+
+    def __init__(self, config_dict):
+        async_strategy.AsyncBaseStrategy.__init__(self, config_dict)
+        self.cycles = []
+
+    async def perform_strategy(self):
+        self.cycles.append(self.clock.time())
+        if len(self.cycles) == 3:
+            self.shutdown = True
+        return False
+
+
+@pytest.fixture
+def make_config(tmp_path):
+    def make(**options):
+        config = {'sleep_time': '10', 'log_name': 'test.async.' + str(next(_names)), 'log_level': 'INFO',
+                  'log_filename': str(tmp_path / 'strategy.log')}
+        config.update(options)
+        return config
+    return make
+
+
+def test_cycles_follow_schedule_in_virtual_time(make_config, virtual_clock, monkeypatch):
+    monkeypatch.setattr(CountingStrategy, 'clock', virtual_clock)
+    strategy = CountingStrategy(make_config())
+    start = virtual_clock.time()
+    strategy.run()
+    assert strategy.cycles == [start, start + 10, start + 20]
+    assert strategy.loop.is_closed()
+
+
+def test_blocking_calls_overlap_and_errors_are_isolated(make_config):
+    strategy = CountingStrategy(make_config(executor_threads='3'))
+    barrier = threading.Barrier(3)
+
+    def query(value):
+        # Fails unless all three calls run at the same time
+        barrier.wait(5)
+        if value == 0:
+            raise ValueError('no value')
+        return value * 2
+
+    results = strategy.get_loop().run_until_complete(strategy.map_blocking(query, [(1, ), (0, ), (3, )]))
+    assert [result for result, error in results] == [2, None, 6]
+    assert isinstance(results[1][1], ValueError)
+    strategy.executor.shutdown()
+
+
+def test_wake_up_from_other_thread_interrupts_sleep(make_config):
+    strategy = CountingStrategy(make_config())
+    loop = strategy.get_loop()
+    threading.Timer(0.05, strategy.wake_up).start()
+    started = time.monotonic()
+    assert loop.run_until_complete(strategy.sleep(30))
+    assert time.monotonic() - started < 5
+    assert not loop.run_until_complete(strategy.sleep(0.01))
+    strategy.executor.shutdown()
+
+
+def test_failed_cycle_is_counted(make_config):
+    class FailingStrategy(CountingStrategy):
+        async def perform_strategy(self):
+            await asyncio.sleep(0)
+            raise RuntimeError('cloud is down')
+
+    strategy = FailingStrategy(make_config())
+    with pytest.raises(RuntimeError):
+        strategy.perform_cycle()
+    snapshot = strategy.metrics.snapshot()
+    assert snapshot['counters'][(metrics.CYCLE_ERRORS, ())] == 1
+    assert snapshot['histograms'][(metrics.CYCLE_DURATION, ())]['count'] == 1
+    strategy.executor.shutdown()
+
+
+def test_cpu_of_blocking_calls_is_charged_to_account(make_config):
+    strategy = CountingStrategy(make_config())
+
+    def busy():
+        end = time.thread_time() + 0.1
+        while time.thread_time() < end:
+            pass
+
+    with parallel.CpuAccount() as account:
+        strategy.get_loop().run_until_complete(strategy.run_blocking(busy))
+    assert account.cpu >= 0.1
+    strategy.executor.shutdown()
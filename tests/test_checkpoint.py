@@ -0,0 +1,56 @@
+import pytest
+
+from smartsched.daemon import checkpoint
+
+
+def test_round_trip(tmp_path):
+    path = checkpoint.get_checkpoint_path(str(tmp_path / 'checkpoints'), 'ranked')
+    state = {'deploying': {42: {'host_id': 7, 'started': 100.5}}, 'first_seen': {42: 99.0}}
+    size = checkpoint.save(path, 123.5, 'RankedStrategy:3', state)
+    assert size > checkpoint.HEADER.size
+    assert checkpoint.load(path) == (123.5, 'RankedStrategy:3', state)
+
+
+def test_shared_references_are_kept(tmp_path):
+    path = str(tmp_path / 'pp.checkpoint')
+    entry = {'vm': {'id': 1}}
+    checkpoint.save(path, 0, 'tag', {'mesh': [entry], 'deploying': {1: {'entry': entry}}})
+    state = checkpoint.load(path)[2]
+    assert state['deploying'][1]['entry'] is state['mesh'][0]
+
+
+def test_save_replaces_previous_checkpoint(tmp_path):
+    path = str(tmp_path / 'pp.checkpoint')
+    checkpoint.save(path, 1, 'tag', 'old')
+    checkpoint.save(path, 2, 'tag', 'new')
+    assert checkpoint.load(path) == (2, 'tag', 'new')
+    assert not (tmp_path / 'pp.checkpoint.tmp').exists()
+
+
+def test_missing_checkpoint(tmp_path):
+    with pytest.raises(checkpoint.CheckpointError):
+        checkpoint.load(str(tmp_path / 'missing.checkpoint'))
+
+
+def test_truncated_checkpoint(tmp_path):
+    path = tmp_path / 'pp.checkpoint'
+    checkpoint.save(str(path), 0, 'tag', list(range(1000)))
+    path.write_bytes(path.read_bytes()[:-10])
+    with pytest.raises(checkpoint.CheckpointError):
+        checkpoint.load(str(path))
+
+
+def test_unknown_format(tmp_path):
+    path = tmp_path / 'pp.checkpoint'
+    path.write_bytes(b'x' * 100)
+    with pytest.raises(checkpoint.CheckpointError):
+        checkpoint.load(str(path))
+
+
+def test_discard(tmp_path):
+    path = str(tmp_path / 'pp.checkpoint')
+    checkpoint.save(path, 0, 'tag', None)
+    checkpoint.discard(path)
+    checkpoint.discard(path)
+    with pytest.raises(checkpoint.CheckpointError):
+        checkpoint.load(path)
@@ -0,0 +1,91 @@
+import pytest
+
+from smartsched.daemon import cluster_snapshot
+
+
+def make_snapshot(hosts=2, vms=3):
+    return {'time': 0,
+            'hosts': {108: [{'id': host_id, 'vms': [str(vm_id) for vm_id in range(vms)]} for host_id in range(hosts)]},
+            'vms': [{'id': vm_id} for vm_id in range(vms)],
+            'host_metrics': {}}
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'snapshot')
+
+
+def test_round_trip(path):
+    writer = cluster_snapshot.SnapshotWriter(path)
+    writer.write(make_snapshot())
+    timestamp, snapshot = cluster_snapshot.SnapshotReader(path).read()
+    assert snapshot == make_snapshot()
+    assert timestamp > 0
+    writer.close()
+
+
+def test_nothing_published(path):
+    writer = cluster_snapshot.SnapshotWriter(path)
+    with pytest.raises(cluster_snapshot.SnapshotError):
+        cluster_snapshot.SnapshotReader(path).read()
+    writer.close()
+
+
+def test_missing_file(path):
+    with pytest.raises(cluster_snapshot.SnapshotError):
+        cluster_snapshot.SnapshotReader(path).read()
+
+
+def test_reader_sees_latest_snapshot_after_growth(path):
+    writer = cluster_snapshot.SnapshotWriter(path)
+    reader = cluster_snapshot.SnapshotReader(path)
+    writer.write(make_snapshot())
+    reader.read()
+    # Bigger than the initial capacity, the file is grown
+    big = make_snapshot(hosts=10, vms=100000)
+    writer.write(big)
+    assert reader.read()[1] == big
+    writer.close()
+
+
+def test_every_read_returns_new_objects(path):
+    writer = cluster_snapshot.SnapshotWriter(path)
+    writer.write(make_snapshot())
+    reader = cluster_snapshot.SnapshotReader(path)
+    reader.read()[1]['vms'].clear()
+    assert len(reader.read()[1]['vms']) == 3
+    writer.close()
+
+
+def test_reader_does_not_return_snapshot_being_written(path, monkeypatch):
+    writer = cluster_snapshot.SnapshotWriter(path)
+    writer.write(make_snapshot())
+    # Writer is in the middle of the next write: sequence is odd
+    writer.sequence += 1
+    cluster_snapshot.HEADER.pack_into(writer.mm, 0, cluster_snapshot.MAGIC, cluster_snapshot.FORMAT_VERSION,
+                                      writer.sequence, 0, 0)
+    monkeypatch.setattr(cluster_snapshot.time, 'sleep', lambda seconds: None)
+    with pytest.raises(cluster_snapshot.SnapshotError):
+        cluster_snapshot.SnapshotReader(path).read()
+    writer.close()
+
+
+def test_restarted_writer_continues_sequence(path):
+    writer = cluster_snapshot.SnapshotWriter(path)
+    writer.write(make_snapshot())
+    # Writer killed in the middle of writing leaves odd sequence
+    writer.sequence += 1
+    cluster_snapshot.HEADER.pack_into(writer.mm, 0, cluster_snapshot.MAGIC, cluster_snapshot.FORMAT_VERSION,
+                                      writer.sequence, 0, 0)
+    writer.close()
+    writer = cluster_snapshot.SnapshotWriter(path)
+    assert writer.sequence % 2 == 0
+    writer.write(make_snapshot(hosts=1))
+    assert cluster_snapshot.SnapshotReader(path).read()[1] == make_snapshot(hosts=1)
+    writer.close()
+
+
+def test_hosts_of_clusters():
+    snapshot = make_snapshot()
+    assert [host['id'] for host in cluster_snapshot.hosts_of_clusters(snapshot, ['108'])] == [0, 1]
+    assert cluster_snapshot.hosts_of_clusters(snapshot, [108, 109]) is None
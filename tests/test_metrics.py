@@ -0,0 +1,66 @@
+import pytest
+
+from smartsched.daemon import metrics
+
+
+class Handler:
+    name = 'fake'
+
+    def ok(self, value):
+        return value
+
+    def fail(self):
+        raise RuntimeError('down')
+
+
+def test_histogram_buckets():
+    strategy_metrics = metrics.StrategyMetrics()
+    for value in (0.001, 0.3, 0.3, 7200):
+        strategy_metrics.observe(metrics.CYCLE_DURATION, (), value)
+    histogram = strategy_metrics.snapshot()['histograms'][(metrics.CYCLE_DURATION, ())]
+    assert histogram['count'] == 4
+    assert histogram['buckets'][0] == 1
+    assert histogram['buckets'][metrics.BUCKETS.index(0.5)] == 2
+    assert histogram['buckets'][-1] == 1
+
+
+def test_instrumented_handler_counts_calls_and_errors():
+    strategy_metrics = metrics.StrategyMetrics()
+    handler = metrics.InstrumentedHandler(Handler(), 'cloud', strategy_metrics)
+    assert handler.ok(5) == 5
+    assert handler.name == 'fake'
+    with pytest.raises(RuntimeError):
+        handler.fail()
+    snapshot = strategy_metrics.snapshot()
+    ok_labels = (('handler', 'cloud'), ('method', 'ok'))
+    fail_labels = (('handler', 'cloud'), ('method', 'fail'))
+    assert snapshot['histograms'][(metrics.RPC_DURATION, ok_labels)]['count'] == 1
+    assert snapshot['histograms'][(metrics.RPC_DURATION, fail_labels)]['count'] == 1
+    assert snapshot['counters'] == {(metrics.RPC_ERRORS, fail_labels): 1}
+
+
+def test_counters_survive_restart_of_strategy():
+    aggregator = metrics.MetricsAggregator(None, None)
+    labels = (('result', 'ok'), )
+    aggregator.add('ranked', 100, {'counters': {(metrics.MIGRATIONS, labels): 3}, 'histograms': {}})
+    aggregator.add('ranked', 100, {'counters': {(metrics.MIGRATIONS, labels): 5}, 'histograms': {}})
+    # New process starts counting from zero
+    aggregator.add('ranked', 200, {'counters': {(metrics.MIGRATIONS, labels): 1}, 'histograms': {}})
+    assert aggregator.collect()['ranked']['counters'][(metrics.MIGRATIONS, labels)] == 6
+
+
+def test_prometheus_text(tmp_path):
+    strategy_metrics = metrics.StrategyMetrics()
+    strategy_metrics.increment(metrics.CYCLE_ERRORS)
+    strategy_metrics.observe(metrics.PHASE_DURATION, (('phase', 'deploy'), ), 0.02)
+    aggregator = metrics.MetricsAggregator(None, str(tmp_path / 'smartsched.prom'))
+    aggregator.add('pp', 1, strategy_metrics.snapshot())
+    aggregator.write()
+    lines = (tmp_path / 'smartsched.prom').read_text().splitlines()
+    assert '# TYPE smartsched_cycle_errors_total counter' in lines
+    assert 'smartsched_cycle_errors_total{strategy="pp"} 1' in lines
+    assert 'smartsched_phase_duration_seconds_bucket{strategy="pp",phase="deploy",le="0.01"} 0' in lines
+    assert 'smartsched_phase_duration_seconds_bucket{strategy="pp",phase="deploy",le="0.025"} 1' in lines
+    assert 'smartsched_phase_duration_seconds_bucket{strategy="pp",phase="deploy",le="+Inf"} 1' in lines
+    assert 'smartsched_phase_duration_seconds_count{strategy="pp",phase="deploy"} 1' in lines
+    assert not (tmp_path / 'smartsched.prom.tmp').exists()
@@ -0,0 +1,101 @@
+import logging
+
+from smartsched.daemon import clock
+from smartsched.daemon import migration_executor
+
+
+class ScriptedCloud:
+    """Cloud whose VM 1 is in the state returned by script(poll, migrate calls)."""
+
+    def __init__(self, script):
+        self.script = script
+        self.migrations = []
+        self.polls = 0
+
+    def migrate(self, vm_id, host_id, live, enforce):
+        self.migrations.append((vm_id, host_id, live))
+
+    def get_vms_repr(self, startId=-1, endId=-1, vmStateFilter=-1):
+        self.polls += 1
+        state, lcm_state, hid = self.script(self.polls, self.migrations)
+        return [{'id': 1, 'state': state, 'lcm_state': lcm_state, 'hid': hid}]
+
+
+def run(script, timeout=100):
+    virtual_clock = clock.VirtualClock()
+    cloud = ScriptedCloud(script)
+    executor = migration_executor.MigrationExecutor(cloud, logging.getLogger('test'), virtual_clock,
+                                                    virtual_clock.sleep, timeout=timeout, poll_interval=10)
+    report = executor.run([{'vm': 1, 'source': 10, 'destination': 20}])
+    return report, cloud.migrations
+
+
+def test_success():
+    report, migrations = run(lambda poll, migrations: ('ACTIVE', 'RUNNING', 20))
+    assert report['succeeded'] == 1
+    assert migrations == [(1, 20, True)]
+
+
+def test_retry_when_vm_stays_on_source():
+    report, migrations = run(lambda poll, migrations: ('ACTIVE', 'RUNNING', 10 if poll == 1 else 20))
+    assert (report['retried'], report['succeeded']) == (1, 1)
+    assert migrations == [(1, 20, True), (1, 20, True)]
+
+
+def test_rollback_waits_for_failed_vm_to_settle():
+    def script(poll, migrations):
+        if len(migrations) == 2:
+            return 'ACTIVE', 'RUNNING', 10
+        if poll < 5:
+            return 'ACTIVE', 'FAILURE', 20
+        return 'POWEROFF', 'LCM_INIT', 20
+
+    report, migrations = run(script)
+    assert report['rolled_back'] == 1
+    # Cold migration back is requested only when the VM is stable
+    assert migrations == [(1, 20, True), (1, 10, False)]
+
+
+def test_timed_out_migration_finishing_late_is_not_rolled_back():
+    report, migrations = run(lambda poll, migrations: ('ACTIVE', 'MIGRATE' if poll < 15 else 'RUNNING', 20))
+    assert report['succeeded'] == 1
+    assert migrations == [(1, 20, True)]
+
+
+def test_vm_failed_on_source_is_not_rolled_back():
+    report, migrations = run(lambda poll, migrations: ('ACTIVE', 'FAILURE', 10))
+    assert report['failed'] == 1
+    assert migrations == [(1, 20, True)]
+
+
+def test_vm_which_does_not_settle_is_failed():
+    report, migrations = run(lambda poll, migrations: ('ACTIVE', 'FAILURE', 20))
+    assert report['failed'] == 1
+    assert migrations == [(1, 20, True)]
+
+
+class RangeRecordingCloud:
+    """Cloud where every migration succeeds at once, requested id ranges are recorded."""
+
+    def __init__(self):
+        self.hosts = {}
+        self.ranges = []
+
+    def migrate(self, vm_id, host_id, live, enforce):
+        self.hosts[vm_id] = host_id
+
+    def get_vms_repr(self, startId=-1, endId=-1, vmStateFilter=-1):
+        self.ranges.append((startId, endId))
+        return [{'id': vm_id, 'state': 'ACTIVE', 'lcm_state': 'RUNNING', 'hid': host_id}
+                for vm_id, host_id in self.hosts.items() if startId <= vm_id <= endId]
+
+
+def test_poll_requests_only_ranges_of_migrating_vms():
+    virtual_clock = clock.VirtualClock()
+    cloud = RangeRecordingCloud()
+    executor = migration_executor.MigrationExecutor(cloud, logging.getLogger('test'), virtual_clock,
+                                                    virtual_clock.sleep, max_per_destination=2)
+    report = executor.run([{'vm': 5, 'source': 10, 'destination': 20},
+                           {'vm': 900000, 'source': 11, 'destination': 20}])
+    assert report['succeeded'] == 2
+    assert sorted(cloud.ranges) == [(5, 5), (900000, 900000)]
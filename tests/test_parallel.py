@@ -0,0 +1,63 @@
+import threading
+import time
+
+from smartsched.daemon import parallel
+
+
+def test_results_keep_order_and_errors_are_isolated():
+    def divide(value):
+        return 12 // value
+    results = parallel.map_parallel(divide, [(1, ), (0, ), (3, )], max_parallel=3)
+    assert [result for result, error in results] == [12, None, 4]
+    assert isinstance(results[1][1], ZeroDivisionError)
+
+
+def test_every_thread_gets_its_own_handler():
+    created = []
+
+    class Handler:
+        def __init__(self):
+            created.append(self)
+            self.thread = threading.current_thread()
+
+        def owner(self):
+            return self.thread is threading.current_thread()
+
+    handler = parallel.PerThreadHandler(Handler)
+    barrier = threading.Barrier(4)
+    # Method is taken in the main thread, but called by the workers
+    owner = handler.owner
+
+    def call():
+        # All workers are alive at once, so none of them reuses a thread of the other
+        barrier.wait(5)
+        return owner()
+    results = parallel.map_parallel(call, [()] * 4, max_parallel=4)
+    assert results == [(True, None)] * 4
+    assert len(created) == 4
+    assert handler.owner()
+    assert len(created) == 5
+
+
+def busy(seconds):
+    end = time.thread_time() + seconds
+    while time.thread_time() < end:
+        pass
+
+
+def test_cpu_of_helper_threads_is_charged_to_account():
+    with parallel.CpuAccount() as account:
+        parallel.map_parallel(busy, [(0.05, )] * 4, max_parallel=4)
+    assert account.cpu >= 0.2
+    # Threads started without the account are not charged
+    parallel.map_parallel(busy, [(0.05, )] * 2, max_parallel=2)
+    assert account.cpu < 0.3
+
+
+def test_nested_helper_threads_are_charged_once():
+    def nested():
+        parallel.map_parallel(busy, [(0.05, )] * 2, max_parallel=2)
+
+    with parallel.CpuAccount() as account:
+        parallel.map_parallel(nested, [()] * 2, max_parallel=2)
+    assert 0.2 <= account.cpu < 0.3
@@ -0,0 +1,95 @@
+import pytest
+
+from smartsched.daemon import pending_queue
+
+
+def vm(vm_id, cpu=1, mem=1024, cluster_id=108, uid=0):
+    return {'id': vm_id, 'cpu_allocated': cpu, 'mem_allocated': mem, 'cluster_id': [cluster_id], 'uid': uid}
+
+
+def ids(queue):
+    return [item['id'] for item in queue.ordered()]
+
+
+def test_age_priority_keeps_first_seen():
+    queue = pending_queue.PendingQueue('age')
+    queue.update([vm(3)], now=10)
+    queue.update([vm(1), vm(3)], now=20)
+    queue.update([vm(2), vm(1), vm(3)], now=30)
+    assert ids(queue) == [3, 1, 2]
+    assert queue.first_seen == {3: 10, 1: 20, 2: 30}
+
+
+def test_size_priority():
+    queue = pending_queue.PendingQueue('size')
+    queue.update([vm(1, mem=1024), vm(2, mem=4096), vm(3, cpu=4, mem=4096)], now=0)
+    assert ids(queue) == [3, 2, 1]
+
+
+def test_weight_priority():
+    weights = pending_queue.parse_weights('cluster:109=2, user:5=0.5')
+    assert weights == {('cluster', '109'): 2.0, ('user', '5'): 0.5}
+    queue = pending_queue.PendingQueue('weight', weights)
+    queue.update([vm(1, uid=5), vm(2), vm(3, cluster_id=109)], now=0)
+    assert ids(queue) == [3, 2, 1]
+
+
+def test_vms_which_are_not_pending_are_removed():
+    queue = pending_queue.PendingQueue()
+    queue.update([vm(1), vm(2), vm(3)], now=0)
+    queue.remove(2)
+    assert 2 not in queue
+    queue.update([vm(1)], now=10)
+    assert ids(queue) == [1]
+    assert len(queue) == 1
+    assert queue.first_seen == {1: 0}
+
+
+def test_kept_vm_does_not_lose_its_age():
+    queue = pending_queue.PendingQueue()
+    queue.update([vm(1), vm(2)], now=0)
+    # VM 1 is being deployed, its deploy fails and it is pending again
+    queue.update([vm(2)], now=10, keep=[1])
+    queue.update([vm(2), vm(1)], now=20)
+    assert ids(queue) == [1, 2]
+    assert queue.first_seen[1] == 0
+
+
+def test_representation_is_refreshed():
+    queue = pending_queue.PendingQueue('size')
+    queue.update([vm(1, mem=1024), vm(2, mem=2048)], now=0)
+    queue.update([vm(1, mem=4096), vm(2, mem=2048)], now=10)
+    assert ids(queue) == [1, 2]
+    assert queue.ordered()[0]['mem_allocated'] == 4096
+
+
+def test_unknown_priority():
+    with pytest.raises(ValueError):
+        pending_queue.PendingQueue('random')
+
+
+def test_only_new_and_changed_vms_are_pushed():
+    queue = pending_queue.PendingQueue('size')
+    queue.update([vm(1), vm(2), vm(3)], now=0)
+    assert len(queue.heap) == 3
+    queue.update([vm(1), vm(2), vm(3)], now=10)
+    assert len(queue.heap) == 3
+    # Key of VM 2 changed and VM 4 is new, old item of VM 2 stays in the heap and is skipped
+    queue.update([vm(1), vm(2, mem=8192), vm(3), vm(4)], now=20)
+    assert len(queue.heap) == 5
+    assert ids(queue) == [2, 1, 3, 4]
+    assert len(queue.heap) == 4
+
+
+def test_removed_vms_are_skipped_and_compacted():
+    queue = pending_queue.PendingQueue()
+    queue.update([vm(vm_id) for vm_id in range(100)], now=0)
+    for vm_id in range(0, 100, 2):
+        queue.remove(vm_id)
+    assert queue.peek()['id'] == 1
+    assert queue.pop()['id'] == 1
+    assert queue.peek()['id'] == 3
+    queue.update([], now=10)
+    # Heap is compacted when most of its items are invalid
+    assert len(queue.heap) <= 16
+    assert queue.pop() is None
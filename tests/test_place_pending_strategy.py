@@ -0,0 +1,92 @@
+import fake_backend
+
+CONFIG = {'sleep_time': '10', 'cluster_list': '108',
+          'cpu_max_ovc': '3', 'mem_max_ovc': '2', 'cpu_max_usage': '90', 'mem_max_usage': '90',
+          'fresh_vm_timeframe': '5', 'deploy_waiting_time': '600'}
+
+
+def record_ranges(monkeypatch):
+    ranges = []
+    get_vms_repr = fake_backend.FakeCloud.get_vms_repr
+
+    def recording(self, startId=-1, endId=-1, vmStateFilter=-1):
+        ranges.append((startId, endId))
+        return get_vms_repr(self, startId, endId, vmStateFilter)
+    monkeypatch.setattr(fake_backend.FakeCloud, 'get_vms_repr', recording)
+    return ranges
+
+
+def test_check_deploy_requests_only_deploying_vms(make_strategy, virtual_clock, monkeypatch):
+    cluster = fake_backend.generate_cluster(hosts=4, vms_per_host=5, pending=1, seed=1, clock=virtual_clock,
+                                            deploy_time=100)
+    cluster.add_vm(900000, 108, 100, 1024 * 1024)
+    strategy = make_strategy('PlacePendingStrategy.py', cluster, dict(CONFIG, max_parallel_deploys='2'))
+    strategy.perform_strategy()
+    assert sorted(strategy.deploying) == [21, 900000]
+
+    ranges = record_ranges(monkeypatch)
+    virtual_clock.sleep(10)
+    strategy.check_deploy()
+    assert sorted(ranges) == [(21, 21), (900000, 900000)]
+
+
+def small_cluster(clock, host_cores=(4, 4), pending=((1, 3), (2, 3))):
+    """Hosts with given amount of cores and pending VMs (id, cores)."""
+    cluster = fake_backend.FakeCluster(clock, deploy_time=100)
+    for host_id, cores in enumerate(host_cores):
+        cluster.add_host(host_id, 108, cores * 100, 16 * 1024 * 1024)
+    for vm_id, cores in pending:
+        cluster.add_vm(vm_id, 108, cores * 100, 1024 * 1024)
+    return cluster
+
+
+def rpc_calls(strategy, handler, method):
+    histogram = strategy.metrics.snapshot()['histograms'].get(
+        ('smartsched_rpc_duration_seconds', (('handler', handler), ('method', method))))
+    return histogram['count'] if histogram else 0
+
+
+def test_hosts_are_queried_once_per_cycle(make_strategy, virtual_clock):
+    cluster = fake_backend.generate_cluster(hosts=4, vms_per_host=5, pending=30, seed=1, clock=virtual_clock)
+    strategy = make_strategy('PlacePendingStrategy.py', cluster, CONFIG)
+    strategy.perform_strategy()
+    assert len(strategy.deploy_mesh) > 1
+    # One snapshot of the cluster serves all pending VMs
+    assert rpc_calls(strategy, 'cloud', 'get_hosts_of_cluster') == 1
+    assert rpc_calls(strategy, 'monitoring', 'get_host_load') == 4 * 4
+    assert rpc_calls(strategy, 'cloud', 'get_vm_repr') == 0
+
+
+def test_deploys_are_pipelined(make_strategy, virtual_clock):
+    cluster = fake_backend.generate_cluster(hosts=4, vms_per_host=2, pending=6, vm_cores=(1, ), seed=2,
+                                            clock=virtual_clock, deploy_time=100)
+    strategy = make_strategy('PlacePendingStrategy.py', cluster, dict(CONFIG, max_parallel_deploys='3'))
+    strategy.perform_strategy()
+    assert len(strategy.deploying) == 3
+    assert len(cluster.history) == 3
+
+    virtual_clock.sleep(100)
+    strategy.perform_strategy()
+    assert len(cluster.history) == 6
+    assert len(strategy.deploying) == 3
+    virtual_clock.sleep(100)
+    strategy.perform_strategy()
+    assert strategy.deploying == {}
+    assert all(vm['lcm_state'] == 'RUNNING' for vm in cluster.vms.values())
+
+
+def test_deploying_vm_reserves_its_host(make_strategy, virtual_clock):
+    cluster = small_cluster(virtual_clock)
+    strategy = make_strategy('PlacePendingStrategy.py', cluster,
+                             dict(CONFIG, cpu_max_ovc='1', max_parallel_deploys='2'))
+    strategy.perform_strategy()
+    # Both VMs are deployed at once, but only one of them fits a host
+    assert sorted(deploy['host'] for deploy in cluster.history) == [0, 1]
+
+
+def test_biggest_vm_is_deployed_first(make_strategy, virtual_clock):
+    cluster = small_cluster(virtual_clock, host_cores=(4, ), pending=((1, 1), (2, 3)))
+    strategy = make_strategy('PlacePendingStrategy.py', cluster,
+                             dict(CONFIG, cpu_max_ovc='1', pending_priority='size'))
+    strategy.perform_strategy()
+    assert [deploy['vm'] for deploy in cluster.history] == [2]
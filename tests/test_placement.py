@@ -0,0 +1,69 @@
+import pytest
+
+from smartsched.daemon import placement
+
+
+def host(cpu_allocated=0.0, mem_allocated=0.0, cpu_used=0.0, mem_used=0.0, cpu_free=32.0, mem_free=128.0):
+    return {'cpu_max': 32.0, 'mem_max': 128.0,
+            'cpu_allocated': cpu_allocated, 'mem_allocated': mem_allocated,
+            'cpu_used': cpu_used, 'mem_used': mem_used,
+            'cpu_free': cpu_free, 'mem_free': mem_free}
+
+
+def vm(cpu=4.0, mem=16.0, max_ovc=1.0, max_usage=1.0):
+    return {'cpu_req': cpu, 'mem_req': mem, 'cpu_allocated': cpu, 'mem_allocated': mem,
+            'cpu_max_ovc': max_ovc, 'mem_max_ovc': max_ovc, 'cpu_max_usage': max_usage, 'mem_max_usage': max_usage}
+
+
+def feasible_hosts(engine, vm_row, ranking='best_fit'):
+    feasible, score = engine.evaluate([vm_row], ranking)
+    return [int(index) for index in feasible[0].nonzero()[0]]
+
+
+def test_allocation_over_overcommit_is_rejected():
+    engine = placement.PlacementEngine([host(cpu_allocated=28.0), host(cpu_allocated=60.0)])
+    # (28 + 4) / 32 = 1, (60 + 4) / 32 = 2
+    assert feasible_hosts(engine, vm(max_ovc=1.0)) == [0]
+    assert feasible_hosts(engine, vm(max_ovc=0.9)) == []
+    assert feasible_hosts(engine, vm(max_ovc=2.0)) == [0, 1]
+
+
+def test_usage_limit_is_checked():
+    engine = placement.PlacementEngine([host(cpu_used=10.0), host(cpu_used=20.0)])
+    # (20 + 4) / 32 = 0.75
+    assert feasible_hosts(engine, vm(max_ovc=10, max_usage=0.5)) == [0]
+    assert feasible_hosts(engine, vm(max_ovc=10, max_usage=0.75)) == [0, 1]
+
+
+def test_request_should_fit_free_resources():
+    engine = placement.PlacementEngine([host(mem_free=8.0), host(mem_free=16.0)])
+    assert feasible_hosts(engine, vm(mem=16.0)) == [1]
+
+
+def test_set_host_updates_admission():
+    engine = placement.PlacementEngine([host()])
+    assert feasible_hosts(engine, vm()) == [0]
+    engine.set_host(0, host(cpu_allocated=30.0))
+    assert feasible_hosts(engine, vm()) == []
+
+
+@pytest.mark.parametrize('ranking, best', [('best_fit', 1), ('worst_fit', 0), ('first_fit', 0)])
+def test_rankings(ranking, best):
+    engine = placement.PlacementEngine([host(cpu_allocated=4.0, mem_allocated=16.0),
+                                        host(cpu_allocated=16.0, mem_allocated=64.0)])
+    feasible, score = engine.evaluate([vm()], ranking)
+    assert feasible[0].all()
+    assert int(score[0].argmax()) == best
+
+
+def test_infeasible_pair_has_lowest_score():
+    engine = placement.PlacementEngine([host(cpu_free=0.0), host()])
+    feasible, score = engine.evaluate([vm()], 'best_fit')
+    assert score[0][0] == float('-inf')
+    assert score[0][1] > score[0][0]
+
+
+def test_unknown_ranking():
+    engine = placement.PlacementEngine([host()])
+    with pytest.raises(ValueError):
+        engine.evaluate([vm()], 'random')
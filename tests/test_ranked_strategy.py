@@ -0,0 +1,62 @@
+import threading
+
+import fake_backend
+
+CONFIG = {'sleep_time': '3700', 'min_lifetime': '3600', 'cluster_list': '108,109', 'psquare': '0.1',
+          'cpu_max_ovc_0': '3', 'mem_max_ovc_0': '2', 'cpu_max_usage_0': '0.8', 'mem_max_usage_0': '0.8',
+          'cpu_max_ovc_1': '1', 'mem_max_ovc_1': '1', 'cpu_max_usage_1': '1', 'mem_max_usage_1': '1'}
+
+
+def test_clusters_are_rebalanced_in_parallel_without_sharing_cloud_handler(make_strategy, virtual_clock,
+                                                                           monkeypatch):
+    cluster = fake_backend.generate_cluster(hosts=8, vms_per_host=6, pending=0, fresh_ratio=0, seed=3,
+                                            clock=virtual_clock, clusters=2)
+    calls = []
+    call = fake_backend.FakeHandler._call
+
+    def recording(self, method):
+        calls.append((threading.current_thread(), self))
+        return call(self, method)
+    monkeypatch.setattr(fake_backend.FakeHandler, '_call', recording)
+    strategy = make_strategy('RankedStrategy.py', cluster,
+                             dict(CONFIG, max_parallel_clusters='2', max_parallel_queries='4', dry_run='yes'))
+    strategy.perform_strategy()
+
+    # Every handler was used by one thread only
+    threads = {}
+    for thread, handler in calls:
+        threads.setdefault(id(handler), set()).add(thread)
+    assert len(set(thread for thread, handler in calls)) > 1
+    assert all(len(handler_threads) == 1 for handler_threads in threads.values())
+    # Ranks of both clusters are merged after the parallel section
+    assert sorted(strategy.clusters) == [108, 109]
+    assert sorted(strategy.host_ranks) == sorted(cluster.hosts)
+    for cluster_id, clusters in strategy.clusters.items():
+        for rank, hosts in clusters.items():
+            assert all(strategy.host_ranks[host['id']] == rank for host in hosts)
+            assert all(host['cluster_id'] == cluster_id for host in hosts)
+
+
+def test_only_new_probes_are_fetched_in_next_cycle(make_strategy, virtual_clock, monkeypatch):
+    cluster = fake_backend.generate_cluster(hosts=2, vms_per_host=3, pending=0, fresh_ratio=0, seed=4,
+                                            clock=virtual_clock)
+    limits = []
+    get_ovz_vm = fake_backend.FakeMonitoring.get_ovz_vm
+
+    def recording(self, vm_id, fields, limit=60):
+        limits.append(limit)
+        return get_ovz_vm(self, vm_id, fields, limit)
+    monkeypatch.setattr(fake_backend.FakeMonitoring, 'get_ovz_vm', recording)
+    strategy = make_strategy('RankedStrategy.py', cluster, dict(CONFIG, cluster_list='108', dry_run='yes'))
+    strategy.perform_strategy()
+    assert limits == [60] * 6
+    classes = dict(strategy.vm_classes)
+
+    del limits[:]
+    virtual_clock.sleep(600)
+    strategy.perform_strategy()
+    # Ten minutes of new probes plus the last seen one
+    assert limits == [11] * 6
+    # Probes of the last hour, both ends included
+    assert all(stats['count'] == 61 for stats in strategy.usage_stats.aggregate(classes).values())
+    assert strategy.vm_classes == classes
@@ -0,0 +1,77 @@
+import itertools
+import logging
+import time
+
+import pytest
+
+from smartsched.daemon import base_strategy
+from smartsched.daemon import parallel
+from smartsched.daemon import shared_pool
+
+_names = itertools.count()
+
+
+def busy(seconds):
+    end = time.thread_time() + seconds
+    while time.thread_time() < end:
+        pass
+
+
+class ParallelStrategy(base_strategy.BaseStrategy):
+    """Burns CPU in four helper threads every cycle."""
+
+    def perform_strategy(self):
+        parallel.map_parallel(busy, [(0.05, )] * 4, max_parallel=4)
+        return True
+
+
+class FailingStrategy(base_strategy.BaseStrategy):
+    def perform_strategy(self):
+        raise RuntimeError('cloud is down')
+
+
+class BrokenStrategy(base_strategy.BaseStrategy):
+    def __init__(self, config_dict):
+        raise ValueError('bad config')
+
+
+@pytest.fixture
+def make_pool(tmp_path):
+    def make(*classes):
+        entries = []
+        for target_class in classes:
+            name = target_class.__name__
+            entries.append((name, target_class, {'name': name, 'sleep_time': '60', 'log_level': 'INFO',
+                                                 'log_name': 'test.pool.' + str(next(_names)),
+                                                 'log_filename': str(tmp_path / 'strategy.log')}))
+        return shared_pool.SharedPool(entries, logging.getLogger('test.pool'), report_interval=0)
+    return make
+
+
+def test_strategy_which_can_not_be_created_is_skipped(make_pool):
+    pool = make_pool(BrokenStrategy, ParallelStrategy)
+    assert list(pool.strategies) == ['ParallelStrategy']
+    assert pool.strategies['ParallelStrategy'].managed
+
+
+def test_cpu_of_helper_threads_is_accounted(make_pool):
+    pool = make_pool(ParallelStrategy)
+    assert pool.perform_cycle('ParallelStrategy')
+    usage = pool.usage['ParallelStrategy']
+    assert usage['cycles'] == 1
+    assert usage['last_cpu'] >= 0.2
+    assert usage['cpu'] == usage['last_cpu']
+
+
+def test_failed_cycle_is_retried_after_sleep_time(make_pool):
+    pool = make_pool(FailingStrategy)
+    with pytest.raises(RuntimeError) as error:
+        pool.perform_cycle('FailingStrategy')
+
+    class Future:
+        def exception(self):
+            return error.value
+    intervals = {'FailingStrategy': 10}
+    assert pool.on_cycle_done('FailingStrategy', Future(), 0, intervals, 1000) == 1060
+    assert pool.usage['FailingStrategy']['errors'] == 1
+    assert pool.usage['FailingStrategy']['cycles'] == 1
@@ -0,0 +1,87 @@
+import collections
+import importlib.util
+import os
+
+import pytest
+
+import fake_backend
+
+pytest.importorskip('smartsched.common')
+import simulator  # noqa: E402
+
+STRATEGIES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'strategy_examples')
+
+
+def test_deploy_is_running_since_its_ready_time(virtual_clock):
+    cluster = fake_backend.FakeCluster(virtual_clock, deploy_time=60)
+    cluster.add_host(0, 108, 400, 1024 ** 2)
+    cluster.add_vm(1, 108, 100, 1024)
+    cluster.add_vm(2, 108, 100, 1024)
+    start = virtual_clock.time()
+    cluster.deploy(1, 0)
+    cluster.deploy(2, 0)
+    cluster.remove_vm(2)
+    virtual_clock.sleep(500)
+    assert [action['running'] for action in cluster.history] == [None, None]
+    # State is changed late, but the VM is RUNNING since the deploy was done
+    cluster.update()
+    assert cluster.vms[1]['lcm_state'] == 'RUNNING'
+    assert [action['running'] for action in cluster.history] == [start + 60, None]
+
+
+def load_strategy(file_name):
+    spec = importlib.util.spec_from_file_location('simulated_' + file_name[:-3], os.path.join(STRATEGIES_DIR, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.target_class
+
+
+def test_replay_measures_latency_till_running(tmp_path):
+    trace_path = str(tmp_path / 'day.trace')
+    simulator.generate_trace(trace_path, hosts=4, vms_per_host=3, days=0.25, interval=300, arrivals_per_hour=2,
+                             seed=5, start=1500000000.0)
+    config = {'name': 'place_pending', 'sleep_time': '60', 'cluster_list': '108',
+              'cpu_max_ovc': '3', 'mem_max_ovc': '2', 'cpu_max_usage': '90', 'mem_max_usage': '90',
+              'fresh_vm_timeframe': '1', 'deploy_waiting_time': '600', 'max_parallel_deploys': '4',
+              'log_name': 'test.simulator', 'log_level': 'INFO', 'log_filename': str(tmp_path / 'sim.log')}
+    replay = simulator.Simulator(load_strategy('PlacePendingStrategy.py'), config, trace_path, deploy_time=90)
+    report = replay.run()
+
+    assert report['frames'] == 72
+    assert report['deploys'] > 0
+    deploys = [action for action in replay.cluster.history if action['action'] == 'deploy']
+    assert report['deploys'] + report['deploys_not_running'] == len(deploys)
+    latencies = sorted(action['running'] - replay.pending_since[action['vm']]
+                       for action in deploys if action['running'] is not None)
+    assert report['deploy_latency']['max'] == latencies[-1]
+    assert report['deploy_latency']['p50'] >= 90
+
+
+def test_ranked_replay_moves_vms_at_most_once_in_steady_state(tmp_path):
+    # VMs arrive and terminate, but their usage and so their classes do not change
+    trace_path = str(tmp_path / 'day.trace')
+    simulator.generate_trace(trace_path, hosts=20, vms_per_host=10, days=1.05, interval=300, arrivals_per_hour=4,
+                             usage_changes_per_hour=0, seed=1, start=1500000000.0)
+    config = {'name': 'ranked', 'sleep_time': '3700', 'min_lifetime': '3600', 'cluster_list': '108',
+              'psquare': '0.1', 'cpu_max_ovc_0': '3', 'mem_max_ovc_0': '2', 'cpu_max_usage_0': '0.8',
+              'mem_max_usage_0': '0.8', 'cpu_max_ovc_1': '1', 'mem_max_ovc_1': '1', 'cpu_max_usage_1': '1',
+              'mem_max_usage_1': '1', 'log_name': 'test.simulator', 'log_level': 'INFO',
+              'log_filename': str(tmp_path / 'sim.log')}
+    strategy_class = load_strategy('RankedStrategy.py')
+    ranks = []
+    perform_strategy = strategy_class.perform_strategy
+
+    def recording(self):
+        perform_strategy(self)
+        ranks.append(dict(self.host_ranks))
+    strategy_class.perform_strategy = recording
+    replay = simulator.Simulator(strategy_class, config, trace_path, new_vms='trace')
+    replay.run()
+
+    assert len(ranks) == 25
+    moves = collections.Counter(action['vm'] for action in replay.cluster.history if action['action'] == 'migrate')
+    assert moves
+    assert max(moves.values()) == 1
+    # Ranks are settled after the first cycle, hosts which are ranked later keep their rank
+    for previous, current in zip(ranks, ranks[1:]):
+        assert all(current[host_id] == rank for host_id, rank in previous.items() if host_id in current)
@@ -0,0 +1,117 @@
+import functools
+import multiprocessing
+import signal
+import sys
+import time
+
+from smartsched.daemon import supervisor
+
+
+def exit_with_error():
+    sys.exit(3)
+
+
+def ignore_sigterm(ready):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    ready.set()
+    time.sleep(60)
+
+
+class FinishedProcess:
+    """Stand-in for multiprocessing.Process which has already exited."""
+    exitcode = 1
+
+    def join(self, timeout=None):
+        pass
+
+    def is_alive(self):
+        return False
+
+
+def crash(strategy, now, monkeypatch, exitcode=1):
+    monkeypatch.setattr(supervisor.time, 'monotonic', lambda: now)
+    strategy.process = FinishedProcess()
+    strategy.process.exitcode = exitcode
+    strategy.exit_handled = False
+    return strategy.on_exit()
+
+
+def test_backoff_doubles_up_to_max(monkeypatch):
+    strategy = supervisor.SupervisedStrategy('s', None, backoff=1, backoff_max=5, max_restarts=10)
+    delays = [crash(strategy, now, monkeypatch) for now in range(1, 6)]
+    assert delays == [1, 2, 4, 5, 5]
+    assert strategy.next_start == 5 + 5
+
+
+def test_restart_is_due_after_delay(monkeypatch):
+    strategy = supervisor.SupervisedStrategy('s', None, backoff=2)
+    crash(strategy, 100, monkeypatch)
+    assert not strategy.restart_due(101)
+    assert strategy.restart_due(102)
+
+
+def test_crash_loop_gives_up(monkeypatch):
+    strategy = supervisor.SupervisedStrategy('s', None, max_restarts=2, crash_loop_window=600)
+    assert crash(strategy, 10, monkeypatch) is not None
+    assert crash(strategy, 20, monkeypatch) is not None
+    assert crash(strategy, 30, monkeypatch) is None
+    assert strategy.given_up
+    assert strategy.next_start is None
+
+
+def test_crashes_out_of_window_are_forgotten(monkeypatch):
+    strategy = supervisor.SupervisedStrategy('s', None, backoff=1, max_restarts=2, crash_loop_window=60)
+    crash(strategy, 0, monkeypatch)
+    crash(strategy, 10, monkeypatch)
+    # Both previous crashes are out of the window, backoff starts again
+    assert crash(strategy, 100, monkeypatch) == 1
+    assert not strategy.given_up
+
+
+def test_exit_is_handled_once():
+    strategy = supervisor.SupervisedStrategy('s', exit_with_error)
+    assert not strategy.has_exited()
+    strategy.start()
+    strategy.process.join()
+    # is_alive reaps the child, its exit should still be noticed
+    assert not strategy.is_alive()
+    assert strategy.has_exited()
+    assert strategy.on_exit() == 1
+    assert strategy.process.exitcode == 3
+    assert not strategy.has_exited()
+
+
+def test_restart_starts_new_process():
+    strategy = supervisor.SupervisedStrategy('s', exit_with_error, backoff=0)
+    strategy.start()
+    strategy.process.join()
+    strategy.on_exit()
+    assert strategy.restart_due(time.monotonic())
+    strategy.restart()
+    assert strategy.restarts == 1
+    assert strategy.next_start is None
+    strategy.process.join()
+    assert strategy.has_exited()
+
+
+def test_clean_exit_is_not_a_crash(monkeypatch):
+    strategy = supervisor.SupervisedStrategy('s', None, max_restarts=0)
+    assert crash(strategy, 10, monkeypatch, exitcode=0) is None
+    assert strategy.finished
+    assert not strategy.given_up
+    assert strategy.crash_times == []
+    assert not strategy.restart_due(1000)
+
+
+def test_hung_strategies_share_shutdown_deadline():
+    strategies = []
+    for name in ('a', 'b', 'c'):
+        ready = multiprocessing.Event()
+        strategy = supervisor.SupervisedStrategy(name, functools.partial(ignore_sigterm, ready))
+        strategy.start()
+        ready.wait(10)
+        strategies.append(strategy)
+    started = time.monotonic()
+    assert supervisor.terminate_all(strategies, timeout=1) == ['a', 'b', 'c']
+    assert time.monotonic() - started < 2.5
+    assert not any(strategy.is_alive() for strategy in strategies)
@@ -0,0 +1,53 @@
+import pytest
+
+from smartsched.daemon import trace
+
+
+def snapshot(time, vms, hosts=(1, 2)):
+    return {'time': time,
+            'hosts': {108: [{'id': host_id, 'vms': []} for host_id in hosts]},
+            'vms': [{'id': vm_id, 'state': state} for vm_id, state in vms.items()],
+            'host_metrics': {}}
+
+
+def test_delta_frames_hold_only_changes(tmp_path):
+    path = str(tmp_path / 'day.trace')
+    writer = trace.TraceWriter(path, keyframe_interval=3)
+    writer.write(snapshot(0, {1: 'ACTIVE', 2: 'PENDING'}), {1: {'cpu': 0.1, 'mem': 0.2}})
+    writer.write(snapshot(60, {1: 'ACTIVE', 2: 'ACTIVE', 3: 'PENDING'}), {1: {'cpu': 0.1, 'mem': 0.2}})
+    writer.write(snapshot(120, {2: 'ACTIVE'}, hosts=(1, )), {})
+    writer.write(snapshot(180, {2: 'ACTIVE'}, hosts=(1, )), {})
+    writer.close()
+
+    frames = []
+    for frame in trace.TraceReader(path):
+        frames.append((frame['time'], frame['key_frame'], sorted(frame['vms']), frame['changes']['vms'],
+                       [host['id'] for host in frame['hosts'][108]], sorted(frame['vm_usage'])))
+    assert frames == [(0, True, [1, 2], ([1, 2], []), [1, 2], [1]),
+                      (60, False, [1, 2, 3], ([2, 3], []), [1, 2], [1]),
+                      (120, False, [2], ([], [1, 3]), [1], []),
+                      (180, True, [2], ([2], []), [1], [])]
+
+
+def test_interrupted_recording_is_continued(tmp_path):
+    path = str(tmp_path / 'day.trace')
+    writer = trace.TraceWriter(path)
+    writer.write(snapshot(0, {1: 'ACTIVE'}))
+    writer.close()
+    with open(path, 'ab') as trace_file:
+        trace_file.write(trace.FRAME_HEADER.pack(60, trace.DELTA_FRAME, 1000) + b'half')
+    assert [frame['time'] for frame in trace.TraceReader(path)] == [0]
+
+    # Incomplete frame is cut off, the new recording starts with a key frame
+    writer = trace.TraceWriter(path)
+    writer.write(snapshot(120, {2: 'ACTIVE'}))
+    writer.close()
+    frames = [(frame['time'], frame['key_frame'], sorted(frame['vms'])) for frame in trace.TraceReader(path)]
+    assert frames == [(0, True, [1]), (120, True, [2])]
+
+
+def test_unknown_file(tmp_path):
+    path = tmp_path / 'day.trace'
+    path.write_bytes(b'something else')
+    with pytest.raises(trace.TraceError):
+        list(trace.TraceReader(str(path)))
@@ -0,0 +1,66 @@
+import pytest
+
+from smartsched.daemon import vm_registry
+
+
+class Cloud:
+    """Cloud handler which knows VMs with given ids and records requested ranges."""
+
+    def __init__(self, vm_ids, done=()):
+        self.vms = {vm_id: {'id': vm_id, 'state': 'DONE' if vm_id in done else 'ACTIVE'} for vm_id in vm_ids}
+        self.ranges = []
+
+    def get_vms_repr(self, startId=-1, endId=-1, vmStateFilter=-1):
+        self.ranges.append((startId, endId))
+        return [dict(vm) for vm_id, vm in sorted(self.vms.items())
+                if (startId < 0 or vm_id >= startId) and (endId < 0 or vm_id <= endId) and
+                (vmStateFilter != -1 or vm['state'] != 'DONE')]
+
+
+@pytest.mark.parametrize('vm_ids, page_size, max_gap, ranges', [
+    ([], 500, None, []),
+    ([5, '3', 4, 4], 500, None, [(3, 5)]),
+    (range(1, 11), 4, None, [(1, 4), (5, 8), (9, 10)]),
+    ([1, 2, 100, 101], 500, 10, [(1, 2), (100, 101)]),
+])
+def test_id_ranges(vm_ids, page_size, max_gap, ranges):
+    assert list(vm_registry.iter_id_ranges(vm_ids, page_size, max_gap)) == ranges
+
+
+def test_pages_contain_only_requested_vms():
+    cloud = Cloud(range(1, 21))
+    pages = list(vm_registry.iter_vm_pages(cloud, [2, 4, 15], page_size=2, max_gap=5))
+    assert [[vm['id'] for vm in page] for page in pages] == [[2, 4], [15]]
+    assert cloud.ranges == [(2, 4), (15, 15)]
+
+
+def test_missing_vms_are_fetched_together_once():
+    cloud = Cloud([1, 2, 3, 1000])
+    registry = vm_registry.VMRegistry(cloud)
+    registry.add([{'id': 1}])
+    registry.prefetch([1, 2, 3, 7, 1000])
+    assert cloud.ranges == [(2, 7), (1000, 1000)]
+    assert len(registry) == 4
+    # Unknown VM is not requested again
+    assert registry.get(7) is None
+    assert registry.get_many(['3', 7, 1000]) == [{'id': 3, 'state': 'ACTIVE'}, {'id': 1000, 'state': 'ACTIVE'}]
+    assert len(cloud.ranges) == 2
+
+
+def test_refresh_replaces_registry():
+    cloud = Cloud([1, 2, 3])
+    registry = vm_registry.VMRegistry(cloud)
+    registry.add([{'id': 9}])
+    assert len(registry.refresh(startId=2, endId=-1)) == 2
+    assert 9 not in registry
+    assert 2 in registry and '3' in registry
+
+
+def test_stream_fills_registry_while_consumed():
+    cloud = Cloud(range(1, 11), done=[3])
+    registry = vm_registry.VMRegistry(cloud)
+    stream = registry.stream([1, 2, 3, 9], page_size=2)
+    assert len(registry) == 0
+    assert [vm['id'] for vm in stream] == [1, 2, 9]
+    assert sorted(registry.vms) == [1, 2, 9]
+    assert cloud.ranges == [(1, 2), (3, 3), (9, 9)]
@@ -0,0 +1,110 @@
+import math
+
+import numpy as np
+import pytest
+
+from smartsched.daemon import vm_stats
+
+
+def probes(*pairs):
+    timestamps = np.array([timestamp for timestamp, value in pairs], dtype=np.float64)
+    values = np.array([value for timestamp, value in pairs], dtype=np.float64)
+    return timestamps, {'cpu': values, 'mem': values}
+
+
+def test_only_probes_newer_than_last_seen_are_merged():
+    window = vm_stats.UsageWindow(600)
+    assert window.last_seen(1) is None
+    assert window.merge(1, *probes((60, 0.1), (120, 0.2))) == 2
+    assert window.last_seen(1) == 120
+    # The next fetch overlaps the previous one, old probes are not counted twice
+    assert window.merge(1, *probes((120, 0.2), (180, 0.3))) == 1
+    assert window.aggregate([1])[1]['count'] == 3
+
+
+def test_corrupted_probe_moves_last_seen():
+    window = vm_stats.UsageWindow(600)
+    assert window.merge(1, *probes((60, 0.1), (120, float('nan')))) == 1
+    assert window.last_seen(1) == 120
+
+
+def test_probes_out_of_window_are_dropped():
+    window = vm_stats.UsageWindow(600)
+    window.merge(1, *probes((0, 1.0), (300, 0.2), (600, 0.4)))
+    window.expire(700)
+    stats = window.aggregate([1])[1]
+    assert stats['count'] == 2
+    assert math.isclose(stats['cpu']['mean'], 0.3)
+    assert stats['mem']['max'] == 0.4
+
+
+def test_not_incremental_merge_replaces_probes():
+    window = vm_stats.UsageWindow(600)
+    window.merge(1, *probes((60, 0.1), (120, 0.2)))
+    window.merge(1, *probes((60, 0.5)), incremental=False)
+    assert window.last_seen(1) is None
+    assert window.aggregate([1])[1]['cpu']['max'] == 0.5
+
+
+def test_retain_forgets_other_vms():
+    window = vm_stats.UsageWindow(600)
+    window.merge(1, *probes((60, 0.1)))
+    window.merge(2, *probes((60, 0.1)))
+    window.retain([2])
+    assert 1 not in window
+    assert window.aggregate([1, 2])[1] is None
+
+
+def test_parse_rows_marks_corrupted_probes():
+    rows = [{'time': '2018-10-10T10:00:00Z', 'cpu': 150.0, 'mem': 40.0, 'num': 2},
+            {'time': '2018-10-10T10:01:00.5Z', 'cpu': 50.0, 'mem': 20.0, 'num': 0},
+            {'time': '2018-10-10T10:02:00Z', 'mem': 10.0}]
+    timestamps, values, complete = vm_stats.parse_rows(rows, 1, now=0)
+    assert complete
+    assert list(timestamps) == [1539165600.0, 1539165660.5, 1539165720.0]
+    # Zero number of cores is replaced by the allocation
+    assert values['cpu'][:2].tolist() == [0.75, 0.5]
+    assert values['mem'][:2].tolist() == [0.4, 0.2]
+    assert np.isnan(values['cpu'][2]) and np.isnan(values['mem'][2])
+
+
+def test_probes_without_time_get_current_time():
+    timestamps, values, complete = vm_stats.parse_rows([{'cpu': 10.0, 'mem': 10.0, 'num': 1}], 1, now=42)
+    assert not complete
+    assert timestamps.tolist() == [42]
+
+
+def test_to_timestamp():
+    assert vm_stats.to_timestamp(1539165600 * 10 ** 9) == 1539165600.0
+    assert vm_stats.to_timestamp('2018-10-10T10:00:00.25Z') == 1539165600.25
+    assert vm_stats.to_timestamp('yesterday') is None
+    assert vm_stats.to_timestamp(None) is None
+
+
+def test_statistics_of_all_vms_in_one_batch():
+    window = vm_stats.UsageWindow(10000)
+    window.merge(1, *probes(*[(minute * 60, minute / 100.0) for minute in range(1, 101)]))
+    window.merge(2, *probes((60, 0.5), (120, float('nan')), (180, 0.7)))
+    stats = window.aggregate([1, 2, 3], ('mean', 'min', 'max', 'p95', 'ewma'), alpha=0.5)
+    assert stats[3] is None
+    assert stats[1]['count'] == 100
+    assert math.isclose(stats[1]['cpu']['mean'], 0.505)
+    assert math.isclose(stats[1]['cpu']['p95'], 0.9505)
+    assert stats[2]['count'] == 2
+    assert stats[2]['cpu']['min'] == 0.5 and stats[2]['cpu']['max'] == 0.7
+    assert math.isclose(stats[2]['cpu']['ewma'], 0.6)
+
+
+def test_ewma_skips_missing_values():
+    matrix = np.array([[1.0, np.nan, 3.0], [np.nan, np.nan, np.nan]])
+    result = vm_stats.ewma(matrix, 0.5)
+    assert result[0] == 2.0
+    assert np.isnan(result[1])
+
+
+def test_check_statistic():
+    for name in ('mean', 'ewma', 'p95', 'p99.9'):
+        vm_stats.check_statistic(name)
+    for name in ('median', 'p101', 'px'):
+        with pytest.raises(ValueError):
+            vm_stats.check_statistic(name)